@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+#
+# Measures the memory used to keep a large account database in memory.
+#
+# Usage: python3 benchmarks/memory.py [users]
+#
+# The previous layout (one object per passwd/group line, each with its
+# own __dict__, privileges list and members list) is compared with the
+# usersd.packed one, keeping in both cases just the entries and a way to
+# look them up by name, as the old code did. The old objects are
+# emulated without DBus, so the figures for them are a lower bound.
+#
+# The full usersd.store.AccountStore is measured as well: besides the
+# packed tables, it keeps the UID/GID, sorted and reverse indexes the
+# old code didn't have.
+
+import os
+import sys
+
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usersd.packed
+import usersd.records
+import usersd.store
+
+# Users per group
+GROUP_SIZE = 50
+
+class LegacyEntry:
+	"""
+	Emulates the instance state of the old per-line objects.
+	"""
+	
+	def __init__(self, path, **attributes):
+		"""
+		Initializes the entry.
+		"""
+		
+		# What dbus.service.Object.__init__() stores
+		self._object_path = path
+		self._connection = None
+		self._locations = []
+		self._locations_lock = threading.Lock()
+		self._fallback = False
+		
+		self.__dict__.update(attributes)
+
+def generate(users):
+	"""
+	Returns a tuple (passwd_lines, group_lines) for the given number
+	of synthetic users.
+	"""
+	
+	passwd = [
+		"user%d:x:%d:%d:User %d,,,:/home/user%d:/bin/bash" % (i, 1000 + i, 1000 + i, i, i)
+		for i in range(users)
+	]
+	
+	group = []
+	for i in range(0, users, GROUP_SIZE):
+		members = ",".join("user%d" % j for j in range(i, min(i + GROUP_SIZE, users)))
+		group.append("group%d:x:%d:%s" % (i, 100000 + i, members))
+	
+	return passwd, group
+
+def load_legacy(passwd, group):
+	"""
+	Loads the lines the old way.
+	"""
+	
+	users = {}
+	for line in passwd:
+		user, password, uid, gid, infos, home, shell = line.split(":")
+		infos = infos.split(",")
+		users[user] = LegacyEntry(
+			"/org/semplicelinux/usersd/user/%s" % uid,
+			user=user,
+			password=password,
+			uid=int(uid),
+			gid=int(gid),
+			fullname=infos[0],
+			address=infos[1],
+			phone=infos[2],
+			other=infos[3],
+			home=home,
+			shell=shell,
+			set_privileges=[0, int(uid)]
+		)
+	
+	groups = {}
+	for line in group:
+		name, password, gid, members = line.split(":")
+		groups[name] = LegacyEntry(
+			"/org/semplicelinux/usersd/group/%s" % gid,
+			group=name,
+			gid=int(gid),
+			members=members.split(","),
+			set_privileges=[]
+		)
+	
+	return users, groups
+
+def load_packed(passwd, group):
+	"""
+	Loads the lines into packed tables, indexed by name only.
+	"""
+	
+	users = usersd.packed.PackedTable(
+		usersd.records.parse_passwd_entry,
+		usersd.records.format_passwd_record
+	)
+	for record in usersd.records.iter_passwd_records(passwd):
+		users.add(record)
+	
+	groups = usersd.packed.PackedTable(
+		usersd.records.parse_group_entry,
+		usersd.records.format_group_record
+	)
+	for record in usersd.records.iter_group_records(group):
+		groups.add(record)
+	
+	return users, groups
+
+def load_store(passwd, group):
+	"""
+	Loads the lines into an AccountStore.
+	"""
+	
+	store = usersd.store.AccountStore()
+	
+	for record in usersd.records.iter_passwd_records(passwd):
+		store.add_user(record)
+	
+	for record in usersd.records.iter_group_records(group):
+		store.add_group(record)
+	
+	# Sort in what's still pending, as the first lookups would
+	for index in (
+		store.users_by_name,
+		store.uid_index,
+		store.gid_index,
+		store.group_gid_index,
+		store.member_index
+	):
+		index.merge()
+	
+	return store
+
+def measure(func, *args):
+	"""
+	Returns the memory (in bytes) still allocated by func(*args) once
+	it returned.
+	"""
+	
+	tracemalloc.start()
+	result = func(*args)
+	size, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	
+	del result
+	
+	return size
+
+if __name__ == "__main__":
+	users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	
+	passwd, group = generate(users)
+	
+	legacy = measure(load_legacy, passwd, group)
+	packed = measure(load_packed, passwd, group)
+	store = measure(load_store, passwd, group)
+	
+	print("users: %d, groups: %d" % (users, len(group)))
+	print("per-line objects: %8.1f MiB (%d bytes/user)" % (legacy / 1048576, legacy / users))
+	print("packed tables:    %8.1f MiB (%d bytes/user)" % (packed / 1048576, packed / users))
+	print("ratio:            %8.1fx" % (legacy / packed))
+	print("account store:    %8.1f MiB (%d bytes/user, with every index)" % (store / 1048576, store / users))
+	print("ratio:            %8.1fx" % (legacy / store))
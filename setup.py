@@ -176,7 +176,8 @@ setup(
 	url='https://github.com/semplice/usersd',
 	scripts=['usersd-service.py'],
 	packages=[
-		'usersd'
+		'usersd',
+		'usersd.backends'
 	],
 	data_files=[
 		("/usr/share/usersd/usersd", ["usersd/usersd.glade"]),
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import base64
+
+from usersd.cursor import encode_cursor, decode_cursor
+
+class CursorTest(unittest.TestCase):
+	"""
+	Tests for the FindUsers() cursors in usersd.cursor.
+	"""
+	
+	def test_round_trip(self):
+		"""
+		Names and (UID, name) positions come back as they were.
+		"""
+		
+		for key in ("alice", "jos\u00e9", "a:b", (1000, "alice"), (0, "x:y")):
+			self.assertEqual(decode_cursor(encode_cursor(key)), key)
+	
+	def test_empty(self):
+		"""
+		An empty cursor is the first page.
+		"""
+		
+		self.assertIsNone(decode_cursor(""))
+	
+	def test_invalid(self):
+		"""
+		Anything that isn't an encoded position is refused.
+		"""
+		
+		for cursor in (
+			"not base64!",
+			base64.urlsafe_b64encode(b"x:alice").decode(),
+			base64.urlsafe_b64encode(b"u:abc:alice").decode(),
+			base64.urlsafe_b64encode(b"u:1000").decode(),
+			base64.urlsafe_b64encode(b"n:\xff").decode(),
+		):
+			with self.assertRaises(Exception):
+				decode_cursor(cursor)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import os
+
+import functools
+import shutil
+import tempfile
+
+import usersd.fileio
+from usersd.fileio import NewEntry
+
+GROUP = [
+	"root:x:0:\n",
+	"sudo:x:27:alice\n",
+	"users:x:100:alice,bob\n",
+]
+
+class FileIOTest(unittest.TestCase):
+	"""
+	Tests for the account file editing helpers in usersd.fileio.
+	"""
+	
+	def test_replace_line(self):
+		"""
+		A string edit replaces the whole line.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(GROUP, {"sudo" : ["sudo:x:27:bob"]}),
+			["root:x:0:\n", "sudo:x:27:bob\n", "users:x:100:alice,bob\n"]
+		)
+	
+	def test_function_edits_in_order(self):
+		"""
+		Function edits are called with the current line, in order.
+		"""
+		
+		edits = [
+			functools.partial(usersd.fileio.replace_field, index=3, value="alice,bob"),
+			functools.partial(usersd.fileio.replace_field, index=2, value="28"),
+		]
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(GROUP, {"sudo" : edits})[1],
+			"sudo:x:28:alice,bob\n"
+		)
+	
+	def test_remove_line(self):
+		"""
+		An edit of None removes the line, and later edits are ignored.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(GROUP, {"sudo" : [None, "sudo:x:27:"]}),
+			["root:x:0:\n", "users:x:100:alice,bob\n"]
+		)
+	
+	def test_edit_missing_entry(self):
+		"""
+		Edits of entries that don't exist are ignored.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(GROUP, {"staff" : ["staff:x:50:"]}),
+			GROUP
+		)
+	
+	def test_new_entry(self):
+		"""
+		NewEntry edits append the entry, and can be followed by other
+		edits.
+		"""
+		
+		result = usersd.fileio.apply_entries(
+			GROUP,
+			{
+				"staff" : [
+					NewEntry("staff:x:50:"),
+					functools.partial(usersd.fileio.add_member, member="carol")
+				]
+			}
+		)
+		
+		self.assertEqual(result, GROUP + ["staff:x:50:carol\n"])
+	
+	def test_new_entry_already_existing(self):
+		"""
+		A NewEntry for an existing entry raises an exception.
+		"""
+		
+		with self.assertRaises(Exception):
+			usersd.fileio.apply_entries(GROUP, {"sudo" : [NewEntry("sudo:x:27:")]})
+	
+	def test_new_entry_after_removal(self):
+		"""
+		An entry can be removed and added again.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(GROUP, {"sudo" : [None, NewEntry("sudo:x:30:")]}),
+			["root:x:0:\n", "sudo:x:30:\n", "users:x:100:alice,bob\n"]
+		)
+	
+	def test_missing_trailing_newline(self):
+		"""
+		A missing newline at the end of the file is added back before
+		appending new entries.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.apply_entries(
+				["root:x:0:\n", "sudo:x:27:"],
+				{"staff" : [NewEntry("staff:x:50:")]}
+			),
+			["root:x:0:\n", "sudo:x:27:\n", "staff:x:50:\n"]
+		)
+	
+	def test_add_member(self):
+		"""
+		add_member() appends a member only once.
+		"""
+		
+		self.assertEqual(usersd.fileio.add_member("root:x:0:", "bob"), "root:x:0:bob")
+		self.assertEqual(usersd.fileio.add_member("sudo:x:27:alice", "bob"), "sudo:x:27:alice,bob")
+		self.assertEqual(usersd.fileio.add_member("sudo:x:27:alice", "alice"), "sudo:x:27:alice")
+	
+	def test_replace_field(self):
+		"""
+		replace_field() changes only the given field.
+		"""
+		
+		self.assertEqual(
+			usersd.fileio.replace_field("bob:x:1001:1001::/home/bob:/bin/sh", 6, "/bin/bash"),
+			"bob:x:1001:1001::/home/bob:/bin/bash"
+		)
+	
+	def test_write_changes(self):
+		"""
+		write_changes() writes every touched file once, keeping its
+		permissions.
+		"""
+		
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		
+		group = os.path.join(directory, "group")
+		gshadow = os.path.join(directory, "gshadow")
+		with open(group, "w") as f:
+			f.writelines(GROUP)
+		with open(gshadow, "w") as f:
+			f.write("sudo:!::alice\n")
+		os.chmod(gshadow, 0o640)
+		
+		errors = usersd.fileio.write_changes([
+			{group : {"sudo" : "sudo:x:27:alice,bob"}},
+			{group : {"root" : "root:x:0:bob"}, gshadow : {"sudo" : None}},
+		])
+		
+		self.assertEqual(errors, [None, None])
+		with open(group) as f:
+			self.assertEqual(
+				f.readlines(),
+				["root:x:0:bob\n", "sudo:x:27:alice,bob\n", "users:x:100:alice,bob\n"]
+			)
+		with open(gshadow) as f:
+			self.assertEqual(f.read(), "")
+		self.assertEqual(os.stat(gshadow).st_mode & 0o777, 0o640)
+		self.assertEqual(sorted(os.listdir(directory)), ["group", "gshadow"])
+	
+	def test_write_changes_failing(self):
+		"""
+		A change that can't be applied fails on its own, and touches no
+		file, while the others are written.
+		"""
+		
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		
+		group = os.path.join(directory, "group")
+		passwd = os.path.join(directory, "passwd")
+		with open(group, "w") as f:
+			f.writelines(GROUP)
+		with open(passwd, "w") as f:
+			f.write("root:x:0:0:root:/root:/bin/bash\n")
+		
+		def fail(line):
+			"""
+			An edit that can't be applied.
+			"""
+			
+			raise Exception("Unable to edit %s" % line)
+		
+		errors = usersd.fileio.write_changes([
+			{group : {"sudo" : "sudo:x:27:"}},
+			{group : {"users" : None}, passwd : {"root" : fail}},
+			{group : {"users" : "users:x:100:"}},
+		])
+		
+		self.assertIsNone(errors[0])
+		self.assertIsInstance(errors[1], Exception)
+		self.assertIsNone(errors[2])
+		with open(group) as f:
+			self.assertEqual(
+				f.readlines(),
+				["root:x:0:\n", "sudo:x:27:\n", "users:x:100:\n"]
+			)
+		with open(passwd) as f:
+			self.assertEqual(f.read(), "root:x:0:0:root:/root:/bin/bash\n")
+		
+		# An unreadable file fails the whole batch, before writing
+		with self.assertRaises(OSError):
+			usersd.fileio.write_changes([
+				{group : {"sudo" : "sudo:x:27:bob"}},
+				{os.path.join(directory, "shadow") : {"root" : None}},
+			])
+		with open(group) as f:
+			self.assertEqual(f.readlines()[1], "sudo:x:27:\n")
+
+if __name__ == "__main__":
+	unittest.main()
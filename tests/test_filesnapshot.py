@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import os
+
+import shutil
+import tempfile
+
+from usersd.filesnapshot import FileSnapshot
+
+class FileSnapshotTest(unittest.TestCase):
+	"""
+	Tests for usersd.filesnapshot.FileSnapshot.
+	"""
+	
+	def setUp(self):
+		"""
+		Creates an account file in a temporary directory, and loads
+		its snapshot.
+		"""
+		
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "passwd")
+		self.write(
+			"root:x:0:0:root:/root:/bin/bash\n",
+			"alice:x:1000:1000:Alice,,,:/home/alice:/bin/bash\n",
+			"bob:x:1001:1001:Bob,,,:/home/bob:/bin/bash\n",
+		)
+		
+		self.snapshot = FileSnapshot(self.path)
+		self.snapshot.load()
+	
+	def tearDown(self):
+		"""
+		Removes the temporary directory.
+		"""
+		
+		shutil.rmtree(self.directory)
+	
+	def write(self, *lines):
+		"""
+		Replaces the content of the account file.
+		"""
+		
+		with open(self.path, "w") as f:
+			f.writelines(lines)
+	
+	def test_unchanged(self):
+		"""
+		Nothing is reported if the file didn't change.
+		"""
+		
+		changed, removed, hashes = self.snapshot.diff()
+		
+		self.assertEqual(changed, {})
+		self.assertEqual(removed, set())
+		self.assertEqual(hashes, self.snapshot.hashes)
+	
+	def test_diff(self):
+		"""
+		New and modified lines are reported with their content, removed
+		entries by name.
+		"""
+		
+		self.write(
+			"root:x:0:0:root:/root:/bin/bash\n",
+			"\n",
+			"bob:x:1001:1001:Bob,,,:/home/bob:/bin/sh\n",
+			"carol:x:1002:1002:Carol,,,:/home/carol:/bin/bash\n",
+		)
+		
+		changed, removed, hashes = self.snapshot.diff()
+		
+		self.assertEqual(
+			changed,
+			{
+				"bob" : "bob:x:1001:1001:Bob,,,:/home/bob:/bin/sh",
+				"carol" : "carol:x:1002:1002:Carol,,,:/home/carol:/bin/bash",
+			}
+		)
+		self.assertEqual(removed, {"alice"})
+		self.assertEqual(set(hashes), {"root", "bob", "carol"})
+	
+	def test_diff_keeps_snapshot(self):
+		"""
+		The snapshot is updated only once the new hashes are set.
+		"""
+		
+		self.write("root:x:0:0:root:/root:/bin/sh\n")
+		
+		changed, removed, hashes = self.snapshot.diff()
+		self.assertEqual(self.snapshot.diff()[:2], (changed, removed))
+		
+		self.snapshot.hashes = hashes
+		self.assertEqual(self.snapshot.diff()[:2], ({}, set()))
+	
+	def test_missing_file(self):
+		"""
+		Every entry is removed when the file is missing.
+		"""
+		
+		os.remove(self.path)
+		
+		changed, removed, hashes = self.snapshot.diff()
+		
+		self.assertEqual(changed, {})
+		self.assertEqual(removed, {"root", "alice", "bob"})
+		self.assertEqual(hashes, {})
+	
+	def test_dump_and_restore(self):
+		"""
+		A restored snapshot compares like the dumped one.
+		"""
+		
+		state = self.snapshot.dump()
+		self.write("root:x:0:0:root:/root:/bin/sh\n")
+		
+		restored = FileSnapshot(self.path)
+		restored.restore(tuple(map(memoryview, state)))
+		
+		# Not yet used, the state is dumped as it was restored
+		self.assertEqual(restored.dump(), state)
+		
+		self.assertEqual(restored.diff()[:2], self.snapshot.diff()[:2])
+		self.assertEqual(restored.hashes, self.snapshot.hashes)
+		self.assertEqual(restored.dump(), state)
+	
+	def test_dump_empty(self):
+		"""
+		An empty snapshot is restored as empty.
+		"""
+		
+		restored = FileSnapshot(self.path)
+		restored.restore(FileSnapshot(self.path).dump())
+		
+		self.assertEqual(restored.hashes, {})
+
+if __name__ == "__main__":
+	unittest.main()
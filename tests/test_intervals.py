@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+from usersd.intervals import IntervalSet
+
+class IntervalSetTest(unittest.TestCase):
+	"""
+	Tests for usersd.intervals.IntervalSet.
+	"""
+	
+	def intervals(self, interval_set):
+		"""
+		Returns the intervals of the given set, as (start, end) tuples.
+		"""
+		
+		return list(zip(interval_set.starts, interval_set.ends))
+	
+	def test_init_merges_adjacent_values(self):
+		"""
+		Sorted values are collapsed into intervals.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 3, 5, 6, 9])
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 3), (5, 6), (9, 9)])
+		self.assertEqual(len(interval_set), 3)
+	
+	def test_init_ignores_duplicates(self):
+		"""
+		Repeated values don't create new intervals.
+		"""
+		
+		interval_set = IntervalSet([1, 1, 2, 2])
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 2)])
+	
+	def test_contains(self):
+		"""
+		Membership is checked against every interval.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 3, 10])
+		
+		for value in (1, 2, 3, 10):
+			self.assertIn(value, interval_set)
+		for value in (0, 4, 9, 11):
+			self.assertNotIn(value, interval_set)
+	
+	def test_add_new_interval(self):
+		"""
+		A value far from the others gets its own interval.
+		"""
+		
+		interval_set = IntervalSet([1, 10])
+		interval_set.add(5)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 1), (5, 5), (10, 10)])
+	
+	def test_add_extends_previous(self):
+		"""
+		A value right after an interval extends it.
+		"""
+		
+		interval_set = IntervalSet([1, 2])
+		interval_set.add(3)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 3)])
+	
+	def test_add_extends_next(self):
+		"""
+		A value right before an interval extends it.
+		"""
+		
+		interval_set = IntervalSet([5, 6])
+		interval_set.add(4)
+		
+		self.assertEqual(self.intervals(interval_set), [(4, 6)])
+	
+	def test_add_joins_intervals(self):
+		"""
+		A value filling a gap joins the two intervals.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 4, 5])
+		interval_set.add(3)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 5)])
+	
+	def test_add_existing(self):
+		"""
+		Adding a value already there changes nothing.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 3])
+		interval_set.add(2)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 3)])
+	
+	def test_remove_single_value_interval(self):
+		"""
+		Removing the only value of an interval drops it.
+		"""
+		
+		interval_set = IntervalSet([1, 5])
+		interval_set.remove(5)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 1)])
+	
+	def test_remove_bounds(self):
+		"""
+		Removing a bound shrinks the interval.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 3, 4])
+		interval_set.remove(1)
+		interval_set.remove(4)
+		
+		self.assertEqual(self.intervals(interval_set), [(2, 3)])
+	
+	def test_remove_splits(self):
+		"""
+		Removing a value in the middle splits the interval.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 3, 4, 5])
+		interval_set.remove(3)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 2), (4, 5)])
+	
+	def test_remove_missing(self):
+		"""
+		Removing a value not there changes nothing.
+		"""
+		
+		interval_set = IntervalSet([1, 2, 5])
+		interval_set.remove(0)
+		interval_set.remove(3)
+		interval_set.remove(6)
+		
+		self.assertEqual(self.intervals(interval_set), [(1, 2), (5, 5)])
+	
+	def test_first_free(self):
+		"""
+		first_free() jumps over the interval containing the minimum.
+		"""
+		
+		interval_set = IntervalSet([1000, 1001, 1002, 1005])
+		
+		self.assertEqual(interval_set.first_free(1000, 2000), 1003)
+		self.assertEqual(interval_set.first_free(1003, 2000), 1003)
+		self.assertEqual(interval_set.first_free(1005, 2000), 1006)
+		self.assertEqual(interval_set.first_free(500, 2000), 500)
+	
+	def test_first_free_exhausted(self):
+		"""
+		first_free() returns None when the range is full.
+		"""
+		
+		interval_set = IntervalSet(range(1000, 1010))
+		
+		self.assertIsNone(interval_set.first_free(1000, 1009))
+		self.assertEqual(interval_set.first_free(1000, 1010), 1010)
+
+if __name__ == "__main__":
+	unittest.main()
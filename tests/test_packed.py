@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import usersd.packed
+import usersd.records
+
+def user(name, uid, fullname=None):
+	"""
+	Returns a PasswdRecord for the given user.
+	"""
+	
+	return usersd.records.parse_passwd_entry(
+		"%s:x:%d:%d:%s,,,:/home/%s:/bin/bash" % (
+			name,
+			uid,
+			uid,
+			name.title() if fullname is None else fullname,
+			name
+		)
+	)
+
+def table():
+	"""
+	Returns an empty PackedTable of users.
+	"""
+	
+	return usersd.packed.PackedTable(
+		usersd.records.parse_passwd_entry,
+		usersd.records.format_passwd_record
+	)
+
+class PackedTableTest(unittest.TestCase):
+	"""
+	Tests for usersd.packed.PackedTable.
+	"""
+	
+	def test_records(self):
+		"""
+		Records come back as they were added, looked up by name.
+		"""
+		
+		users = table()
+		alice = user("alice", 1000)
+		row = users.add(alice)
+		users.add(user("bob", 1001))
+		
+		self.assertEqual(users["alice"], alice)
+		self.assertEqual(users.record(row), alice)
+		self.assertEqual(users.find("bob"), row + 1)
+		self.assertEqual(users.find("carol"), -1)
+		self.assertIn("bob", users)
+		self.assertNotIn(1001, users)
+		self.assertIsNone(users.get("carol"))
+		self.assertEqual(list(users), ["alice", "bob"])
+		self.assertEqual(len(users), 2)
+	
+	def test_non_ascii(self):
+		"""
+		Names and fields are not limited to ASCII.
+		"""
+		
+		users = table()
+		record = user("jos\u00e9", 1000, "Jos\u00e9 \u00c1lvarez")
+		users.add(record)
+		
+		self.assertEqual(users["jos\u00e9"], record)
+	
+	def test_unstorable_record(self):
+		"""
+		Records that would not read back the same are refused.
+		"""
+		
+		users = table()
+		record = user("alice", 1000)._replace(fullname="a:b")
+		
+		with self.assertRaises(ValueError):
+			users.add(record)
+		
+		self.assertEqual(len(users), 0)
+	
+	def test_remove_and_grow(self):
+		"""
+		Lookups keep working while the hash table grows and rows are
+		removed.
+		"""
+		
+		users = table()
+		for i in range(1000):
+			users.add(user("user%d" % i, 1000 + i))
+		
+		for i in range(0, 1000, 2):
+			users.remove(users.find("user%d" % i))
+		
+		self.assertEqual(len(users), 500)
+		self.assertEqual(users.find("user10"), -1)
+		self.assertEqual(users["user11"].uid, 1011)
+		self.assertEqual(list(users)[:2], ["user1", "user3"])
+	
+	def test_compact(self):
+		"""
+		Compaction drops the removed rows, keeping the order of the
+		others, and returns how they have been numbered again.
+		"""
+		
+		users = table()
+		for i in range(300):
+			users.add(user("user%d" % i, 1000 + i))
+		
+		for i in range(200):
+			users.remove(users.find("user%d" % i))
+		
+		self.assertTrue(users.needs_compaction())
+		
+		old = users.find("user250")
+		remap = users.compact()
+		
+		self.assertFalse(users.needs_compaction())
+		self.assertEqual(users.find("user250"), remap[old])
+		self.assertEqual(users.find("user200"), 0)
+		self.assertEqual(users["user299"].uid, 1299)
+		self.assertEqual(len(users.starts), 100)
+
+class IndexTest(unittest.TestCase):
+	"""
+	Tests for usersd.packed.NumberIndex and NameIndex.
+	"""
+	
+	def test_number_index(self):
+		"""
+		Pairs are sorted by number and tiebreak, whether they are
+		merged all at once or one by one.
+		"""
+		
+		users = table()
+		index = usersd.packed.NumberIndex(users.key)
+		
+		for name, uid in (("root", 0), ("carol", 1002), ("toor", 0), ("alice", 1000)):
+			index.add(uid, users.add(user(name, uid)))
+		
+		self.assertEqual(index.range(0, 2000), (0, 4))
+		self.assertEqual(list(index.numbers), [0, 0, 1000, 1002])
+		self.assertEqual([users.name(row) for row in index.find(0)], ["root", "toor"])
+		
+		# Few pairs are inserted one by one
+		index.add(0, users.add(user("admin", 0)))
+		self.assertEqual(
+			[users.name(row) for row in index.find(0)],
+			["admin", "root", "toor"]
+		)
+		self.assertEqual(users.name(index.first(0)), "root")
+		self.assertEqual(index.range(1, 1001), (3, 4))
+		
+		index.remove(0, users.find("root"))
+		self.assertEqual(users.name(index.first(0)), "toor")
+		self.assertEqual(index.first(4242), -1)
+	
+	def test_name_index(self):
+		"""
+		Rows are sorted by name, and found with bisect().
+		"""
+		
+		users = table()
+		index = usersd.packed.NameIndex(users)
+		
+		for name, uid in (("carol", 1002), ("alice", 1000), ("bob", 1001)):
+			index.add(users.add(user(name, uid)))
+		
+		self.assertEqual(index.bisect(b"bob"), 1)
+		self.assertEqual(index.bisect(b"bob", right=True), 2)
+		
+		index.add(users.add(user("bea", 1003)))
+		index.remove(users.find("alice"))
+		
+		self.assertEqual(
+			[users.name(row) for row in index.rows],
+			["bea", "bob", "carol"]
+		)
+	
+	def test_dump_and_restore(self):
+		"""
+		Restored tables and indexes match the dumped ones.
+		"""
+		
+		users = table()
+		index = usersd.packed.NumberIndex()
+		for i in range(50):
+			index.add(1000 + i, users.add(user("user%d" % i, 1000 + i)))
+		users.remove(users.find("user7"))
+		
+		restored = table()
+		restored.restore(users.dump())
+		restored_index = usersd.packed.NumberIndex()
+		restored_index.restore(index.dump())
+		
+		self.assertEqual(restored, users)
+		self.assertEqual(restored["user8"], users["user8"])
+		self.assertEqual(list(restored_index.rows), list(index.rows))
+		
+		restored.add(user("user7", 1007))
+		self.assertEqual(restored["user7"].uid, 1007)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import os
+
+import shutil
+import tempfile
+
+import usersd.shadow
+
+from usersd.shadow import ShadowCache
+
+SHADOW = [
+	"root:*:19000:0:99999:7:::\n",
+	"alice:$6$salt$hash:19500:0:99999:7:::\n",
+	"bob:!:19600:1:90:14:30:20000:\n",
+]
+
+class ShadowCacheTest(unittest.TestCase):
+	"""
+	Tests for usersd.shadow.ShadowCache.
+	"""
+	
+	def setUp(self):
+		"""
+		Creates a shadow file in a temporary directory.
+		"""
+		
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "shadow")
+		self.write(*SHADOW)
+		
+		self.cache = ShadowCache(self.path)
+	
+	def tearDown(self):
+		"""
+		Removes the temporary directory.
+		"""
+		
+		shutil.rmtree(self.directory)
+	
+	def write(self, *lines):
+		"""
+		Replaces the content of the shadow file.
+		"""
+		
+		with open(self.path, "w") as f:
+			f.writelines(lines)
+	
+	def test_lookups(self):
+		"""
+		Fields are looked up by user, and numbers converted.
+		"""
+		
+		self.assertEqual(
+			self.cache.get("bob"),
+			["bob", "!", "19600", "1", "90", "14", "30", "20000", ""]
+		)
+		self.assertEqual(self.cache.get_field("alice", usersd.shadow.PASSWORD), "$6$salt$hash")
+		self.assertEqual(self.cache.get_number("bob", usersd.shadow.EXPIRE_DATE), 20000)
+		self.assertIsNone(self.cache.get_number("alice", usersd.shadow.EXPIRE_DATE))
+		self.assertIsNone(self.cache.get("carol"))
+		self.assertIsNone(self.cache.get_field("carol", usersd.shadow.PASSWORD))
+	
+	def test_malformed_and_duplicate_lines(self):
+		"""
+		Lines without fields are skipped, and the last entry of an user
+		wins.
+		"""
+		
+		self.write(
+			"root:*:19000:0:99999:7:::\n",
+			"garbage\n",
+			"\n",
+			"alice:!:1::::::\n",
+			"alice:*:2::::::\n",
+		)
+		
+		self.assertEqual(self.cache.get_field("alice", usersd.shadow.PASSWORD), "*")
+		self.assertEqual(len(self.cache.entries), 2)
+	
+	def test_validate(self):
+		"""
+		The file is parsed again only when it changes.
+		"""
+		
+		self.assertEqual(self.cache.get_field("root", usersd.shadow.PASSWORD), "*")
+		
+		# Same size and mtime: the cached entries are used
+		st = os.stat(self.path)
+		self.write(SHADOW[0].replace("*", "!"), *SHADOW[1:])
+		os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+		self.assertEqual(self.cache.get_field("root", usersd.shadow.PASSWORD), "*")
+		
+		self.write(*SHADOW[:2])
+		self.assertEqual(self.cache.get_field("root", usersd.shadow.PASSWORD), "*")
+		self.assertIsNone(self.cache.get("bob"))
+		
+		os.remove(self.path)
+		self.assertIsNone(self.cache.get("root"))
+		self.assertIsNone(self.cache.stamp)
+	
+	def test_dump_without_passwords(self):
+		"""
+		Passwords are left out of the dumped state.
+		"""
+		
+		stamp, aging = self.cache.dump()
+		
+		restored = usersd.shadow.new_table()
+		restored.restore(aging)
+		
+		self.assertEqual(restored["alice"][usersd.shadow.PASSWORD], "")
+		self.assertEqual(restored["bob"][usersd.shadow.EXPIRE_DATE], "20000")
+		self.assertNotIn(b"$6$", bytes(aging[0]))
+		
+		# The cache itself keeps them
+		self.assertEqual(self.cache.get_field("alice", usersd.shadow.PASSWORD), "$6$salt$hash")
+	
+	def test_restore(self):
+		"""
+		A restored cache answers aging lookups without reading the file,
+		and reads it once a password is needed.
+		"""
+		
+		state = self.cache.dump()
+		
+		restored = ShadowCache(self.path)
+		restored.restore(state)
+		
+		# Make any read visible
+		st = os.stat(self.path)
+		self.write(SHADOW[0], SHADOW[1].replace("19500", "19501"), SHADOW[2])
+		os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+		
+		self.assertTrue(restored.partial)
+		self.assertEqual(restored.get_number("alice", usersd.shadow.LAST_CHANGE), 19500)
+		self.assertTrue(restored.partial)
+		
+		self.assertEqual(restored.get_field("alice", usersd.shadow.PASSWORD), "$6$salt$hash")
+		self.assertFalse(restored.partial)
+		self.assertEqual(restored.get_number("alice", usersd.shadow.LAST_CHANGE), 19501)
+	
+	def test_restore_changed(self):
+		"""
+		A restored cache is ignored if the file changed since the dump.
+		"""
+		
+		state = self.cache.dump()
+		self.write(*SHADOW[:2])
+		
+		restored = ShadowCache(self.path)
+		restored.restore(state)
+		
+		self.assertIsNone(restored.get_number("bob", usersd.shadow.LAST_CHANGE))
+		self.assertFalse(restored.partial)
+
+if __name__ == "__main__":
+	unittest.main()
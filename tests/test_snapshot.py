@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import shutil
+import tempfile
+import unittest
+
+import usersd.records
+import usersd.snapshot
+import usersd.store
+
+KEY = ((1, 2, 3), (4, 5, 6), None)
+
+class SnapshotCacheTest(unittest.TestCase):
+	"""
+	Tests for usersd.snapshot.SnapshotCache.
+	"""
+	
+	def setUp(self):
+		"""
+		Creates a cache in a temporary directory.
+		"""
+		
+		self.directory = tempfile.mkdtemp()
+		self.cache = usersd.snapshot.SnapshotCache(
+			os.path.join(self.directory, "cache", "accounts.cache")
+		)
+	
+	def tearDown(self):
+		"""
+		Removes the temporary directory.
+		"""
+		
+		shutil.rmtree(self.directory)
+	
+	def test_buffers(self):
+		"""
+		Buffers come back as memoryviews, everything else as it was.
+		"""
+		
+		self.cache.save(KEY, ((b"abc", 3), {"path" : (b"", b"x" * 5000)}, None))
+		
+		(buffer, number), state, nothing = self.cache.load(KEY)
+		
+		self.assertIsInstance(buffer, memoryview)
+		self.assertEqual(bytes(buffer), b"abc")
+		self.assertEqual(number, 3)
+		self.assertEqual(bytes(state["path"][1]), b"x" * 5000)
+		self.assertEqual(bytes(state["path"][0]), b"")
+		self.assertIsNone(nothing)
+	
+	def test_stale(self):
+		"""
+		A cache built from other sources is not used.
+		"""
+		
+		self.cache.save(KEY, (b"abc",))
+		
+		self.assertIsNone(self.cache.load(((1, 2, 4), (4, 5, 6), None)))
+	
+	def test_untrusted(self):
+		"""
+		A cache others could have written is not used.
+		"""
+		
+		self.cache.save(KEY, (b"abc",))
+		os.chmod(self.cache.path, 0o644)
+		
+		self.assertIsNone(self.cache.load(KEY))
+	
+	def test_truncated(self):
+		"""
+		A truncated cache is not used.
+		"""
+		
+		self.cache.save(KEY, (b"x" * 5000,))
+		os.truncate(self.cache.path, os.path.getsize(self.cache.path) - 1)
+		
+		self.assertIsNone(self.cache.load(KEY))
+		
+		os.truncate(self.cache.path, 4)
+		self.assertIsNone(self.cache.load(KEY))
+	
+	def test_store(self):
+		"""
+		An account store restored from the cache matches the saved one.
+		"""
+		
+		store = usersd.store.AccountStore()
+		for i in range(100):
+			store.add_user(usersd.records.parse_passwd_entry(
+				"user%d:x:%d:100:User %d,,,:/home/user%d:/bin/sh" % (i, 1000 + i, i, i)
+			))
+		store.add_group(usersd.records.parse_group_entry("users:x:100:user1,user2"))
+		store.remove_user("user50")
+		
+		self.cache.save(KEY, store.dump())
+		
+		restored = usersd.store.AccountStore()
+		restored.restore(self.cache.load(KEY))
+		
+		self.assertEqual(restored.users, store.users)
+		self.assertEqual(restored.get_user_by_uid(1099).user, "user99")
+		self.assertEqual(restored.get_groups_for_user("user2"), ("users",))
+		self.assertEqual(len(list(restored.iter_users_in_group(restored.get_group("users")))), 99)
+		self.assertIn(1049, restored.used_uids)
+		self.assertNotIn(1050, restored.used_uids)
+		
+		# The restored store is not tied to the file
+		os.unlink(self.cache.path)
+		restored.add_user(usersd.records.parse_passwd_entry(
+			"user50:x:1050:100:,,,:/home/user50:/bin/sh"
+		))
+		self.assertEqual(restored.get_user("user50").uid, 1050)
+
+if __name__ == "__main__":
+	unittest.main()
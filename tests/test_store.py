@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import unittest
+
+import usersd.records
+import usersd.store
+
+def user(name, uid, gid=None):
+	"""
+	Returns a PasswdRecord for the given user.
+	"""
+	
+	return usersd.records.parse_passwd_entry(
+		"%s:x:%d:%d:%s,,,:/home/%s:/bin/bash" % (
+			name,
+			uid,
+			uid if gid is None else gid,
+			name.title(),
+			name
+		)
+	)
+
+def names(records):
+	"""
+	Returns the names of the given PasswdRecords.
+	"""
+	
+	return [record.user for record in records]
+
+def uids(records):
+	"""
+	Returns (UID, name) tuples for the given PasswdRecords.
+	"""
+	
+	return [(record.uid, record.user) for record in records]
+
+def group(name, gid, members=()):
+	"""
+	Returns a GroupRecord for the given group.
+	"""
+	
+	return usersd.records.parse_group_entry(
+		"%s:x:%d:%s" % (name, gid, ",".join(members))
+	)
+
+class AccountStoreTest(unittest.TestCase):
+	"""
+	Tests for usersd.store.AccountStore.
+	"""
+	
+	def setUp(self):
+		"""
+		Creates a store with a few accounts.
+		"""
+		
+		self.store = usersd.store.AccountStore()
+		
+		for name, uid in (("carol", 1002), ("alice", 1000), ("bob", 1001), ("root", 0)):
+			self.store.add_user(user(name, uid))
+		
+		self.store.add_group(group("alice", 1000))
+		self.store.add_group(group("bob", 1001))
+		self.store.add_group(group("carol", 1002))
+		self.store.add_group(group("sudo", 27, ("alice", "bob")))
+	
+	def test_lookups(self):
+		"""
+		Records can be found by name and by ID.
+		"""
+		
+		self.assertEqual(self.store.get_user("bob").uid, 1001)
+		self.assertEqual(self.store.get_user_by_uid(1002).user, "carol")
+		self.assertEqual(self.store.get_group_by_gid(27).group, "sudo")
+		self.assertIsNone(self.store.get_user("nobody"))
+		self.assertIsNone(self.store.get_group_by_gid(4242))
+	
+	def test_replace_user(self):
+		"""
+		Adding an existing user replaces it, updating every index.
+		"""
+		
+		self.store.add_user(user("bob", 1500))
+		
+		self.assertIsNone(self.store.get_user_by_uid(1001))
+		self.assertEqual(self.store.get_user_by_uid(1500).user, "bob")
+		self.assertNotIn(1001, self.store.used_uids)
+		self.assertEqual(list(self.store.uid_index.find(1500)), [self.store.users.find("bob")])
+		self.assertEqual(len(self.store.users), 4)
+	
+	def test_remove_user(self):
+		"""
+		Removed users disappear from every index.
+		"""
+		
+		record = self.store.remove_user("bob")
+		
+		self.assertEqual(record.user, "bob")
+		self.assertIsNone(self.store.get_user("bob"))
+		self.assertIsNone(self.store.get_user_by_uid(1001))
+		self.assertEqual(len(self.store.uid_index.find(1001)), 0)
+		self.assertNotIn(1001, self.store.used_uids)
+		self.assertIsNone(self.store.remove_user("bob"))
+	
+	def test_shared_uid_handoff(self):
+		"""
+		When several users share a UID, the first one owns it, and the
+		next one takes over once it's removed.
+		"""
+		
+		self.store.add_user(user("toor", 0))
+		self.store.add_user(user("admin", 0))
+		
+		self.assertEqual(self.store.get_user_by_uid(0).user, "root")
+		
+		self.store.remove_user("root")
+		self.assertEqual(self.store.get_user_by_uid(0).user, "toor")
+		self.assertIn(0, self.store.used_uids)
+		
+		self.store.remove_user("admin")
+		self.assertEqual(self.store.get_user_by_uid(0).user, "toor")
+		
+		self.store.remove_user("toor")
+		self.assertIsNone(self.store.get_user_by_uid(0))
+		self.assertNotIn(0, self.store.used_uids)
+		self.assertEqual(len(self.store.uid_index.find(0)), 0)
+	
+	def test_removing_secondary_owner(self):
+		"""
+		Removing a user that doesn't own its shared UID keeps the owner.
+		"""
+		
+		self.store.add_user(user("toor", 0))
+		self.store.remove_user("toor")
+		
+		self.assertEqual(self.store.get_user_by_uid(0).user, "root")
+		self.assertEqual(len(self.store.uid_index.find(0)), 1)
+	
+	def test_shared_gid_handoff(self):
+		"""
+		Shared GIDs behave like shared UIDs.
+		"""
+		
+		self.store.add_group(group("wheel", 27))
+		self.assertEqual(self.store.get_group_by_gid(27).group, "sudo")
+		
+		self.store.remove_group("sudo")
+		self.assertEqual(self.store.get_group_by_gid(27).group, "wheel")
+		self.assertIn(27, self.store.used_gids)
+	
+	def test_groups_for_user(self):
+		"""
+		The reverse index follows membership changes.
+		"""
+		
+		self.assertEqual(set(self.store.get_groups_for_user("alice")), {"sudo"})
+		self.assertEqual(tuple(self.store.get_groups_for_user("carol")), ())
+		
+		self.store.add_group(group("adm", 4, ("alice", "carol")))
+		self.assertEqual(set(self.store.get_groups_for_user("alice")), {"sudo", "adm"})
+		self.assertEqual(set(self.store.get_groups_for_user("carol")), {"adm"})
+		
+		self.store.add_group(group("sudo", 27, ("bob",)))
+		self.assertEqual(set(self.store.get_groups_for_user("alice")), {"adm"})
+		
+		self.store.remove_group("adm")
+		self.assertEqual(tuple(self.store.get_groups_for_user("alice")), ())
+		self.assertEqual(self.store.get_groups_for_user("carol"), ())
+		self.assertEqual(len(self.store.member_index.numbers), 1)
+	
+	def test_iter_users_by_name(self):
+		"""
+		Users are listed by name, resuming after a cursor.
+		"""
+		
+		self.assertEqual(
+			names(self.store.iter_users_by_name()),
+			["alice", "bob", "carol", "root"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_by_name(after="bob")),
+			["carol", "root"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_by_name(after="zzz")),
+			[]
+		)
+	
+	def test_iter_users_by_name_prefix(self):
+		"""
+		The prefix limits the listed users, even with a cursor.
+		"""
+		
+		self.store.add_user(user("carl", 1003))
+		
+		self.assertEqual(
+			names(self.store.iter_users_by_name(prefix="car")),
+			["carl", "carol"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_by_name(after="carl", prefix="car")),
+			["carol"]
+		)
+		# A cursor before the prefix range starts from the prefix
+		self.assertEqual(
+			names(self.store.iter_users_by_name(after="alice", prefix="car")),
+			["carl", "carol"]
+		)
+	
+	def test_iter_users_by_uid(self):
+		"""
+		Users are listed by UID within the given range, resuming after
+		a (UID, name) cursor.
+		"""
+		
+		self.store.add_user(user("toor", 1001))
+		
+		self.assertEqual(
+			names(self.store.iter_users_by_uid(uid_min=1000)),
+			["alice", "bob", "toor", "carol"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_by_uid(after=(1001, "bob"), uid_min=1000)),
+			["toor", "carol"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_by_uid(uid_min=1, uid_max=1001)),
+			["alice", "bob", "toor"]
+		)
+		# A cursor before uid_min is ignored
+		self.assertEqual(
+			names(self.store.iter_users_by_uid(after=(0, "root"), uid_min=1002)),
+			["carol"]
+		)
+	
+	def test_iter_users_in_group(self):
+		"""
+		Members and users with the group as primary GID are listed,
+		sorted by the cursor key.
+		"""
+		
+		self.store.add_user(user("dave", 1003, 27))
+		
+		sudo = self.store.get_group("sudo")
+		
+		self.assertEqual(
+			names(self.store.iter_users_in_group(sudo)),
+			["alice", "bob", "dave"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_in_group(sudo, after=(1001, "bob"))),
+			["dave"]
+		)
+		self.assertEqual(
+			names(self.store.iter_users_in_group(sudo, after="alice", by_name=True)),
+			["bob", "dave"]
+		)
+		
+		self.store.remove_user("dave")
+		self.assertEqual(
+			names(self.store.iter_users_in_group(sudo)),
+			["alice", "bob"]
+		)
+	
+	def test_iter_users_follow_changes(self):
+		"""
+		Replaced and removed users are listed accordingly.
+		"""
+		
+		self.store.add_user(user("bob", 1500))
+		
+		self.assertEqual(names(self.store.iter_users_by_name()).count("bob"), 1)
+		self.assertEqual(
+			uids(self.store.iter_users_by_uid()),
+			[(0, "root"), (1000, "alice"), (1002, "carol"), (1500, "bob")]
+		)
+		
+		self.store.remove_user("bob")
+		
+		self.assertNotIn("bob", names(self.store.iter_users_by_name()))
+		self.assertNotIn((1500, "bob"), uids(self.store.iter_users_by_uid()))
+	
+	def test_find_free_ids(self):
+		"""
+		The same number is used for UID and GID when possible.
+		"""
+		
+		self.assertEqual(self.store.find_free_ids(1000, 60000, 1000, 60000), (1003, 1003))
+		
+		# 1003 is a free UID, but not a free GID
+		self.store.add_group(group("staff", 1003))
+		self.assertEqual(self.store.find_free_ids(1000, 60000, 1000, 60000), (1004, 1004))
+	
+	def test_find_free_ids_different(self):
+		"""
+		Different IDs are returned if no number is free in both ranges.
+		"""
+		
+		self.assertEqual(self.store.find_free_ids(1000, 1003, 1004, 1010), (1003, 1004))
+	
+	def test_find_free_ids_exhausted(self):
+		"""
+		An exception is raised when a range is full.
+		"""
+		
+		with self.assertRaises(Exception):
+			self.store.find_free_ids(1000, 1002, 1000, 60000)
+	
+	def test_reserve_and_release_ids(self):
+		"""
+		Reserved IDs are skipped until released or actually used.
+		"""
+		
+		self.store.reserve_ids(1003, 1003)
+		self.assertEqual(self.store.find_free_ids(1000, 60000, 1000, 60000), (1004, 1004))
+		
+		self.store.release_ids(1003, 1003)
+		self.assertEqual(self.store.find_free_ids(1000, 60000, 1000, 60000), (1003, 1003))
+		
+		# Once used, an ID is no longer released
+		self.store.reserve_ids(1003, 1003)
+		self.store.add_user(user("dave", 1003))
+		self.store.release_ids(1003, 1003)
+		self.assertIn(1003, self.store.used_uids)
+		self.assertNotIn(1003, self.store.used_gids)
+	
+	def test_dump_and_restore(self):
+		"""
+		A restored store matches the dumped one, shared IDs included.
+		"""
+		
+		self.store.add_user(user("toor", 0))
+		
+		restored = usersd.store.AccountStore()
+		restored.restore(self.store.dump())
+		
+		self.assertEqual(restored.users, self.store.users)
+		self.assertEqual(restored.groups, self.store.groups)
+		self.assertEqual(restored.users_by_uid, self.store.users_by_uid)
+		self.assertEqual(restored.groups_by_gid, self.store.groups_by_gid)
+		self.assertEqual(
+			names(restored.iter_users_by_name()),
+			names(self.store.iter_users_by_name())
+		)
+		self.assertEqual(
+			uids(restored.iter_users_by_uid()),
+			uids(self.store.iter_users_by_uid())
+		)
+		self.assertEqual(
+			set(restored.get_groups_for_user("alice")),
+			set(self.store.get_groups_for_user("alice"))
+		)
+		self.assertEqual(restored.get_user_by_uid(0).user, "root")
+		
+		restored.remove_user("root")
+		self.assertEqual(restored.get_user_by_uid(0).user, "toor")
+
+if __name__ == "__main__":
+	unittest.main()
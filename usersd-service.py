@@ -24,18 +24,43 @@
 
 import os
 
+from usersd.timeline import timeline
+timeline.mark("interpreter startup")
+
+import sys
+import signal
+import time
+
+import threading
+
 import dbus
 
-from usersd.common import MainLoop, is_authorized
+from usersd.common import MainLoop, call_if_authorized, authorization_cache, Deferred
 
 import usersd.objects
 import usersd.user
 import usersd.group
+import usersd.store
+import usersd.backends
+import usersd.records
+import usersd.home
+import usersd.job
 
-import quickstart.translations
+from usersd.logindefs import login_defs
+from usersd.config import config
+from usersd.cursor import encode_cursor, decode_cursor
+from usersd.shadow import shadow_cache
+from usersd.snapshot import snapshot_cache
+from usersd.storage import storage
+
+from usersd.hashing import hashing_executor
 
 from dbus.mainloop.glib import DBusGMainLoop
 
+from gi.repository import GLib
+
+timeline.mark("imports")
+
 if os.path.islink(__file__):
 	# If we are a link, everything is a WTF...
 	USERSD_DIR = os.path.dirname(os.path.normpath(os.path.join(os.path.dirname(__file__), os.readlink(__file__))))
@@ -52,17 +77,34 @@ else:
 # for now, this chdir call will do the job.
 os.chdir(USERSD_DIR)
 
-# Parse default locale from /etc/default/locale
-try:
-	with open("/etc/default/locale", "r") as f:
-		os.environ["LANG"] = f.readline().strip().split("=")[-1]
-except:
-	pass
+# Where new home directories are created
+HOME_BASE = "/home"
+
+USER_PATH = "/org/semplicelinux/usersd/user"
+GROUP_PATH = "/org/semplicelinux/usersd/group"
+
+# Page sizes for FindUsers()
+FIND_USERS_DEFAULT_LIMIT = 100
+FIND_USERS_MAX_LIMIT = 1000
+
+# Maximum number of IDs handed out by a single AllocateIds() call
+ALLOCATE_IDS_MAX_COUNT = 10000
+
+# Seconds IDs handed out by AllocateIds() stay reserved
+ALLOCATE_IDS_RESERVATION = 5 * 60
+
+# Workers used to remove home directories
+HOME_REMOVAL_WORKERS = config.get_int("HOME_REMOVAL_WORKERS", 4)
+
+# Milliseconds between two Progress signals of a job
+JOB_PROGRESS_INTERVAL = 500
 
-TRANSLATION = quickstart.translations.Translation("usersd")
-TRANSLATION.load()
-TRANSLATION.install()
-TRANSLATION.bind_also_locale()
+# Seconds finished jobs stay on the bus
+JOB_LINGER = 60
+
+# Exported objects unused for this many seconds are removed from the bus
+OBJECT_IDLE_TIMEOUT = 60
+OBJECT_SWEEP_INTERVAL = 30
 
 class Usersd(usersd.objects.BaseObject):
 	"""
@@ -81,6 +123,26 @@ class Usersd(usersd.objects.BaseObject):
 		
 		pass
 	
+	@dbus.service.signal(
+		"org.semplicelinux.usersd",
+		signature="asas"
+	)
+	def AccountsChanged(self, users, groups):
+		"""
+		Signal emitted when users and/or groups have been added, modified
+		or removed, either by usersd or by someone else (e.g. useradd or
+		vipw).
+		
+		users and groups contain the names of the affected entries.
+		
+		This is the signal clients caching account details should
+		invalidate their caches on: PropertiesChanged is emitted only by
+		the objects currently exported, and idle objects are removed
+		from the bus after a while.
+		"""
+		
+		pass
+	
 	def __init__(self):
 		"""
 		Initializes the object.
@@ -93,62 +155,565 @@ class Usersd(usersd.objects.BaseObject):
 		
 		super().__init__(self.bus_name)
 		
-		self._users = {}
-		self._groups = {}
-		self._generate_users(refresh_groups=False)
-		self._generate_groups()
+		timeline.mark("bus name acquisition")
+		
+		# The account source, "files" by default
+		self.backend = usersd.backends.get_backend(config.get("BACKEND", "files"))
+		
+		self.store = usersd.store.AccountStore()
+		
+		# Exported User and Group objects, by name.
+		# Objects are created only when a client first uses them.
+		self.live_users = {}
+		self.live_groups = {}
+		
+		# Running and recently finished jobs, by ID
+		self.jobs = {}
+		self.next_job_id = 1
+		
+		# Cached GetUsersDetailed() and GetGroupsDetailed() replies, as
+		# (store generation, reply) tuples
+		self._detailed_replies = {}
+		
+		# The source version the store has been built from, and whether
+		# the snapshot cache needs to be written again
+		self.snapshot_key = self.backend.cache_key()
+		self.snapshot_dirty = False
+		
+		if self._load_snapshot():
+			timeline.mark("account store (cached)")
+		else:
+			self._generate_users()
+			self._generate_groups()
+			self.snapshot_dirty = True
+			
+			timeline.mark("account store")
+		
+		self.user_tree = usersd.objects.LazyObjectTree(
+			self.bus_name,
+			USER_PATH,
+			self._resolve_user_path
+		)
+		self.group_tree = usersd.objects.LazyObjectTree(
+			self.bus_name,
+			GROUP_PATH,
+			self._resolve_group_path
+		)
+		
+		GLib.timeout_add_seconds(OBJECT_SWEEP_INTERVAL, self.on_object_sweep)
+		
+		# Watch the account source for external changes
+		self.backend.watch(self.on_accounts_changed)
+		
+		timeline.mark("backend watch")
+		
+		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, self.on_sighup)
+		
+		# Don't delay the first requests
+		GLib.idle_add(self.save_snapshot)
 	
-	def _generate_users(self, refresh_groups=True):
+	def _load_snapshot(self):
 		"""
-		Generates a user object for every user in /etc/passwd.
+		Loads the account store from the snapshot cache.
+		
+		Returns True if the cache was valid, False if not.
 		"""
-				
-		with open("/etc/passwd", "r") as f:
-			for user in f:
-				name = user.split(":")[0]
-				if not name in self._users:
-					self._users[name] = usersd.user.User(
-						self,
-						self.bus_name,
-						user.strip()
-					)
-		
-		# Refresh groups if asked to
-		if refresh_groups:
-			self._generate_groups()
 		
-		# Emit signal
-		self.UserListChanged()
+		if self.snapshot_key is None:
+			return False
+		
+		data = snapshot_cache.load(self.snapshot_key)
+		if data is None:
+			return False
+		
+		store, backend, shadow = data
+		
+		self.store.restore(store)
+		self.backend.restore_state(backend)
+		shadow_cache.restore(shadow)
+		
+		return True
+	
+	def save_snapshot(self):
+		"""
+		Writes the snapshot cache, if the store changed since it has
+		been last written.
+		"""
+		
+		if self.snapshot_key is None or not self.snapshot_dirty:
+			return
+		
+		snapshot_cache.save(
+			self.snapshot_key,
+			(
+				self.store.dump(),
+				self.backend.dump_state(),
+				shadow_cache.dump()
+			)
+		)
+		
+		self.snapshot_dirty = False
+	
+	def _resolve_user_path(self, uid):
+		"""
+		Returns the User object for the given (relative) object path.
+		"""
+		
+		try:
+			record = self.store.get_user_by_uid(int(uid))
+		except ValueError:
+			return None
+		
+		if record is None:
+			return None
+		
+		return self.get_user_object(record.user)
+	
+	def _resolve_group_path(self, gid):
+		"""
+		Returns the Group object for the given (relative) object path.
+		"""
+		
+		try:
+			record = self.store.get_group_by_gid(int(gid))
+		except ValueError:
+			return None
+		
+		if record is None:
+			return None
+		
+		return self.get_group_object(record.group)
+	
+	def get_user_object(self, name):
+		"""
+		Returns the User object of the given user, exporting it if
+		needed. Returns None if the user doesn't exist.
+		"""
+		
+		obj = self.live_users.get(name)
+		if obj is None:
+			record = self.store.get_user(name)
+			if record is None:
+				return None
+			
+			obj = self.live_users[name] = usersd.user.User(
+				self,
+				self.bus_name,
+				record
+			)
+		
+		return obj
+	
+	def get_group_object(self, name):
+		"""
+		Returns the Group object of the given group, exporting it if
+		needed. Returns None if the group doesn't exist.
+		"""
+		
+		obj = self.live_groups.get(name)
+		if obj is None:
+			record = self.store.get_group(name)
+			if record is None:
+				return None
+			
+			obj = self.live_groups[name] = usersd.group.Group(
+				self,
+				self.bus_name,
+				record
+			)
+		
+		return obj
 	
-	def _generate_groups(self, refresh=False):
+	def _unexport_user(self, name):
 		"""
-		Generates a group object for every group in /etc/group.
+		Removes the User object of the given user from the bus, if any.
 		"""
 		
-		with open("/etc/group", "r") as f:
-			for group in f:
-				name = group.split(":")[0]
-				if not name in self._groups:
-					self._groups[name] = usersd.group.Group(
-						self,
-						self.bus_name,
-						group.strip()
-					)
-				elif refresh:
-					self._groups[name].refresh_members_from_group_entry(group.strip())
+		obj = self.live_users.pop(name, None)
+		if obj is not None:
+			obj.remove_from_connection()
+	
+	def _unexport_group(self, name):
+		"""
+		Removes the Group object of the given group from the bus, if any.
+		"""
+		
+		obj = self.live_groups.pop(name, None)
+		if obj is not None:
+			obj.remove_from_connection()
+	
+	def _update_user(self, record):
+		"""
+		Stores the given PasswdRecord, refreshing the exported object
+		(if any).
+		"""
+		
+		self.store.add_user(record)
+		
+		obj = self.live_users.get(record.user)
+		if obj is not None:
+			if obj.uid == record.uid:
+				obj.reload_record(record)
+			else:
+				# The object path changed
+				self._unexport_user(record.user)
+	
+	def _remove_user(self, name):
+		"""
+		Removes the given user from the store and from the bus.
+		"""
+		
+		self.store.remove_user(name)
+		self._unexport_user(name)
+	
+	def _update_group(self, record):
+		"""
+		Stores the given GroupRecord, refreshing the exported object
+		(if any).
+		"""
+		
+		self.store.add_group(record)
+		
+		obj = self.live_groups.get(record.group)
+		if obj is not None:
+			if obj.gid == record.gid:
+				obj.reload_record(record)
+			else:
+				self._unexport_group(record.group)
+	
+	def _remove_group(self, name):
+		"""
+		Removes the given group from the store and from the bus.
+		"""
+		
+		self.store.remove_group(name)
+		self._unexport_group(name)
+	
+	def on_object_sweep(self):
+		"""
+		Unexports the objects that haven't been used recently.
+		"""
+		
+		now = time.monotonic()
+		
+		for live in (self.live_users, self.live_groups):
+			for name, obj in list(live.items()):
+				if now - obj.last_access > OBJECT_IDLE_TIMEOUT:
+					del live[name]
+					obj.remove_from_connection()
+		
+		return True
+	
+	def on_accounts_changed(self, changes):
+		"""
+		Fired by the backend when accounts have been changed by someone
+		else.
+		
+		Only the affected records and objects are created, updated or
+		removed.
+		"""
+		
+		users = set()
+		groups = set()
+		
+		self.snapshot_key = self.backend.cache_key()
+		self.snapshot_dirty = True
+		
+		for name in changes.removed_users:
+			self._remove_user(name)
+		users.update(changes.removed_users)
+		
+		# Whether the user list itself changed
+		list_changed = bool(changes.removed_users) or any(
+			not name in self.store.users for name in changes.changed_users
+		)
+		
+		for record in changes.changed_users.values():
+			self._update_user(record)
+		users.update(changes.changed_users)
+		
+		users.update(
+			name for name in changes.touched_users
+			if name in self.store.users
+		)
+		
+		for name in changes.removed_groups:
+			self._remove_group(name)
+		groups.update(changes.removed_groups)
+		
+		for record in changes.changed_groups.values():
+			self._update_group(record)
+		groups.update(changes.changed_groups)
+		
+		if users or groups:
+			self.AccountsChanged(sorted(users), sorted(groups))
+		
+		if list_changed:
+			self.UserListChanged()
+	
+	def _reconcile(self, entries, table, update, remove, lookup):
+		"""
+		Brings the given store table in sync with the given backend
+		entries (see Backend.iter_user_entries()).
+		
+		The fingerprint of every entry is kept in the table (see
+		PackedTable.fingerprints), so only the entries whose fingerprint
+		changed since the last reconcile are parsed. Records changed in
+		the store in the meantime get a new row, and thus are compared
+		again. Records that actually differ from the stored ones are
+		passed to update(), and the names no longer there to remove().
+		Names the backend still knows through lookup() (accounts that
+		can't be enumerated) are kept.
+		
+		Returns a tuple (changed, removed) with the affected names.
+		"""
+		
+		seen = set()
+		changed = []
+		
+		for name, fingerprint, parse in entries:
+			seen.add(name)
+			
+			row = table.find(name)
+			if row >= 0 and table.fingerprints[row] == fingerprint:
+				continue
+			
+			try:
+				record = parse()
+				if row < 0 or table.record(row) != record:
+					update(record)
+					changed.append(name)
+			except (ValueError, TypeError):
+				# Keep the previous record until the entry is fixed
+				print("usersd: ignoring malformed entry %s" % name, file=sys.stderr)
+				continue
+			
+			row = table.find(name)
+			if row >= 0:
+				table.fingerprints[row] = fingerprint
+		
+		removed = set()
+		for name in set(table) - seen:
+			record = lookup(name)
+			if record is None:
+				remove(name)
+				removed.add(name)
+			elif table.get(name) != record:
+				update(record)
+				changed.append(name)
+		
+		return changed, removed
+	
+	def _generate_users(self):
+		"""
+		Reconciles the users of the store (and the exported objects)
+		with the backend: new users are added, changed ones updated and
+		removed ones unexported.
+		
+		Returns a tuple (changed, removed) with the affected names.
+		"""
+		
+		return self._reconcile(
+			self.backend.iter_user_entries(),
+			self.store.users,
+			self._update_user,
+			self._remove_user,
+			self.backend.lookup_user
+		)
+	
+	def _generate_groups(self):
+		"""
+		Reconciles the groups of the store with the backend, like
+		_generate_users().
+		
+		Returns a tuple (changed, removed) with the affected names.
+		"""
+		
+		return self._reconcile(
+			self.backend.iter_group_entries(),
+			self.store.groups,
+			self._update_group,
+			self._remove_group,
+			self.backend.lookup_group
+		)
+	
+	def reload(self):
+		"""
+		Reconciles the whole store with the backend, notifying clients
+		about what changed.
+		
+		This is what SIGHUP does: it picks up changes the backend could
+		not report (e.g. an NSS source between two polls).
+		"""
+		
+		users_changed, users_removed = self._generate_users()
+		groups_changed, groups_removed = self._generate_groups()
+		
+		self.snapshot_key = self.backend.cache_key()
+		
+		users = set(users_changed) | users_removed
+		groups = set(groups_changed) | groups_removed
+		
+		if users or groups:
+			self.snapshot_dirty = True
+			
+			self.AccountsChanged(sorted(users), sorted(groups))
+		
+		if users:
+			# Emit signal
+			self.UserListChanged()
+	
+	def on_sighup(self):
+		"""
+		Fired when the daemon receives SIGHUP.
+		"""
+		
+		end = MainLoop.begin()
+		try:
+			self.reload()
+		finally:
+			end()
+		
+		return True
+	
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd",
+		out_signature="a{sv}"
+	)
+	def GetStatistics(self):
+		"""
+		This method returns a dictionary containing some internal
+		counters, useful for debugging and monitoring.
+		"""
+		
+		return {
+			"AuthorizationCacheHits" : dbus.UInt64(authorization_cache.hits),
+			"AuthorizationCacheMisses" : dbus.UInt64(authorization_cache.misses),
+			"HashingQueueDepth" : dbus.UInt32(hashing_executor.pending),
+			"HashingWorkers" : dbus.UInt32(hashing_executor.workers),
+			"ActiveOperations" : dbus.UInt32(MainLoop.active),
+		}
+	
+	def create_job(self):
+		"""
+		Creates and exports a new Job.
+		"""
+		
+		job = usersd.job.Job(self.bus_name, self.next_job_id)
+		self.next_job_id += 1
+		
+		self.jobs[job.job_id] = (job, MainLoop.begin())
+		
+		return job
+	
+	def finish_job(self, job, success):
+		"""
+		Marks the given job as finished. The job is removed from the
+		bus after JOB_LINGER seconds.
+		"""
+		
+		job.finish(success)
+		
+		job, end = self.jobs[job.job_id]
+		end()
+		
+		GLib.timeout_add_seconds(JOB_LINGER, self.on_job_linger_elapsed, job)
+	
+	def on_job_linger_elapsed(self, job):
+		"""
+		Removes a finished job from the bus.
+		"""
+		
+		del self.jobs[job.job_id]
+		job.remove_from_connection()
+		
+		return False
+	
+	def remove_home(self, job, path):
+		"""
+		Removes the given home directory in a worker thread, reporting
+		the progress through the given job.
+		"""
+		
+		remover = usersd.home.HomeRemover(path, HOME_REMOVAL_WORKERS)
+		
+		def on_progress_timeout():
+			job.Progress(dbus.UInt64(remover.files), dbus.UInt64(remover.bytes))
+			return True
+		
+		progress_timeout = GLib.timeout_add(JOB_PROGRESS_INTERVAL, on_progress_timeout)
+		
+		def on_removal_done(error):
+			GLib.source_remove(progress_timeout)
+			on_progress_timeout()
+			
+			if error is not None:
+				print("usersd: unable to remove %s: %s" % (path, error), file=sys.stderr)
+			
+			self.finish_job(job, error is None)
+			
+			return False
+		
+		def run():
+			try:
+				remover.run()
+			except Exception as e:
+				GLib.idle_add(on_removal_done, e)
+			else:
+				GLib.idle_add(on_removal_done, None)
+		
+		threading.Thread(target=run, name="usersd-remove-home").start()
 	
 	def remove_from_user_list(self, user):
 		"""
 		Removes the given username from the users list.
+		
+		Only the groups the user was member of (found through the
+		reverse index) are updated, and its private group is removed.
+		
+		Returns a tuple (record, groups) with the removed PasswdRecord
+		and the old GroupRecords of the changed groups, suitable for
+		restore_user().
 		"""
 		
-		if user in self._users:
-			del self._users[user]
-
-		# Refresh groups
-		self._generate_groups(refresh=True)
+		record = self.store.get_user(user)
+		if record is None:
+			return None, []
+		
+		old_groups = []
+		
+		for name in sorted(self.store.get_groups_for_user(user)):
+			group = self.store.get_group(name)
+			old_groups.append(group)
+			self._update_group(
+				group._replace(
+					members=tuple(member for member in group.members if member != user)
+				)
+			)
+		
+		self._remove_user(user)
+		
+		# The private group is orphaned now
+		group = self.store.get_group(user)
+		if group is not None and group.gid == record.gid and not group.members:
+			old_groups.append(group)
+			self._remove_group(user)
+		
+		self.AccountsChanged([user], sorted(group.group for group in old_groups))
+		self.UserListChanged()
+		
+		return record, old_groups
+	
+	def restore_user(self, record, groups):
+		"""
+		Puts back a user removed by remove_from_user_list().
+		"""
+		
+		self._update_user(record)
+		for group in groups:
+			self._update_group(group)
 		
-		# Emit signal
+		self.AccountsChanged([record.user], sorted(group.group for group in groups))
 		self.UserListChanged()
 
 	@usersd.objects.BaseObject.outside_timeout(
@@ -165,11 +730,56 @@ class Usersd(usersd.objects.BaseObject):
 		
 		result = {}
 					
-		for group, obj in self._groups.items():
-			result[obj.gid] = (group,)
+		for group, record in self.store.groups.items():
+			result[record.gid] = (group,)
 		
 		return result
 
+	def _get_detailed_reply(self, records, key, export_properties):
+		"""
+		Returns a (cached) dictionary with the given key attribute of
+		every record as keys, and every exported property as values.
+		
+		The reply is built again only when the store changes.
+		"""
+		
+		cached = self._detailed_replies.get(key)
+		if cached is not None and cached[0] == self.store.generation:
+			return cached[1]
+		
+		reply = dbus.Dictionary(
+			{
+				getattr(record, key) : usersd.objects.marshal_properties(
+					export_properties,
+					record
+				)
+				for record in records.values()
+			},
+			signature="ia{sv}"
+		)
+		
+		self._detailed_replies[key] = (self.store.generation, reply)
+		
+		return reply
+	
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd.group",
+		out_signature="a{ia{sv}}",
+		sender_keyword="sender",
+		connection_keyword="connection"
+	)
+	def GetGroupsDetailed(self, sender, connection):
+		"""
+		This method returns a dictionary containing every group's GID as
+		keys, and a dictionary with every group property as values.
+		"""
+		
+		return self._get_detailed_reply(
+			self.store.groups,
+			"gid",
+			usersd.group.Group.export_properties
+		)
+	
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.group",
 		in_signature="s",
@@ -183,13 +793,7 @@ class Usersd(usersd.objects.BaseObject):
 		user is in.
 		"""
 		
-		result = []
-					
-		for group, obj in self._groups.items():
-			if user in obj.members:
-				result.append(group)
-		
-		return result
+		return list(self.store.get_groups_for_user(user))
 
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.group",
@@ -203,61 +807,23 @@ class Usersd(usersd.objects.BaseObject):
 		This method returns the object path for the given group.
 		"""
 		
-		if group in self._groups: return self._groups[group].path
+		record = self.store.get_group(group)
+		if record is None:
+			# The backend may know groups that can't be enumerated
+			record = self.backend.lookup_group(group)
+			if record is not None:
+				self.store.add_group(record)
 		
-		return None
-	
-	# NOTE: The following method needs to be properly security-audited
-	# before we can export it to DBus.
-	# For now is only meant to be used internally when creating an user.
-	# You can take advantage of that using the ShowUserCreationUI method.
-	#
-	#@usersd.objects.BaseObject.outside_timeout(
-	#	"org.semplicelinux.usersd.user",
-	#	in_signature="sas",
-	#	sender_keyword="sender",
-	#	connection_keyword="connection"
-	#)
-	def AddGroupsToUser(self, user, groups, sender=None, connection=None):
-		"""
-		Adds the given user to every group specified in the specfied
-		groups list.
-		"""
+		if record is not None: return "%s/%s" % (GROUP_PATH, record.gid)
 		
-		if sender and connection and not is_authorized(
-			sender,
-			connection,
-			"org.semplicelinux.usersd.add-user",
-			True # user interaction
-		):
-			raise Exception("Not authorized")
-		
-		for group in groups:
-			if not group in self._groups:
-				continue
-			
-			members = self._groups[group].members
-			if not user in members:
-				members.append(user)
-			
-				self._groups[group].Set(
-					"org.semplicelinux.usersd.group",
-					"Members",
-					members
-				)
+		return None
 	
 	def get_uids_with_users(self):
 		"""
-		A variant of the self._users dictionary, with UIDs as keys.
+		A variant of the self.store.users dictionary, with UIDs as keys.
 		"""
 		
-		result = {}
-		
-		for user, obj in self._users.items():
-			
-			result[obj.uid] = obj
-		
-		return result
+		return self.store.users_by_uid
 
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.user",
@@ -273,11 +839,121 @@ class Usersd(usersd.objects.BaseObject):
 		
 		result = {}
 					
-		for user, obj in self._users.items():
-			result[obj.uid] = (user, obj.fullname, obj.home)
+		for user, record in self.store.users.items():
+			result[record.uid] = (user, record.fullname, record.home)
 		
 		return result
 
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd.user",
+		out_signature="a{ia{sv}}",
+		sender_keyword="sender",
+		connection_keyword="connection"
+	)
+	def GetUsersDetailed(self, sender, connection):
+		"""
+		This method returns a dictionary containing every user's UID as
+		keys, and a dictionary with every user property as values.
+		"""
+		
+		return self._get_detailed_reply(
+			self.store.users,
+			"uid",
+			usersd.user.User.export_properties
+		)
+
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd.user",
+		in_signature="a{sv}su",
+		out_signature="a{ia{sv}}s",
+		sender_keyword="sender",
+		connection_keyword="connection"
+	)
+	def FindUsers(self, filters, cursor, limit, sender, connection):
+		"""
+		This method searches for users matching the given filters, and
+		returns a page of results and the cursor of the next page (an
+		empty string if there aren't more results).
+		
+		Results are dictionaries with every user's UID as keys, and a
+		dictionary with every user property as values, like
+		GetUsersDetailed().
+		
+		Supported filters:
+		  - NamePrefix (s): the username starts with the given string
+		  - UidMin, UidMax (u): the UID is in the given range
+		  - Shell (s): the user has the given shell
+		  - Group (s): the user is member of the given group
+		  - HumanOnly (b): the UID is between UID_MIN and UID_MAX, as
+		    specified in /etc/login.defs
+		
+		Results are sorted by name if NamePrefix is specified, by UID
+		otherwise. Pass an empty cursor to get the first page.
+		"""
+		
+		prefix = str(filters.get("NamePrefix", ""))
+		uid_min = int(filters.get("UidMin", 0))
+		uid_max = int(filters["UidMax"]) if "UidMax" in filters else None
+		shell = filters.get("Shell")
+		
+		if filters.get("HumanOnly", False):
+			uid_min = max(uid_min, login_defs.get_int("UID_MIN"))
+			uid_max = min(
+				uid_max if uid_max is not None else login_defs.get_int("UID_MAX"),
+				login_defs.get_int("UID_MAX")
+			)
+		
+		group = None
+		if "Group" in filters:
+			group = self.store.get_group(filters["Group"])
+			if group is None:
+				# No one can be member of a nonexistent group
+				return dbus.Dictionary(signature="ia{sv}"), ""
+		
+		if not limit:
+			limit = FIND_USERS_DEFAULT_LIMIT
+		limit = min(limit, FIND_USERS_MAX_LIMIT)
+		
+		after = decode_cursor(cursor)
+		if after is not None and not isinstance(after, str if prefix else tuple):
+			raise Exception("Invalid cursor")
+		
+		if group is not None:
+			# Only the users in the group need to be looked at
+			records = self.store.iter_users_in_group(group, after, by_name=bool(prefix))
+		elif prefix:
+			records = self.store.iter_users_by_name(after or "", prefix)
+		else:
+			records = self.store.iter_users_by_uid(after, uid_min, uid_max)
+		
+		result = dbus.Dictionary(signature="ia{sv}")
+		count = 0
+		next_cursor = ""
+		
+		for record in records:
+			if prefix and not record.user.startswith(prefix):
+				continue
+			
+			if record.uid < uid_min or (uid_max is not None and record.uid > uid_max):
+				continue
+			
+			if shell is not None and record.shell != shell:
+				continue
+			
+			result[record.uid] = usersd.objects.marshal_properties(
+				usersd.user.User.export_properties,
+				record
+			)
+			
+			count += 1
+			if count >= limit:
+				next_cursor = encode_cursor(
+					record.user if prefix else (record.uid, record.user)
+				)
+				break
+		
+		return result, next_cursor
+
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.user",
 		in_signature="s",
@@ -290,7 +966,14 @@ class Usersd(usersd.objects.BaseObject):
 		This method returns the object path for the given user.
 		"""
 		
-		if user in self._users: return self._users[user].path
+		record = self.store.get_user(user)
+		if record is None:
+			# The backend may know users that can't be enumerated
+			record = self.backend.lookup_user(user)
+			if record is not None:
+				self.store.add_user(record)
+		
+		if record is not None: return "%s/%s" % (USER_PATH, record.uid)
 		
 		return None
 
@@ -299,51 +982,246 @@ class Usersd(usersd.objects.BaseObject):
 		in_signature="ss",
 		out_signature="b",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def CreateUser(self, user, fullname, sender, connection):
+	def CreateUser(self, user, fullname, sender, connection, reply_handler, error_handler):
 		"""
-		This method returns the object path for the given user.
+		This method creates a new user.
+		
+		Returns True if the user has been created successfully. An error
+		is returned if not.
+		"""
+		
+		call_if_authorized(
+			sender,
+			"org.semplicelinux.usersd.add-user",
+			reply_handler,
+			error_handler,
+			self.create_user,
+			user,
+			fullname
+		)
+	
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd.user",
+		in_signature="ub",
+		out_signature="a(uu)",
+		sender_keyword="sender",
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
+	)
+	def AllocateIds(self, count, system, sender, connection, reply_handler, error_handler):
+		"""
+		This method returns count free (UID, GID) pairs, for bulk
+		provisioning tools. When possible, the UID and the GID are the
+		same number.
+		
+		If system is True, the IDs are taken from the SYS_UID_* and
+		SYS_GID_* ranges of /etc/login.defs.
+		
+		The returned IDs are reserved for a few minutes, so that other
+		callers (and usersd itself) don't hand them out again.
 		"""
 		
-		if not is_authorized(
+		call_if_authorized(
 			sender,
-			connection,
 			"org.semplicelinux.usersd.add-user",
-			True # user interaction
-		):
-			raise Exception("Not authorized")
+			reply_handler,
+			error_handler,
+			self.allocate_ids,
+			count,
+			system
+		)
+	
+	def allocate_ids(self, count, system=False):
+		"""
+		Returns a list of count free (UID, GID) tuples, reserving them.
+		"""
 		
-		if usersd.user.User.add(user, fullname):
-			# User created successfully, we should refresh the user list
-			self._generate_users()
+		if count > ALLOCATE_IDS_MAX_COUNT:
+			raise Exception("Can't allocate more than %d IDs at once" % ALLOCATE_IDS_MAX_COUNT)
+		
+		prefix = "SYS_" if system else ""
+		ranges = [
+			login_defs.get_int(prefix + key)
+			for key in ("UID_MIN", "UID_MAX", "GID_MIN", "GID_MAX")
+		]
+		
+		result = []
+		try:
+			for i in range(count):
+				uid, gid = self.store.find_free_ids(*ranges)
+				self.store.reserve_ids(uid, gid)
+				result.append((uid, gid))
+		except:
+			for uid, gid in result:
+				self.store.release_ids(uid, gid)
+			raise
+		
+		GLib.timeout_add_seconds(
+			ALLOCATE_IDS_RESERVATION,
+			self.on_reservation_expired,
+			result
+		)
+		
+		return dbus.Array(
+			[dbus.Struct((dbus.UInt32(uid), dbus.UInt32(gid))) for uid, gid in result],
+			signature="(uu)"
+		)
+	
+	def on_reservation_expired(self, ids):
+		"""
+		Releases the IDs reserved by allocate_ids(), if still unused.
+		"""
+		
+		for uid, gid in ids:
+			self.store.release_ids(uid, gid)
+		
+		return False
+	
+	def create_user(self, user, fullname, shell="/bin/bash", password_hash="!", groups=()):
+		"""
+		Creates a new user, with its own private group, and makes it
+		member of the given groups.
+		
+		Everything is written in a single transaction, and the new
+		records are inserted in the store right away. The home directory
+		is created once the transaction has been committed.
+		
+		NOTE: the password will *NOT* be encrypted, so you have to
+		encrypt it *BEFORE* calling this method. The default "!" locks
+		the account.
+		
+		Returns a Deferred that completes with True once the user has
+		been created.
+		"""
+		
+		if not self.backend.writable:
+			raise usersd.backends.ReadOnlyBackendError()
+		
+		usersd.user.User.validate_username(user)
+		
+		# The same checks done when changing them later
+		fullname = usersd.user.User.validate_property("fullname", fullname)[1]
+		shell = usersd.user.User.validate_property("shell", shell)[1]
+		
+		if self.store.get_user(user) is not None or self.store.get_group(user) is not None:
+			raise Exception("The user %s already exists" % user)
+		
+		for group in groups:
+			if self.store.get_group(group) is None:
+				raise Exception("The group %s doesn't exist" % group)
+		
+		uid, gid = self.store.find_free_ids(
+			login_defs.get_int("UID_MIN"),
+			login_defs.get_int("UID_MAX"),
+			login_defs.get_int("GID_MIN"),
+			login_defs.get_int("GID_MAX")
+		)
+		
+		record = usersd.records.PasswdRecord(
+			user,
+			"x",
+			uid,
+			gid,
+			fullname,
+			"",
+			"",
+			"",
+			os.path.join(HOME_BASE, user),
+			shell
+		)
+		group = usersd.records.GroupRecord(user, "x", gid, ())
+		
+		deferred = self.backend.create_user(record, group, password_hash, groups)
+		
+		# Insert the new user right away, without reparsing anything
+		old_groups = [self.store.get_group(name) for name in groups]
+		
+		self._update_user(record)
+		self._update_group(group)
+		for old_group in old_groups:
+			if not user in old_group.members:
+				self._update_group(
+					old_group._replace(members=old_group.members + (user,))
+				)
+		
+		changed_groups = sorted(set(groups) | {user})
+		
+		self.AccountsChanged([user], changed_groups)
+		self.UserListChanged()
+		
+		result = Deferred()
+		
+		def on_committed(_, error):
+			if error is not None:
+				# Roll back
+				self._remove_user(user)
+				self._remove_group(user)
+				for old_group in old_groups:
+					self._update_group(old_group)
+				self.AccountsChanged([user], changed_groups)
+				self.UserListChanged()
+				
+				result.complete(error=error)
+				return
+			
+			try:
+				usersd.home.create_home(
+					record.home,
+					uid,
+					gid,
+					login_defs.get_int("HOME_MODE")
+				)
+			except OSError as e:
+				print("usersd: unable to create %s: %s" % (record.home, e), file=sys.stderr)
+			
+			result.complete(True)
+		
+		deferred.add_callback(on_committed)
+		
+		return result
 	
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.user",
 		in_signature="sas",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def ShowUserCreationUI(self, display, groups, sender, connection):
+	def ShowUserCreationUI(self, display, groups, sender, connection, reply_handler, error_handler):
 		"""
 		This method shows the user interface that permits to create a new
 		user.
 		"""
 		
-		if not is_authorized(
+		call_if_authorized(
 			sender,
-			connection,
 			"org.semplicelinux.usersd.add-user",
-			True # user interaction
-		):
-			raise Exception("Not authorized")
-		
-		usersd.user.User.add_graphically(sender, self, display, groups)
+			reply_handler,
+			error_handler,
+			usersd.user.User.add_graphically,
+			sender,
+			self,
+			display,
+			groups
+		)
 	
 if __name__ == "__main__":
 		
 	DBusGMainLoop(set_as_default=True)
+	timeline.mark("main loop setup")
+	
 	clss = Usersd()
 	
+	timeline.report()
+	
 	# Ladies and gentlemen...
 	MainLoop.run()
+	
+	# Write the changes still queued
+	storage.commit()
+	
+	# Make the next activation faster
+	clss.save_snapshot()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import importlib
+
+import functools
+
+import zlib
+
+# Backend name -> (module, class)
+BACKENDS = {
+	"files" : ("usersd.backends.files", "FilesBackend"),
+	"nss" : ("usersd.backends.nss", "NSSBackend"),
+}
+
+def identity(value):
+	"""
+	Returns value.
+	"""
+	
+	return value
+
+def fingerprint(record):
+	"""
+	Returns a 32-bit checksum of the given record, stable across runs.
+	"""
+	
+	return zlib.crc32(repr(tuple(record)).encode())
+
+class ReadOnlyBackendError(Exception):
+	"""
+	Raised when trying to change accounts of a read-only backend.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the exception.
+		"""
+		
+		super().__init__("The account source is read-only")
+
+class AccountChanges:
+	"""
+	The changes notified by a backend to its watch() callback.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		# name -> new/modified PasswdRecord
+		self.changed_users = {}
+		
+		# names of the removed users
+		self.removed_users = set()
+		
+		# name -> new/modified GroupRecord
+		self.changed_groups = {}
+		
+		# names of the removed groups
+		self.removed_groups = set()
+		
+		# names of the users whose other details (e.g. the password)
+		# changed
+		self.touched_users = set()
+	
+	def __bool__(self):
+		"""
+		Returns True if something changed.
+		"""
+		
+		return bool(
+			self.changed_users or
+			self.removed_users or
+			self.changed_groups or
+			self.removed_groups or
+			self.touched_users
+		)
+
+class Backend:
+	"""
+	The base class of every account source.
+	
+	A backend provides the user and group records to the account store,
+	notifies external changes and, if writable, stores changes back.
+	"""
+	
+	# Backends that can't store changes should leave this to False
+	writable = False
+	
+	def iter_users(self):
+		"""
+		Yields a PasswdRecord for every user.
+		"""
+		
+		raise NotImplementedError
+	
+	def iter_groups(self):
+		"""
+		Yields a GroupRecord for every group.
+		"""
+		
+		raise NotImplementedError
+	
+	def iter_user_entries(self):
+		"""
+		Yields a (name, fingerprint, parse) tuple for every user, where
+		fingerprint (a 32-bit number) changes every time the user's
+		entry changes and parse() returns its PasswdRecord.
+		
+		Backends that can cheaply fingerprint their raw entries should
+		override this, so that unchanged entries are never parsed.
+		"""
+		
+		for record in self.iter_users():
+			yield record.user, fingerprint(record), functools.partial(identity, record)
+	
+	def iter_group_entries(self):
+		"""
+		Like iter_user_entries(), but for groups.
+		"""
+		
+		for record in self.iter_groups():
+			yield record.group, fingerprint(record), functools.partial(identity, record)
+	
+	def lookup_user(self, name):
+		"""
+		Returns the PasswdRecord of the given user, if it's known by
+		the source but can't be enumerated. Returns None otherwise.
+		
+		Every enumerable user is already in the store, so by default
+		there is nothing to look up.
+		"""
+		
+		return None
+	
+	def lookup_group(self, name):
+		"""
+		Like lookup_user(), but for groups.
+		"""
+		
+		return None
+	
+	def watch(self, callback):
+		"""
+		Starts watching the source for changes. callback will be called
+		with an AccountChanges object every time something changes.
+		"""
+		
+		pass
+	
+	def cache_key(self):
+		"""
+		Returns a value that changes every time the source changes, used
+		to validate the snapshot cache (see usersd.snapshot).
+		
+		Backends that return None are never cached.
+		"""
+		
+		return None
+	
+	def dump_state(self):
+		"""
+		Returns the internal state of the backend that should be stored
+		in the snapshot cache (see SnapshotCache.save()).
+		"""
+		
+		return None
+	
+	def restore_state(self, state):
+		"""
+		Restores a state returned by dump_state(). Called before
+		watch().
+		"""
+		
+		pass
+	
+	def create_user(self, record, group, password_hash, groups):
+		"""
+		Adds the given PasswdRecord, with its private GroupRecord and
+		password hash, and makes it member of the given groups.
+		"""
+		
+		raise ReadOnlyBackendError()
+	
+	def write_user(self, record):
+		"""
+		Stores the given (modified) PasswdRecord.
+		
+		Write methods return a Deferred (see usersd.common) that
+		completes once the change is on disk.
+		"""
+		
+		raise ReadOnlyBackendError()
+	
+	def write_password(self, user, password_hash):
+		"""
+		Stores the given password hash for the given user.
+		"""
+		
+		raise ReadOnlyBackendError()
+	
+	def write_group_members(self, members):
+		"""
+		Stores the given group memberships.
+		
+		members is a dictionary with the group names as keys and the
+		new members lists as values.
+		"""
+		
+		raise ReadOnlyBackendError()
+
+def get_backend(name):
+	"""
+	Returns an instance of the backend with the given name.
+	"""
+	
+	if not name in BACKENDS:
+		raise Exception("Unknown backend %s" % name)
+	
+	module, clss = BACKENDS[name]
+	
+	return getattr(importlib.import_module(module), clss)()
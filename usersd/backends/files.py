@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+import sys
+
+import time
+
+import zlib
+
+import functools
+
+import usersd.fileio
+import usersd.records
+import usersd.watch
+
+from usersd.snapshot import file_stamp
+
+from usersd.backends import Backend, AccountChanges
+from usersd.storage import storage
+from usersd.logindefs import login_defs
+
+PASSWD = "/etc/passwd"
+GROUP = "/etc/group"
+SHADOW = "/etc/shadow"
+GSHADOW = "/etc/gshadow"
+
+class FilesBackend(Backend):
+	"""
+	The classic flat-file account source (/etc/passwd, /etc/group and
+	their shadow counterparts).
+	"""
+	
+	writable = True
+	
+	def __init__(self):
+		"""
+		Initializes the backend.
+		"""
+		
+		self.watcher = None
+		
+		# Cached FileSnapshot states, by path
+		self.restored_state = {}
+	
+	def iter_users(self):
+		"""
+		Yields a PasswdRecord for every user in /etc/passwd.
+		"""
+		
+		with open(PASSWD, "r") as f:
+			yield from usersd.records.iter_passwd_records(f)
+	
+	def iter_groups(self):
+		"""
+		Yields a GroupRecord for every group in /etc/group.
+		"""
+		
+		with open(GROUP, "r") as f:
+			yield from usersd.records.iter_group_records(f)
+	
+	@staticmethod
+	def _iter_entries(path, parse):
+		"""
+		Yields a (name, fingerprint, parse) tuple for every entry of the
+		given file, fingerprinting the raw line.
+		"""
+		
+		with open(path, "r") as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					yield (
+						line.split(":", 1)[0],
+						zlib.crc32(line.encode()),
+						functools.partial(parse, line)
+					)
+	
+	def iter_user_entries(self):
+		"""
+		Yields a (name, fingerprint, parse) tuple for every line of
+		/etc/passwd.
+		"""
+		
+		return self._iter_entries(PASSWD, usersd.records.parse_passwd_entry)
+	
+	def iter_group_entries(self):
+		"""
+		Yields a (name, fingerprint, parse) tuple for every line of
+		/etc/group.
+		"""
+		
+		return self._iter_entries(GROUP, usersd.records.parse_group_entry)
+	
+	def watch(self, callback):
+		"""
+		Watches the account files through inotify.
+		"""
+		
+		self.watcher = usersd.watch.FileWatcher(
+			lambda changes: self.on_files_changed(changes, callback)
+		)
+		for path in (PASSWD, GROUP, SHADOW):
+			self.watcher.add(path, self.restored_state.get(path))
+		
+		self.restored_state = {}
+	
+	def cache_key(self):
+		"""
+		Returns the (inode, mtime, size) tuples of the account files.
+		"""
+		
+		return tuple(file_stamp(path) for path in (PASSWD, GROUP, SHADOW))
+	
+	def dump_state(self):
+		"""
+		Returns the line hashes of the watched files.
+		"""
+		
+		if self.watcher is None:
+			return None
+		
+		return {
+			snapshot.path : snapshot.dump()
+			for snapshots in self.watcher.snapshots.values()
+			for snapshot in snapshots.values()
+		}
+	
+	def restore_state(self, state):
+		"""
+		Restores the line hashes of the watched files, so that they
+		don't need to be read again.
+		"""
+		
+		if state is not None:
+			self.restored_state = state
+	
+	@staticmethod
+	def _parse_lines(lines, parse):
+		"""
+		Parses the given dictionary of lines (keyed by entry name),
+		returning a dictionary with the records.
+		
+		Malformed lines (e.g. while someone is still editing the file)
+		are logged and skipped: the entry keeps its previous record
+		until the line is fixed.
+		"""
+		
+		records = {}
+		for name, line in lines.items():
+			try:
+				records[name] = parse(line)
+			except (ValueError, TypeError):
+				print("usersd: ignoring malformed entry %s" % name, file=sys.stderr)
+		
+		return records
+	
+	def on_files_changed(self, changes, callback):
+		"""
+		Fired by the FileWatcher when the account files have been
+		changed.
+		"""
+		
+		result = AccountChanges()
+		
+		if PASSWD in changes:
+			changed, result.removed_users = changes[PASSWD]
+			result.changed_users = self._parse_lines(
+				changed,
+				usersd.records.parse_passwd_entry
+			)
+		
+		if SHADOW in changes:
+			changed, removed = changes[SHADOW]
+			result.touched_users = set(changed) | removed
+		
+		if GROUP in changes:
+			changed, result.removed_groups = changes[GROUP]
+			result.changed_groups = self._parse_lines(
+				changed,
+				usersd.records.parse_group_entry
+			)
+		
+		if result:
+			callback(result)
+	
+	def create_user(self, record, group, password_hash, groups):
+		"""
+		Stages the entries of a new user in every account file.
+		Everything is written in the same transaction.
+		"""
+		
+		shadow = ":".join((
+			record.user,
+			password_hash,
+			str(int(time.time() // 86400)),
+			str(login_defs.get_int("PASS_MIN_DAYS")),
+			str(login_defs.get_int("PASS_MAX_DAYS")),
+			str(login_defs.get_int("PASS_WARN_AGE")),
+			"",
+			"",
+			""
+		))
+		
+		group_entries = {
+			name : functools.partial(usersd.fileio.add_member, member=record.user)
+			for name in groups
+		}
+		gshadow_entries = dict(group_entries)
+		
+		group_entries[group.group] = usersd.fileio.NewEntry(
+			usersd.records.format_group_record(group)
+		)
+		gshadow_entries[group.group] = usersd.fileio.NewEntry(
+			"%s:!::%s" % (group.group, ",".join(group.members))
+		)
+		
+		changes = {
+			PASSWD : {
+				record.user : usersd.fileio.NewEntry(
+					usersd.records.format_passwd_record(record)
+				)
+			},
+			SHADOW : {record.user : usersd.fileio.NewEntry(shadow)},
+			GROUP : group_entries,
+		}
+		if os.path.exists(GSHADOW):
+			changes[GSHADOW] = gshadow_entries
+		
+		return storage.stage(changes)
+	
+	def write_user(self, record):
+		"""
+		Stages the given PasswdRecord for /etc/passwd.
+		
+		Returns a Deferred that completes once the change has been
+		committed.
+		"""
+		
+		return storage.stage({
+			PASSWD : {record.user : usersd.records.format_passwd_record(record)}
+		})
+	
+	def write_password(self, user, password_hash):
+		"""
+		Stages the given password hash for /etc/shadow.
+		"""
+		
+		return storage.stage({
+			SHADOW : {
+				user : functools.partial(
+					usersd.fileio.replace_field,
+					index=1,
+					value=password_hash
+				)
+			}
+		})
+	
+	def write_group_members(self, members):
+		"""
+		Stages the given group memberships for /etc/group and
+		/etc/gshadow.
+		"""
+		
+		entries = {}
+		for group, lst in members.items():
+			entries[group] = functools.partial(
+				usersd.fileio.replace_field,
+				index=3,
+				value=",".join(user for user in lst if user)
+			)
+		
+		changes = {GROUP : entries}
+		if os.path.exists(GSHADOW):
+			changes[GSHADOW] = entries
+		
+		return storage.stage(changes)
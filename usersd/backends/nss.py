@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import pwd
+import grp
+
+import usersd.records
+
+from usersd.backends import Backend, AccountChanges
+from usersd.config import config
+
+from gi.repository import GLib
+
+# Seconds between two enumerations of the NSS databases
+REFRESH_INTERVAL = config.get_int("NSS_REFRESH_INTERVAL", 60)
+
+class NSSBackend(Backend):
+	"""
+	A read-only account source that uses the system's Name Service
+	Switch, thus including accounts provided by e.g. sssd or LDAP.
+	
+	As NSS doesn't notify changes, the databases are enumerated
+	again every REFRESH_INTERVAL seconds and compared with the cached
+	snapshot.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the backend.
+		"""
+		
+		# name -> record
+		self.users = {}
+		self.groups = {}
+		
+		self.refresh()
+	
+	@staticmethod
+	def _user_record(entry):
+		"""
+		Returns a PasswdRecord from the given pwd.struct_passwd.
+		"""
+		
+		return usersd.records.make_passwd_record(
+			entry.pw_name,
+			entry.pw_passwd,
+			entry.pw_uid,
+			entry.pw_gid,
+			entry.pw_gecos,
+			entry.pw_dir,
+			entry.pw_shell
+		)
+	
+	@staticmethod
+	def _group_record(entry):
+		"""
+		Returns a GroupRecord from the given grp.struct_group.
+		"""
+		
+		return usersd.records.GroupRecord(
+			entry.gr_name,
+			entry.gr_passwd,
+			entry.gr_gid,
+			usersd.records.make_members(entry.gr_mem)
+		)
+	
+	def refresh(self):
+		"""
+		Enumerates the NSS databases again.
+		
+		Returns an AccountChanges object describing the differences
+		with the previous snapshot.
+		"""
+		
+		changes = AccountChanges()
+		
+		users = {}
+		for entry in pwd.getpwall():
+			# Like getpwnam(), the first entry wins
+			if not entry.pw_name in users:
+				users[entry.pw_name] = self._user_record(entry)
+		
+		groups = {}
+		for entry in grp.getgrall():
+			if not entry.gr_name in groups:
+				groups[entry.gr_name] = self._group_record(entry)
+		
+		changes.changed_users = {
+			name : record
+			for name, record in users.items()
+			if self.users.get(name) != record
+		}
+		changes.removed_users = set(self.users) - set(users)
+		
+		changes.changed_groups = {
+			name : record
+			for name, record in groups.items()
+			if self.groups.get(name) != record
+		}
+		changes.removed_groups = set(self.groups) - set(groups)
+		
+		self.users = users
+		self.groups = groups
+		
+		return changes
+	
+	def iter_users(self):
+		"""
+		Yields a PasswdRecord for every user in the snapshot.
+		"""
+		
+		return iter(list(self.users.values()))
+	
+	def iter_groups(self):
+		"""
+		Yields a GroupRecord for every group in the snapshot.
+		"""
+		
+		return iter(list(self.groups.values()))
+	
+	def lookup_user(self, name):
+		"""
+		Returns the PasswdRecord of the given user, or None.
+		
+		Users not yet in the snapshot (or not enumerable at all) are
+		looked up directly.
+		"""
+		
+		record = self.users.get(name)
+		if record is None:
+			try:
+				record = self._user_record(pwd.getpwnam(name))
+			except KeyError:
+				pass
+		
+		return record
+	
+	def lookup_group(self, name):
+		"""
+		Returns the GroupRecord of the given group, or None.
+		"""
+		
+		record = self.groups.get(name)
+		if record is None:
+			try:
+				record = self._group_record(grp.getgrnam(name))
+			except KeyError:
+				pass
+		
+		return record
+	
+	def watch(self, callback):
+		"""
+		Polls the NSS databases every REFRESH_INTERVAL seconds.
+		"""
+		
+		GLib.timeout_add_seconds(
+			REFRESH_INTERVAL,
+			self.on_refresh_timeout_elapsed,
+			callback
+		)
+	
+	def on_refresh_timeout_elapsed(self, callback):
+		"""
+		Fired when it's time to enumerate the databases again.
+		"""
+		
+		changes = self.refresh()
+		if changes:
+			callback(changes)
+		
+		return True
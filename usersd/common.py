@@ -23,13 +23,20 @@
 
 import os
 
+import time
+
+import builtins
+
 import dbus
 
+from collections import namedtuple
+
 import importlib
 
-from gi.repository import GLib, Polkit
+from gi.repository import GLib
 
-authority = Polkit.Authority.get_sync()
+# Seconds a positive authorization result is cached
+AUTHORIZATION_CACHE_TTL = 10
 
 class ModuleProxy:
 	"""
@@ -49,12 +56,15 @@ class ModuleProxy:
 		os.environ["XAUTHORITY"] = os.path.join(dct[user].home, ".Xauthority")
 		os.environ["DISPLAY"] = display
 	
-	def __init__(self, module):
+	def __init__(self, module, setup=None):
 		"""
 		Initializes the class.
+		
+		If specified, setup is called right before loading the module.
 		"""
 		
 		self.module = module
+		self.setup = setup
 	
 	def __getattr__(self, attr):
 		"""
@@ -62,14 +72,89 @@ class ModuleProxy:
 		"""
 		
 		if not self._real:
+			if self.setup:
+				self.setup()
+			
 			self._real = importlib.import_module(self.module)
 		
 		return getattr(self._real, attr)
 
+Polkit = ModuleProxy("gi.repository.Polkit")
+
+# The Polkit authority, see get_authority()
+_authority = None
+
+# The quickstart Translation, see setup_translations()
+_translation = None
+
+def get_authority():
+	"""
+	Returns the Polkit authority, connecting to it on first use.
+	"""
+	
+	global _authority
+	
+	if _authority is None:
+		_authority = Polkit.Authority.get_sync()
+	
+	return _authority
+
+def setup_translations():
+	"""
+	Loads and installs the translations, if not already done.
+	
+	This is deferred until something actually needs translated strings
+	(i.e. the user interface), as none of the DBus methods do.
+	"""
+	
+	global _translation
+	
+	if _translation is not None:
+		return
+	
+	# Parse default locale from /etc/default/locale
+	try:
+		with open("/etc/default/locale", "r") as f:
+			os.environ["LANG"] = f.readline().strip().split("=")[-1]
+	except:
+		pass
+	
+	import quickstart.translations
+	
+	_translation = quickstart.translations.Translation("usersd")
+	_translation.load()
+	_translation.install()
+	_translation.bind_also_locale()
+
+def lazy_gettext(message):
+	"""
+	A placeholder for the _() builtin, that sets up the translations on
+	first use.
+	"""
+	
+	setup_translations()
+	
+	if builtins._ is lazy_gettext:
+		# Translations couldn't be installed
+		return message
+	
+	return builtins._(message)
+
+builtins._ = lazy_gettext
+
 class LoopWithTimeout():
 	"""
 	A LoopWithTimeout is a GLibMainLoop that supports timeouts.
 	
+	The loop quits once nothing happened for timeout_length seconds.
+	Operations (method calls, including the ones that reply later,
+	worker jobs, dialogs...) are tracked through begin(): the loop
+	never quits while one of them is in flight.
+	
+	Activity only updates a counter and a timestamp; a single timer
+	checks them lazily when it fires, and rearms itself for the
+	remaining time.
+	
 	We don't directly subclass GLib.MainLoop because we can't.
 	"""
 	
@@ -82,89 +167,470 @@ class LoopWithTimeout():
 		
 		self.timeout_length = timeout_length
 		
-		self.add_timeout()
-
+		# Operations in flight, and the last time one started or ended
+		self.active = 0
+		self.last_activity = time.monotonic()
+		
+		self.timeout = GLib.timeout_add_seconds(self.timeout_length, self.on_timeout_elapsed)
+	
 	def on_timeout_elapsed(self):
 		"""
 		Fired when the timeout elapsed.
 		"""
 		
-		self.quit()
+		if self.active:
+			remaining = self.timeout_length
+		else:
+			remaining = self.last_activity + self.timeout_length - time.monotonic()
+		
+		if remaining > 0:
+			# Something happened in the meantime, check again later
+			self.timeout = GLib.timeout_add_seconds(
+				max(int(remaining + 0.5), 1),
+				self.on_timeout_elapsed
+			)
+		else:
+			self.timeout = 0
+			self.quit()
 		
 		return False
 	
-	def remove_timeout(self):
+	def begin(self):
 		"""
-		Removes the timeout.
+		Marks the start of an operation.
+		
+		Returns a function that marks its end. Only the first call of
+		the returned function counts, and its arguments are ignored, so
+		that it can be used directly as a callback.
 		"""
+		
+		self.active += 1
+		self.last_activity = time.monotonic()
+		
+		finished = False
+		
+		def end(*args):
+			nonlocal finished
+			if finished:
+				return
+			
+			finished = True
+			self.active -= 1
+			self.last_activity = time.monotonic()
+		
+		return end
+	
+	def __getattr__(self, name):
+		"""
+		Proxy to the self.loop object.
+		"""
+		
+		return getattr(self.loop, name)
 
-		if self.timeout > 0:
-			# Timeout already present, cancel it
-			GLib.source_remove(self.timeout)
-			self.timeout = 0
+# The credentials of a bus client
+Credentials = namedtuple("Credentials", ("uid", "pid", "start_time"))
+
+class VanishedNameWatcher:
+	"""
+	Notifies the connected callbacks when a name disappears from the
+	system bus.
+	
+	The NameOwnerChanged subscription is made only when someone needs it,
+	as the bus connection might not be ready when this module is imported.
+	"""
 	
-	def add_timeout(self):
+	def __init__(self):
 		"""
-		Timeout.
+		Initializes the watcher.
 		"""
 		
-		self.timeout = GLib.timeout_add_seconds(self.timeout_length, self.on_timeout_elapsed)
+		self.callbacks = []
+		self.watching = False
 	
-	def __getattr__(self, name):
+	def connect(self, callback):
 		"""
-		Proxy to the self.loop object.
+		Registers a callback, that will be called with the name that
+		went away.
 		"""
 		
-		return getattr(self.loop, name)
+		self.callbacks.append(callback)
+	
+	def watch(self):
+		"""
+		Starts listening to NameOwnerChanged, if not already done.
+		"""
+		
+		if self.watching:
+			return
+		
+		dbus.SystemBus().add_signal_receiver(
+			self.on_name_owner_changed,
+			signal_name="NameOwnerChanged",
+			dbus_interface="org.freedesktop.DBus",
+			bus_name="org.freedesktop.DBus",
+			path="/org/freedesktop/DBus",
+			arg2="" # Only names that went away
+		)
+		self.watching = True
+	
+	def on_name_owner_changed(self, name, old_owner, new_owner):
+		"""
+		Fired when a name changes owner.
+		"""
+		
+		if not new_owner:
+			for callback in self.callbacks:
+				callback(name)
+
+class CredentialsResolver:
+	"""
+	Resolves and caches the credentials of bus clients.
+	
+	UID and PID are fetched with a single GetConnectionCredentials call
+	through a shared proxy. Results are cached until the sender's name
+	disappears from the bus.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the resolver.
+		"""
+		
+		self._proxy = None
+		
+		# sender -> Credentials
+		self.cache = {}
+		
+		name_watcher.connect(self.forget)
+	
+	@property
+	def proxy(self):
+		"""
+		The org.freedesktop.DBus proxy.
+		"""
+		
+		if self._proxy is None:
+			self._proxy = dbus.Interface(
+				dbus.SystemBus().get_object(
+					"org.freedesktop.DBus",
+					"/org/freedesktop/DBus"
+				),
+				"org.freedesktop.DBus"
+			)
+		
+		return self._proxy
+	
+	def forget(self, sender):
+		"""
+		Drops the cached credentials of the given sender.
+		"""
+		
+		self.cache.pop(sender, None)
+	
+	def get(self, sender):
+		"""
+		Returns the Credentials of the given sender.
+		"""
+		
+		credentials = self.cache.get(sender)
+		if credentials is None:
+			name_watcher.watch()
+			
+			result = self.proxy.GetConnectionCredentials(sender)
+			pid = int(result["ProcessID"])
+			
+			credentials = self.cache[sender] = Credentials(
+				int(result["UnixUserID"]),
+				pid,
+				get_process_start_time(pid)
+			)
+		
+		return credentials
+
+class AuthorizationCache:
+	"""
+	A cache of positive Polkit authorization results, granted without
+	user interaction.
+	
+	Results are keyed by (sender unique name, process start time, action)
+	and expire after a short time. Every result of a sender is dropped
+	as soon as its name disappears from the bus, so that a reused name
+	can never inherit a decision.
+	"""
+	
+	def __init__(self, ttl):
+		"""
+		Initializes the cache.
+		"""
+		
+		self.ttl = ttl
+		
+		# key -> expiration time
+		self.entries = {}
+		
+		# sender -> set of keys
+		self.by_sender = {}
+		
+		self.hits = 0
+		self.misses = 0
+		
+		name_watcher.connect(self.forget)
+	
+	def forget(self, sender):
+		"""
+		Drops every result of the given sender.
+		"""
+		
+		for key in self.by_sender.pop(sender, ()):
+			self.entries.pop(key, None)
+	
+	def lookup(self, key):
+		"""
+		Returns True if there is a valid positive result for the given key.
+		"""
+		
+		expiration = self.entries.get(key)
+		if expiration is not None:
+			if expiration > time.monotonic():
+				self.hits += 1
+				return True
+			
+			# Expired
+			del self.entries[key]
+			self.by_sender[key[0]].discard(key)
+		
+		self.misses += 1
+		return False
+	
+	def store(self, key):
+		"""
+		Stores a positive result for the given key.
+		"""
+		
+		name_watcher.watch()
+		
+		self.entries[key] = time.monotonic() + self.ttl
+		self.by_sender.setdefault(key[0], set()).add(key)
+
+def get_process_start_time(pid):
+	"""
+	Returns the start time of the given process, as found in
+	/proc/PID/stat. Returns 0 if it can't be determined.
+	"""
+	
+	try:
+		with open("/proc/%d/stat" % pid, "r") as f:
+			stat = f.read()
+	except OSError:
+		return 0
+	
+	# The second field (the command name) may contain spaces, so
+	# start after its closing parenthesis. The start time is the 22nd
+	# field.
+	return int(stat[stat.rindex(")") + 2:].split(" ")[19])
 
 def get_user(sender):
 	"""
-	Returns the user name of the given sender.
+	Returns the UID of the given sender.
 	"""
 	
-	return dbus.Interface(
-		dbus.SystemBus().get_object(
-			"org.freedesktop.DBus",
-			"/org/freedesktop/DBus"
-		),
-		"org.freedesktop.DBus"
-	).GetConnectionUnixUser(sender)
+	return credentials_resolver.get(sender).uid
 
 def is_authorized(sender, connection, privilege, user_interaction=True):
 	"""
 	Checks if the sender has the given privilege.
 	
 	Returns True if yes, False if not.
+	
+	The check is first done without user interaction: only results
+	granted that way are cached, so that an action that requires
+	authenticating every time (e.g. auth_admin) is never granted by the
+	cache. If a challenge is needed, and user interaction is allowed,
+	the check is done again letting Polkit ask.
 	"""
 	
-	if not user_interaction:
-		flags = Polkit.CheckAuthorizationFlags.NONE
-	else:
-		flags = Polkit.CheckAuthorizationFlags.ALLOW_USER_INTERACTION
+	credentials = credentials_resolver.get(sender)
+	
+	key = (sender, credentials.start_time, privilege)
+	if authorization_cache.lookup(key):
+		return True
+	
+	subject = Polkit.UnixProcess.new_full(credentials.pid, credentials.start_time)
 	
-	# Get PID
-	pid = dbus.Interface(
-		dbus.SystemBus().get_object(
-			"org.freedesktop.DBus",
-			"/org/freedesktop/DBus"
-		),
-		"org.freedesktop.DBus"
-	).GetConnectionUnixProcessID(sender)
-		
 	try:
-		result = authority.check_authorization_sync(
-			Polkit.UnixProcess.new(pid),
+		result = get_authority().check_authorization_sync(
+			subject,
 			privilege,
 			None,
-			flags,
+			Polkit.CheckAuthorizationFlags.NONE,
 			None
 		)
+		
+		if result.get_is_authorized():
+			authorization_cache.store(key)
+			return True
+		elif not user_interaction or not result.get_is_challenge():
+			return False
+		
+		return get_authority().check_authorization_sync(
+			subject,
+			privilege,
+			None,
+			Polkit.CheckAuthorizationFlags.ALLOW_USER_INTERACTION,
+			None
+		).get_is_authorized()
 	except:
 		return False
+
+def is_authorized_async(sender, privilege, callback, user_interaction=True):
+	"""
+	Asynchronously checks if the sender has the given privilege.
+	
+	callback is called with True if yes, False if not. The main loop
+	keeps running while Polkit waits for the user to authenticate.
+	Like is_authorized(), only results granted without a challenge
+	are cached.
+	"""
+	
+	credentials = credentials_resolver.get(sender)
+	
+	key = (sender, credentials.start_time, privilege)
+	if authorization_cache.lookup(key):
+		callback(True)
+		return
+	
+	subject = Polkit.UnixProcess.new_full(credentials.pid, credentials.start_time)
+	
+	def on_challenge_checked(authority, res, data):
+		try:
+			authorized = authority.check_authorization_finish(res).get_is_authorized()
+		except:
+			authorized = False
+		
+		callback(authorized)
+	
+	def on_authorization_checked(authority, res, data):
+		try:
+			result = authority.check_authorization_finish(res)
+		except:
+			callback(False)
+			return
+		
+		if result.get_is_authorized():
+			authorization_cache.store(key)
+			callback(True)
+		elif user_interaction and result.get_is_challenge():
+			authority.check_authorization(
+				subject,
+				privilege,
+				None,
+				Polkit.CheckAuthorizationFlags.ALLOW_USER_INTERACTION,
+				None,
+				on_challenge_checked,
+				None
+			)
+		else:
+			callback(False)
+	
+	get_authority().check_authorization(
+		subject,
+		privilege,
+		None,
+		Polkit.CheckAuthorizationFlags.NONE,
+		None,
+		on_authorization_checked,
+		None
+	)
+
+class Deferred:
+	"""
+	The result of an operation that completes later (e.g. a write
+	queued in usersd.storage).
+	
+	Callbacks are called with the (result, error) tuple, one of them
+	being None, like the ones of HashingExecutor.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the object.
+		"""
+		
+		self.done = False
+		self.result = None
+		self.error = None
+		
+		self.callbacks = []
+	
+	def add_callback(self, callback):
+		"""
+		Calls callback once the operation completed (or right away, if
+		it already did).
+		"""
+		
+		if self.done:
+			callback(self.result, self.error)
+		else:
+			self.callbacks.append(callback)
+		
+		return self
+	
+	def complete(self, result=None, error=None):
+		"""
+		Completes the operation, firing the callbacks.
+		"""
+		
+		self.done = True
+		self.result = result
+		self.error = error
+		
+		callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			callback(result, error)
+
+def call_if_authorized(sender, privilege, reply_handler, error_handler, func, *args):
+	"""
+	Calls func(*args) if the sender has the given privilege, then
+	completes the deferred DBus reply with its return value.
+	
+	If func returns a Deferred, the reply is sent once it completes.
+	If privilege is None, func is called right away.
+	"""
+	
+	def on_result(result, error):
+		if error is not None:
+			error_handler(error)
+		elif result is None:
+			reply_handler()
+		else:
+			reply_handler(result)
 	
-	return result.get_is_authorized()
+	def on_authorization(authorized):
+		if not authorized:
+			error_handler(Exception("Not authorized"))
+			return
+		
+		try:
+			result = func(*args)
+		except Exception as e:
+			error_handler(e)
+			return
+		
+		if isinstance(result, Deferred):
+			result.add_callback(on_result)
+		else:
+			on_result(result, None)
+	
+	if privilege is None:
+		on_authorization(True)
+	else:
+		is_authorized_async(sender, privilege, on_authorization)
 
 MainLoop = LoopWithTimeout(5 * 60)
 
-usersd_ui = ModuleProxy("usersd.ui")
+name_watcher = VanishedNameWatcher()
+credentials_resolver = CredentialsResolver()
+authorization_cache = AuthorizationCache(AUTHORIZATION_CACHE_TTL)
+
+usersd_ui = ModuleProxy("usersd.ui", setup=setup_translations)
 Gtk = ModuleProxy("gi.repository.Gtk")
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+# The daemon configuration, in the same KEY=VALUE format of the other
+# files in /etc/default
+CONFIG_FILE = "/etc/default/usersd"
+
+class Config:
+	"""
+	The usersd configuration.
+	"""
+	
+	def __init__(self, path):
+		"""
+		Initializes the class, reading the given file (if it exists).
+		"""
+		
+		self.values = {}
+		
+		try:
+			with open(path, "r") as f:
+				for line in f:
+					line = line.strip()
+					if not line or line.startswith("#") or not "=" in line:
+						continue
+					
+					key, value = line.split("=", 1)
+					self.values[key.strip()] = value.strip().strip("\"'")
+		except OSError:
+			pass
+	
+	def get(self, key, default=None):
+		"""
+		Returns the value of the given key, or default.
+		"""
+		
+		return self.values.get(key, default)
+	
+	def get_int(self, key, default):
+		"""
+		Like get(), but converts the value to an integer.
+		"""
+		
+		try:
+			return int(self.values[key])
+		except (KeyError, ValueError):
+			return default
+
+config = Config(CONFIG_FILE)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import base64
+
+def encode_cursor(key):
+	"""
+	Returns an opaque FindUsers() cursor from the given position, which
+	is either an username or an (UID, username) tuple.
+	"""
+	
+	if isinstance(key, tuple):
+		key = "u:%d:%s" % key
+	else:
+		key = "n:%s" % key
+	
+	return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_cursor(cursor):
+	"""
+	The opposite of encode_cursor(). Returns None for an empty cursor.
+	"""
+	
+	if not cursor:
+		return None
+	
+	try:
+		key = base64.urlsafe_b64decode(cursor.encode()).decode()
+		if key.startswith("n:"):
+			return key[2:]
+		elif key.startswith("u:"):
+			uid, name = key[2:].split(":", 1)
+			return (int(uid), name)
+	except ValueError:
+		pass
+	
+	raise Exception("Invalid cursor")
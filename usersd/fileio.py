@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+import sys
+
+import ctypes
+import ctypes.util
+
+import contextlib
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+@contextlib.contextmanager
+def passwd_lock():
+	"""
+	Context manager that holds the lock on the account files.
+	
+	This is the same lock (lckpwdf(3)) taken by the shadow tools, so
+	that we never race with useradd, vipw and friends.
+	"""
+	
+	if libc.lckpwdf() != 0:
+		raise OSError(ctypes.get_errno(), "Unable to lock the account files")
+	
+	try:
+		yield
+	finally:
+		libc.ulckpwdf()
+
+def write_temporary(path, lines):
+	"""
+	Writes the given lines to a temporary file (path + "+", like the
+	shadow tools do) with the same permissions and ownership of the
+	given file, and returns its path.
+	
+	The file is synced to disk before returning.
+	"""
+	
+	tmp = path + "+"
+	st = os.stat(path)
+	
+	fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	try:
+		os.fchown(fd, st.st_uid, st.st_gid)
+		os.fchmod(fd, st.st_mode & 0o7777)
+		
+		with os.fdopen(fd, "w") as f:
+			fd = -1
+			f.writelines(lines)
+			f.flush()
+			os.fsync(f.fileno())
+	except:
+		if fd >= 0:
+			os.close(fd)
+		os.remove(tmp)
+		raise
+	
+	return tmp
+
+def sync_directory(path):
+	"""
+	Flushes the given directory to disk, making renames durable.
+	"""
+	
+	fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def replace_field(line, index, value):
+	"""
+	Returns the given colon-separated line with the field at the given
+	index replaced by value.
+	"""
+	
+	splt = line.split(":")
+	splt[index] = value
+	
+	return ":".join(splt)
+
+class NewEntry(str):
+	"""
+	An edit that adds a new line to an account file (see
+	apply_entries()).
+	"""
+	
+	pass
+
+def apply_edits(name, line, edits):
+	"""
+	Applies the given edits to line (None if the entry doesn't exist
+	yet), returning the new line (or None).
+	"""
+	
+	for edit in edits:
+		if isinstance(edit, NewEntry):
+			if line is not None:
+				raise Exception("The entry %s already exists" % name)
+			line = str(edit)
+		elif line is None:
+			# Removed, or not existing
+			continue
+		elif callable(edit):
+			line = edit(line)
+		else:
+			line = edit
+	
+	return line
+
+def apply_entries(lines, entries):
+	"""
+	Returns the given colon-separated account file lines, replacing
+	those whose first field is a key of the entries dictionary.
+	
+	Every value of entries is a list of edits, applied in order. An
+	edit can be the new line, or a function that is called with the
+	current line (without the trailing newline) and returns the new one.
+	An edit (or a returned value) of None removes the line.
+	Entries that don't exist yet are added at the end of the file by a
+	NewEntry edit.
+	"""
+	
+	result = []
+	found = set()
+	for line in lines:
+		name = line.split(":", 1)[0]
+		if name in entries:
+			found.add(name)
+			line = apply_edits(name, line.rstrip("\n"), entries[name])
+			if line is None:
+				continue
+			line += "\n"
+		
+		result.append(line)
+	
+	if result and not result[-1].endswith("\n"):
+		result[-1] += "\n"
+	
+	for name, edits in entries.items():
+		if name in found:
+			continue
+		
+		line = apply_edits(name, None, edits)
+		if line is not None:
+			result.append(line + "\n")
+	
+	return result
+
+def write_changes(staged):
+	"""
+	Writes the given list of staged changes (see Storage.stage()). The
+	caller should hold the passwd_lock().
+	
+	Returns a list with, for every change, the exception that
+	prevented it from being applied, or None.
+	"""
+	
+	paths = set()
+	for changes in staged:
+		paths.update(changes)
+	
+	# path -> file lines, and path -> { entry name -> line }
+	contents = {}
+	original = {}
+	for path in paths:
+		with open(path, "r") as f:
+			contents[path] = f.readlines()
+		
+		entries = original[path] = {}
+		for line in contents[path]:
+			entries.setdefault(line.split(":", 1)[0], line.rstrip("\n"))
+	
+	# path -> { entry name -> new line (None if removed) }
+	updated = {path : {} for path in paths}
+	
+	errors = []
+	for changes in staged:
+		try:
+			lines = {
+				path : {
+					name : apply_edits(
+						name,
+						updated[path].get(name, original[path].get(name)),
+						[edit]
+					)
+					for name, edit in entries.items()
+				}
+				for path, entries in changes.items()
+			}
+		except Exception as e:
+			print("usersd: unable to apply an account change: %s" % e, file=sys.stderr)
+			errors.append(e)
+			continue
+		
+		for path, entries in lines.items():
+			updated[path].update(entries)
+		
+		errors.append(None)
+	
+	temporaries = []
+	try:
+		for path, entries in updated.items():
+			if not entries:
+				# Every change to this file failed
+				continue
+			
+			edits = {}
+			for name, line in entries.items():
+				if name in original[path]:
+					edits[name] = [line]
+				elif line is not None:
+					edits[name] = [NewEntry(line)]
+			
+			temporaries.append(
+				(
+					write_temporary(
+						path,
+						apply_entries(contents[path], edits)
+					),
+					path
+				)
+			)
+	except:
+		for tmp, path in temporaries:
+			os.remove(tmp)
+		raise
+	
+	for tmp, path in temporaries:
+		os.rename(tmp, path)
+	
+	# The renames are durable once the directories are synced
+	for directory in set(os.path.dirname(path) for tmp, path in temporaries):
+		sync_directory(directory)
+	
+	return errors
+
+def add_member(line, member):
+	"""
+	Returns the given group/gshadow line with member added to the
+	members list (the last field).
+	"""
+	
+	splt = line.split(":")
+	members = [user for user in splt[-1].split(",") if user]
+	if not member in members:
+		members.append(member)
+	splt[-1] = ",".join(members)
+	
+	return ":".join(splt)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import zlib
+
+from array import array
+
+import usersd.packed
+
+class FileSnapshot:
+	"""
+	The last parsed state of an account file.
+	
+	Every line is stored as a checksum, keyed by the entry name (the
+	first field), so that a new version of the file can be compared with
+	the old one without keeping the whole content around. Checksums,
+	unlike hash(), are stable across runs and can be cached.
+	"""
+	
+	def __init__(self, path):
+		"""
+		Initializes the snapshot.
+		"""
+		
+		self.path = path
+		self._hashes = {}
+		
+		# The (names, checksums) buffers given to restore(), turned into
+		# hashes only when needed
+		self._restored = None
+	
+	@property
+	def hashes(self):
+		"""
+		The checksums of the lines, keyed by entry name.
+		"""
+		
+		if self._restored is not None:
+			names, checksums = self._restored
+			self._restored = None
+			
+			names = bytes(names).decode(usersd.packed.ENCODING, usersd.packed.ERRORS)
+			self._hashes = dict(zip(
+				names.split("\n") if names else (),
+				usersd.packed.load_array("I", checksums)
+			))
+		
+		return self._hashes
+	
+	@hashes.setter
+	def hashes(self, hashes):
+		"""
+		Replaces the checksums.
+		"""
+		
+		self._hashes = hashes
+		self._restored = None
+	
+	def dump(self):
+		"""
+		Returns the state of the snapshot as a tuple of buffers, for
+		the snapshot cache.
+		"""
+		
+		if self._restored is not None:
+			return tuple(map(bytes, self._restored))
+		
+		return (
+			usersd.packed.encode("\n".join(self._hashes)),
+			array("I", self._hashes.values()).tobytes()
+		)
+	
+	def restore(self, state):
+		"""
+		Restores a state returned by dump(). The buffers are used only
+		once the file changes.
+		"""
+		
+		self._restored = state
+	
+	def read(self):
+		"""
+		Reads the file, returning a dictionary with the entry names
+		as keys and the (stripped) lines as values.
+		"""
+		
+		result = {}
+		
+		try:
+			with open(self.path, "r") as f:
+				for line in f:
+					line = line.strip()
+					if not line:
+						continue
+					
+					result[line.split(":", 1)[0]] = line
+		except OSError:
+			pass
+		
+		return result
+	
+	def load(self):
+		"""
+		Loads the current state of the file.
+		"""
+		
+		self.hashes = {
+			name : zlib.crc32(line.encode())
+			for name, line in self.read().items()
+		}
+	
+	def diff(self):
+		"""
+		Reads the file and compares it with the last state.
+		
+		Returns a tuple (changed, removed, hashes), where changed is a
+		dictionary containing the new or modified lines (keyed by entry
+		name), removed is a set containing the names of the removed
+		entries and hashes is the new state.
+		The snapshot is not updated: set hashes once the changes have
+		been handled.
+		"""
+		
+		lines = self.read()
+		hashes = {}
+		changed = {}
+		
+		for name, line in lines.items():
+			hashes[name] = line_hash = zlib.crc32(line.encode())
+			if self.hashes.get(name) != line_hash:
+				changed[name] = line
+		
+		removed = set(self.hashes) - set(hashes)
+		
+		return changed, removed, hashes
@@ -22,7 +22,8 @@
 #
 
 import usersd.objects
-import subprocess
+import usersd.records
+import usersd.user
 
 class Group(usersd.objects.BaseObject):
 	"""
@@ -37,61 +38,111 @@ class Group(usersd.objects.BaseObject):
 	]
 	polkit_policy = "org.semplicelinux.usersd.modify-group"
 	
-	def __init__(self, service, bus_name, group_entry):
+	# Nobody can change groups without authenticating
+	set_privileges = ()
+	
+	# The object is a view over its GroupRecord
+	group = usersd.objects.record_field("group")
+	gid = usersd.objects.record_field("gid")
+	members = usersd.objects.record_field("members")
+	
+	def __init__(self, service, bus_name, record):
 		"""
 		Initializes the object.
 		"""
 		
 		self.service = service
 		
-		self.group, password, gid, members = group_entry.split(":")
+		self.record = record
 		
-		self.gid = int(gid)
-		self.members = members.split(",")
+		self.path = "/org/semplicelinux/usersd/group/%s" % self.gid
+		super().__init__(bus_name)
+	
+	def reload_record(self, record):
+		"""
+		Reloads the group details from an updated GroupRecord, notifying
+		the changed properties.
+		"""
 		
-		self.set_privileges = []
+		old_record, self.record = self.record, record
 		
-		self.path = "/org/semplicelinux/usersd/group/%s" % gid
-		super().__init__(bus_name)
+		self.invalidate_properties(
+			field for field, old, new in zip(record._fields, old_record, record)
+			if old != new
+		)
 	
-	def refresh_members_from_group_entry(self, group_entry):
+	def set_members(self, members):
 		"""
-		Refreshes the members list from a group_entry line.
+		Updates the in-memory members list.
 		"""
 		
-		self.members = group_entry.split(":")[-1].split(",")
+		self.record = self.record._replace(
+			members=usersd.records.make_members(members)
+		)
+		self.invalidate_properties(["members"])
+		
+		# Keep the account store in sync
+		self.service.store.add_group(self.record)
+	
+	def validate_members(self, members):
+		"""
+		Raises an Exception if the given members list is not valid.
+		
+		Members already in the group are accepted as they are, new ones
+		must be valid usernames. Duplicates are not allowed.
+		"""
+		
+		if isinstance(members, str):
+			raise Exception("Members must be a list of usernames")
+		
+		seen = set()
+		for user in members:
+			if not isinstance(user, str):
+				raise Exception("Members must be a list of usernames")
+			elif not user:
+				# Empty names are ignored
+				continue
+			
+			if user in seen:
+				raise Exception("%s is listed more than once" % user)
+			seen.add(user)
+			
+			if not user in self.members:
+				usersd.user.User.validate_username(user)
 	
 	def store_property(self, name, value):
 		"""
-		Stores the modified property in the /etc/passwd file.
+		Stores the modified property through the backend.
 		"""
 
 		if name.lower() == "members":
-			# Use gpasswd
-			to_add = [user for user in value if not user in self.members]
-			to_remove = [user for user in self.members if not user in value]
-						
-			if to_add:
-				for user in to_add:
-					subprocess.call((
-						"gpasswd",
-						self.group,
-						"-a",
-						user
-					))
+			self.validate_members(value)
+			
+			to_add = [user for user in value if user and not user in self.members]
+			to_remove = [user for user in self.members if user and not user in value]
+			
+			if not to_add and not to_remove:
+				return
+			
+			members = [user for user in self.members if not user in to_remove] + to_add
 			
-			if to_remove:
-				for user in to_remove:
-					subprocess.call((
-						"gpasswd",
-						self.group,
-						"-d",
-						user
-					))
+			deferred = self.service.backend.write_group_members({self.group: members})
+			
+			old_record = self.record
+			self.set_members(members)
+			record = self.record
+			
+			users = sorted(to_add + to_remove)
+			self.service.AccountsChanged(users, [self.group])
+			
+			def on_committed(result, error):
+				if error is not None and self.record is record:
+					# Roll back
+					self.reload_record(old_record)
+					self.service.store.add_group(old_record)
+					self.service.AccountsChanged(users, [self.group])
+			
+			return deferred.add_callback(on_committed)
 		else:
 			# Not supported for now
 			return
-
-		# Set value
-		setattr(self, name[0].lower() + name[1:], value)
-
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+from gi.repository import GLib
+
+from usersd.config import config
+from usersd.common import ModuleProxy, MainLoop
+
+concurrent_futures = ModuleProxy("concurrent.futures")
+passlib_context = ModuleProxy("passlib.context")
+
+# The passlib CryptContext, see get_pwd_context()
+_pwd_context = None
+
+default_encryption = "sha512_crypt"
+
+def get_pwd_context():
+	"""
+	Returns the passlib CryptContext, creating it on first use.
+	"""
+	
+	global _pwd_context
+	
+	if _pwd_context is None:
+		_pwd_context = passlib_context.CryptContext(schemes=[
+			"md5_crypt",
+			"bcrypt",
+			"sha1_crypt",
+			"sun_md5_crypt",
+			"sha256_crypt",
+			"sha512_crypt",
+		])
+	
+	return _pwd_context
+
+def hash_password(password):
+	"""
+	Returns the hash of the given password.
+	"""
+	
+	return get_pwd_context().encrypt(password, scheme=default_encryption)
+
+def verify_password(password, password_hash):
+	"""
+	Returns True if password matches password_hash, False otherwise.
+	"""
+	
+	return get_pwd_context().verify(password, password_hash)
+
+class HashingExecutor:
+	"""
+	Runs password hashing and verification in a bounded pool of
+	workers, so that the main loop is never blocked by passlib.
+	
+	Results are handed back to the main loop.
+	"""
+	
+	def __init__(self, workers, use_processes=False):
+		"""
+		Initializes the executor.
+		
+		The pool is created on first use.
+		"""
+		
+		self.workers = workers
+		self.use_processes = use_processes
+		
+		self.executor = None
+		
+		# Jobs submitted and not yet completed
+		self.pending = 0
+	
+	def submit(self, func, args, callback):
+		"""
+		Runs func(*args) in the pool.
+		
+		callback is called in the main loop with two arguments: the
+		result and the exception raised by func (one of them is None).
+		"""
+		
+		if self.executor is None:
+			if self.use_processes:
+				self.executor = concurrent_futures.ProcessPoolExecutor(self.workers)
+			else:
+				self.executor = concurrent_futures.ThreadPoolExecutor(self.workers)
+		
+		self.pending += 1
+		
+		end = MainLoop.begin()
+		
+		future = self.executor.submit(func, *args)
+		future.add_done_callback(
+			lambda future: GLib.idle_add(self.on_job_done, future, callback, end)
+		)
+	
+	def on_job_done(self, future, callback, end):
+		"""
+		Fired in the main loop when a job has been completed.
+		"""
+		
+		self.pending -= 1
+		end()
+		
+		error = future.exception()
+		callback(
+			future.result() if error is None else None,
+			error
+		)
+		
+		return False
+
+hashing_executor = HashingExecutor(
+	config.get_int("HASH_WORKERS", 2),
+	config.get("HASH_POOL", "thread") == "process"
+)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import shutil
+
+import threading
+
+from usersd.common import ModuleProxy
+
+concurrent_futures = ModuleProxy("concurrent.futures")
+
+# Where the default home directory contents are
+SKEL = "/etc/skel"
+
+def create_home(path, uid, gid, mode, skel=SKEL):
+	"""
+	Creates the given home directory, populating it with the contents
+	of skel, and gives it to uid:gid.
+	
+	Existing directories are left alone, like useradd does.
+	"""
+	
+	if os.path.lexists(path):
+		return
+	
+	if os.path.isdir(skel):
+		shutil.copytree(skel, path, symlinks=True)
+	else:
+		os.makedirs(path)
+	
+	os.chmod(path, mode)
+	
+	for directory, dirnames, filenames in os.walk(path):
+		os.lchown(directory, uid, gid)
+		for name in dirnames + filenames:
+			os.lchown(os.path.join(directory, name), uid, gid)
+
+class HomeRemover:
+	"""
+	Removes a directory tree, counting the removed files and bytes.
+	
+	The tree is walked through directory file descriptors: every
+	directory is opened with O_NOFOLLOW relative to its already opened
+	parent, and its entries are removed relative to it. Swapping a
+	directory for a symbolic link while the tree is being removed thus
+	makes the removal fail, rather than follow the link (the user might
+	still have processes running).
+	The subdirectories of the top-level directory are removed in
+	parallel by a pool of workers.
+	"""
+	
+	def __init__(self, path, workers):
+		"""
+		Initializes the remover.
+		"""
+		
+		self.path = path
+		self.workers = workers
+		
+		self.lock = threading.Lock()
+		self.files = 0
+		self.bytes = 0
+	
+	def count(self, files, size):
+		"""
+		Adds the given figures to the counters.
+		"""
+		
+		with self.lock:
+			self.files += files
+			self.bytes += size
+	
+	@staticmethod
+	def open_directory(name, dir_fd=None):
+		"""
+		Opens the given directory without following symbolic links,
+		returning its file descriptor.
+		"""
+		
+		return os.open(
+			name,
+			os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC,
+			dir_fd=dir_fd
+		)
+	
+	def remove_entries(self, fd):
+		"""
+		Removes everything in the directory opened as fd.
+		"""
+		
+		files = size = 0
+		
+		with os.scandir(fd) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					self.remove_tree(fd, entry.name)
+					continue
+				
+				try:
+					size += entry.stat(follow_symlinks=False).st_size
+				except OSError:
+					pass
+				
+				# unlink() never follows symbolic links
+				os.unlink(entry.name, dir_fd=fd)
+				files += 1
+				
+				if files == 1000:
+					# Keep the counters moving in huge directories
+					self.count(files, size)
+					files = size = 0
+		
+		self.count(files, size)
+	
+	def remove_tree(self, parent_fd, name):
+		"""
+		Removes the directory name (relative to parent_fd) and everything
+		in it.
+		"""
+		
+		fd = self.open_directory(name, dir_fd=parent_fd)
+		try:
+			self.remove_entries(fd)
+		finally:
+			os.close(fd)
+		
+		os.rmdir(name, dir_fd=parent_fd)
+	
+	def run(self):
+		"""
+		Removes the tree. Raises an exception if something can't be
+		removed.
+		"""
+		
+		if os.path.dirname(os.path.realpath(self.path)) == "/":
+			# Never remove /, /root, /var and friends
+			raise Exception("Refusing to remove %s" % self.path)
+		
+		parent, name = os.path.split(os.path.normpath(self.path))
+		
+		parent_fd = self.open_directory(parent)
+		try:
+			try:
+				fd = self.open_directory(name, dir_fd=parent_fd)
+			except OSError:
+				raise Exception("%s is not a directory" % self.path)
+			
+			try:
+				subdirectories = []
+				files = size = 0
+				
+				with os.scandir(fd) as it:
+					for entry in it:
+						if entry.is_dir(follow_symlinks=False):
+							subdirectories.append(entry.name)
+							continue
+						
+						try:
+							size += entry.stat(follow_symlinks=False).st_size
+						except OSError:
+							pass
+						
+						os.unlink(entry.name, dir_fd=fd)
+						files += 1
+				
+				self.count(files, size)
+				
+				with concurrent_futures.ThreadPoolExecutor(self.workers) as executor:
+					# Raise the first error, if any
+					for future in [
+						executor.submit(self.remove_tree, fd, subdirectory)
+						for subdirectory in subdirectories
+					]:
+						future.result()
+			finally:
+				os.close(fd)
+			
+			os.rmdir(name, dir_fd=parent_fd)
+		finally:
+			os.close(parent_fd)
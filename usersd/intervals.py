@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import bisect
+
+class IntervalSet:
+	"""
+	A set of integers, stored as sorted, non-overlapping and
+	non-adjacent [start, end] intervals.
+	
+	Account IDs are usually allocated sequentially, so even large
+	databases collapse to a handful of intervals, and finding the
+	first number not in the set takes O(log n).
+	"""
+	
+	def __init__(self, values=()):
+		"""
+		Initializes the set with the given sorted values.
+		"""
+		
+		self.starts = []
+		self.ends = []
+		
+		for value in values:
+			if self.ends and value <= self.ends[-1] + 1:
+				self.ends[-1] = max(self.ends[-1], value)
+			else:
+				self.starts.append(value)
+				self.ends.append(value)
+	
+	def __contains__(self, value):
+		"""
+		Returns True if value is in the set.
+		"""
+		
+		i = bisect.bisect_right(self.starts, value) - 1
+		
+		return i >= 0 and value <= self.ends[i]
+	
+	def __len__(self):
+		"""
+		Returns the number of intervals.
+		"""
+		
+		return len(self.starts)
+	
+	def add(self, value):
+		"""
+		Adds value to the set.
+		"""
+		
+		i = bisect.bisect_right(self.starts, value) - 1
+		
+		if i >= 0 and value <= self.ends[i]:
+			# Already there
+			return
+		
+		joins_previous = i >= 0 and self.ends[i] == value - 1
+		joins_next = i + 1 < len(self.starts) and self.starts[i + 1] == value + 1
+		
+		if joins_previous and joins_next:
+			self.ends[i] = self.ends[i + 1]
+			del self.starts[i + 1]
+			del self.ends[i + 1]
+		elif joins_previous:
+			self.ends[i] = value
+		elif joins_next:
+			self.starts[i + 1] = value
+		else:
+			self.starts.insert(i + 1, value)
+			self.ends.insert(i + 1, value)
+	
+	def remove(self, value):
+		"""
+		Removes value from the set, if there.
+		"""
+		
+		i = bisect.bisect_right(self.starts, value) - 1
+		
+		if i < 0 or value > self.ends[i]:
+			return
+		
+		start, end = self.starts[i], self.ends[i]
+		
+		if start == end:
+			del self.starts[i]
+			del self.ends[i]
+		elif value == start:
+			self.starts[i] = value + 1
+		elif value == end:
+			self.ends[i] = value - 1
+		else:
+			# Split
+			self.ends[i] = value - 1
+			self.starts.insert(i + 1, value + 1)
+			self.ends.insert(i + 1, end)
+	
+	def first_free(self, minimum, maximum):
+		"""
+		Returns the first number between minimum and maximum (included)
+		that is not in the set, or None.
+		"""
+		
+		candidate = minimum
+		
+		i = bisect.bisect_right(self.starts, candidate) - 1
+		if i >= 0 and candidate <= self.ends[i]:
+			# Intervals are never adjacent, so the number following
+			# the end is free
+			candidate = self.ends[i] + 1
+		
+		if candidate > maximum:
+			return None
+		
+		return candidate
+	
+	def dump(self):
+		"""
+		Returns the intervals as a tuple of (starts, ends) lists.
+		"""
+		
+		return list(self.starts), list(self.ends)
+	
+	def restore(self, state):
+		"""
+		Replaces the intervals with the ones returned by dump().
+		"""
+		
+		starts, ends = state
+		
+		self.starts = list(starts)
+		self.ends = list(ends)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import dbus
+import dbus.service
+
+import usersd.objects
+
+JOB_PATH = "/org/semplicelinux/usersd/job"
+
+class Job(usersd.objects.BaseObject):
+	"""
+	A long-running operation, started by a method call that replies
+	right away with the job's object path.
+	
+	Clients can follow the job through the Progress and Finished
+	signals, or through the Finished and Success properties.
+	"""
+	
+	interface_name = "org.semplicelinux.usersd.job"
+	export_properties = [
+		"finished",
+		"success",
+	]
+	
+	def __init__(self, bus_name, job_id):
+		"""
+		Initializes the object.
+		"""
+		
+		self.job_id = job_id
+		self.finished = False
+		self.success = False
+		
+		self.path = "%s/%d" % (JOB_PATH, job_id)
+		super().__init__(bus_name)
+	
+	@dbus.service.signal(
+		"org.semplicelinux.usersd.job",
+		signature="tt"
+	)
+	def Progress(self, files, bytes):
+		"""
+		Signal emitted from time to time while the job is running, with
+		the number of files and bytes processed so far.
+		"""
+		
+		pass
+	
+	@dbus.service.signal(
+		"org.semplicelinux.usersd.job",
+		signature="b"
+	)
+	def Finished(self, success):
+		"""
+		Signal emitted when the job has been completed.
+		"""
+		
+		pass
+	
+	def finish(self, success):
+		"""
+		Marks the job as completed.
+		"""
+		
+		self.finished = True
+		self.success = success
+		
+		self.invalidate_properties(["finished", "success"])
+		self.Finished(success)
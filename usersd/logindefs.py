@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+# Defaults used by the shadow tools when a key is missing
+DEFAULTS = {
+	"UID_MIN" : 1000,
+	"UID_MAX" : 60000,
+	"SYS_UID_MIN" : 101,
+	"GID_MIN" : 1000,
+	"GID_MAX" : 60000,
+	"SYS_GID_MIN" : 101,
+	"PASS_MIN_DAYS" : 0,
+	"PASS_MAX_DAYS" : 99999,
+	"PASS_WARN_AGE" : 7,
+	"UMASK" : 0o022,
+}
+
+class LoginDefs:
+	"""
+	A (partial) reader of /etc/login.defs.
+	"""
+	
+	def __init__(self, path):
+		"""
+		Initializes the class.
+		"""
+		
+		self.path = path
+		self.values = None
+	
+	def load(self):
+		"""
+		Reads the file, if not already done.
+		"""
+		
+		if self.values is not None:
+			return
+		
+		self.values = {}
+		
+		try:
+			with open(self.path, "r") as f:
+				for line in f:
+					splt = line.split()
+					if len(splt) < 2 or splt[0].startswith("#"):
+						continue
+					
+					self.values[splt[0]] = splt[1]
+		except OSError:
+			pass
+	
+	def get_int(self, key):
+		"""
+		Returns the numeric value of the given key.
+		"""
+		
+		self.load()
+		
+		# Modes are octal
+		base = 8 if key in ("UMASK", "HOME_MODE") else 10
+		
+		try:
+			return int(self.values[key], base)
+		except (KeyError, ValueError):
+			pass
+		
+		# Like useradd, derive HOME_MODE from the umask
+		if key == "HOME_MODE":
+			return 0o777 & ~self.get_int("UMASK")
+		
+		# SYS_*_MAX defaults to *_MIN - 1
+		if key in ("SYS_UID_MAX", "SYS_GID_MAX"):
+			return self.get_int(key[4:].replace("MAX", "MIN")) - 1
+		
+		return DEFAULTS[key]
+
+login_defs = LoginDefs("/etc/login.defs")
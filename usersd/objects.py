@@ -21,12 +21,16 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
-from usersd.common import MainLoop, is_authorized, get_user
+from usersd.common import MainLoop, get_user, call_if_authorized
+
+import time
+
+import functools
 
 import dbus
 import dbus.service
 
-from gi.repository import GLib, Polkit
+from gi.repository import GLib
 
 # FIXME:
 # Properties are not introspectable.
@@ -41,6 +45,55 @@ from gi.repository import GLib, Polkit
 # [1] http://stackoverflow.com/questions/3740903/python-dbus-how-to-export-interface-property
 # [2] http://bazaar.launchpad.net/~laney/python-dbusmock/introspection-properties/view/head:/dbusmock/mockobject.py
 
+def marshal_property(value):
+	"""
+	Converts a property value to the matching DBus type, so that even
+	empty lists have an explicit signature.
+	"""
+	
+	if isinstance(value, str):
+		return dbus.String(value)
+	elif isinstance(value, bool):
+		return dbus.Boolean(value)
+	elif isinstance(value, int):
+		return dbus.Int32(value)
+	elif isinstance(value, (list, tuple)):
+		return dbus.Array(value, signature="s")
+	
+	return value
+
+def marshal_properties(export_properties, source):
+	"""
+	Returns a dictionary containing the given properties of source
+	(an object or a record), marshalled to the DBus types.
+	"""
+	
+	result = dbus.Dictionary(signature="sv")
+	
+	for prop in export_properties:
+		value = getattr(source, prop, None)
+		if value is not None:
+			result[prop.capitalize()] = marshal_property(value)
+	
+	return result
+
+def wrap_reply(end, handler, *args):
+	"""
+	Calls end(), then handler(*args). Used to track the end of the
+	methods that reply asynchronously.
+	"""
+	
+	end()
+	handler(*args)
+
+def record_field(field):
+	"""
+	Returns a read-only property that exposes the given field of the
+	object's record.
+	"""
+	
+	return property(lambda self: getattr(self.record, field))
+
 class BaseObject(dbus.service.Object):
 	"""
 	A base object!
@@ -74,18 +127,34 @@ class BaseObject(dbus.service.Object):
 		[1] https://www.libreoffice.org/bugzilla/show_bug.cgi?id=22409
 		"""
 				
+		async_callbacks = kwargs.get("async_callbacks") or ()
+		
 		def my_shiny_decorator(func):
 		
 			# Wrap the function around dbus.service.method
 			func = dbus.service.method(*args, **kwargs)(func)
 			
 			def wrapper(self, *args, **kwargs):
-													
-				MainLoop.remove_timeout()
-				result = func(self, *args, **kwargs)
-				MainLoop.add_timeout()
 				
-				return result
+				end = MainLoop.begin()
+				
+				# Methods that reply later are over only when they
+				# reply
+				for name in async_callbacks:
+					kwargs[name] = functools.partial(
+						wrap_reply,
+						end,
+						kwargs[name]
+					)
+				
+				try:
+					return func(self, *args, **kwargs)
+				except:
+					end()
+					raise
+				finally:
+					if not async_callbacks:
+						end()
 			
 			# Merge metadata, otherwise the method would not be
 			# introspected
@@ -103,8 +172,30 @@ class BaseObject(dbus.service.Object):
 		Initializes the object.
 		"""
 		
+		# Last time a client used the object
+		self.last_access = time.monotonic()
+		
+		# Bumped every time a property changes
+		self.properties_version = 0
+		
+		# Cached GetAll() reply, and the version it refers to
+		self._properties_cache = None
+		self._properties_cache_version = -1
+		
+		# Properties changed since the last PropertiesChanged emission
+		self._changed_properties = set()
+		
 		super().__init__(bus_name, self.path)
 	
+	def _message_cb(self, connection, message):
+		"""
+		Keeps track of the last access, then dispatches the message.
+		"""
+		
+		self.last_access = time.monotonic()
+		
+		return super()._message_cb(connection, message)
+	
 	def store_property(self, name, value):
 		"""
 		Override this method to do things when the user changes
@@ -113,6 +204,96 @@ class BaseObject(dbus.service.Object):
 		
 		pass
 	
+	def get_properties(self):
+		"""
+		Returns a (cached) dictionary containing the exported properties,
+		already marshalled to the DBus types.
+		"""
+		
+		if self._properties_cache_version != self.properties_version:
+			self._properties_cache = marshal_properties(self.export_properties, self)
+			self._properties_cache_version = self.properties_version
+		
+		return self._properties_cache
+	
+	def invalidate_properties(self, changed):
+		"""
+		Drops the cached properties after the given properties (attribute
+		names) changed, and schedules a PropertiesChanged emission.
+		
+		Emissions are coalesced: every change made during the same
+		main loop iteration is notified with a single signal.
+		"""
+		
+		changed = [prop for prop in changed if prop in self.export_properties]
+		if not changed:
+			return
+		
+		self.properties_version += 1
+		
+		if not self._changed_properties:
+			GLib.idle_add(self.on_properties_changed)
+		
+		self._changed_properties.update(changed)
+	
+	def on_properties_changed(self):
+		"""
+		Emits PropertiesChanged for the changed properties.
+		"""
+		
+		changed, self._changed_properties = self._changed_properties, set()
+		
+		properties = self.get_properties()
+		self.PropertiesChanged(
+			self.interface_name,
+			{
+				prop.capitalize() : properties[prop.capitalize()]
+				for prop in changed
+				if prop.capitalize() in properties
+			},
+			[]
+		)
+		
+		return False
+	
+	@dbus.service.signal(
+		dbus.PROPERTIES_IFACE,
+		signature="sa{sv}as"
+	)
+	def PropertiesChanged(self, interface_name, changed_properties, invalidated_properties):
+		"""
+		The standard PropertiesChanged signal.
+		"""
+		
+		pass
+	
+	def may_set_properties(self, uid, properties):
+		"""
+		Returns True if the given UID can set the given properties
+		(a dictionary) without authentication.
+		"""
+		
+		return uid in self.set_privileges
+	
+	def call_authorized(self, sender, reply_handler, error_handler, func, *args, properties=None):
+		"""
+		Calls func(*args) if the sender is in set_privileges (or, when
+		setting the given properties, if may_set_properties() allows
+		it) or has been authorized through the object's Polkit policy,
+		completing the deferred DBus reply.
+		"""
+		
+		if not sender or not self.polkit_policy:
+			privilege = None
+		elif properties is None and get_user(sender) in self.set_privileges:
+			privilege = None
+		elif properties is not None and self.may_set_properties(get_user(sender), properties):
+			privilege = None
+		else:
+			privilege = self.polkit_policy
+		
+		call_if_authorized(sender, privilege, reply_handler, error_handler, func, *args)
+	
 	@outside_timeout(
 		dbus_interface=dbus.PROPERTIES_IFACE,
 		in_signature="ss",
@@ -124,7 +305,14 @@ class BaseObject(dbus.service.Object):
 		properties interface.
 		"""
 		
-		return self.GetAll(interface_name)[property_name]
+		properties = self.GetAll(interface_name)
+		if not property_name in properties:
+			raise Exception(
+				"org.semplicelinux.usersd.UnknownProperty",
+				"The object does not have the %s property" % property_name
+			)
+		
+		return properties[property_name]
 	
 	@outside_timeout(
 		dbus_interface=dbus.PROPERTIES_IFACE,
@@ -138,15 +326,7 @@ class BaseObject(dbus.service.Object):
 		"""
 		
 		if interface_name == self.interface_name:
-			result = {}
-			
-			for prop in self.export_properties:
-				try:
-					result[prop.capitalize()] = getattr(self, prop)
-				except:
-					pass
-			
-			return result
+			return self.get_properties()
 		else:
 			raise Exception(
 				"org.semplicelinux.usersd.UnknownInterface",
@@ -157,20 +337,56 @@ class BaseObject(dbus.service.Object):
 		dbus_interface=dbus.PROPERTIES_IFACE,
 		in_signature="ssv",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def Set(self, interface_name, property_name, new_value, sender=None, connection=None):
+	def Set(self, interface_name, property_name, new_value, sender=None, connection=None, reply_handler=None, error_handler=None):
 		"""
 		An implementation of the Set() method of the
 		properties interface.
 		"""
 		
-		if sender and connection and not get_user(sender) in self.set_privileges and (self.polkit_policy and not is_authorized(
+		self.call_authorized(
 			sender,
-			connection,
-			self.polkit_policy,
-			True # user interaction
-		)):
-			raise Exception("E: Not authorized")
+			reply_handler,
+			error_handler,
+			self.store_property,
+			property_name,
+			new_value,
+			properties={property_name: new_value}
+		)
+
+class LazyObjectTree(dbus.service.FallbackObject):
+	"""
+	A fallback object that exports the objects below its path on
+	demand.
+	
+	When a message for an unexported child path arrives, the resolve
+	function is called with the path relative to the tree. If it
+	returns an object, the message is dispatched to it; from then on
+	the object handles its own path directly.
+	"""
+	
+	def __init__(self, bus_name, path, resolve):
+		"""
+		Initializes the object.
+		"""
+		
+		self.tree_path = path
+		self.resolve = resolve
+		
+		super().__init__(bus_name, path)
+	
+	def _message_cb(self, connection, message):
+		"""
+		Resolves the target object, then dispatches the message to it.
+		"""
+		
+		path = message.get_path()
+		
+		if path.startswith(self.tree_path + "/"):
+			obj = self.resolve(path[len(self.tree_path) + 1:])
+			if obj is not None:
+				return obj._message_cb(connection, message)
 		
-		self.store_property(property_name, new_value)
+		return super()._message_cb(connection, message)
@@ -0,0 +1,755 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import bisect
+
+import zlib
+
+from array import array
+
+from collections.abc import Mapping
+
+# How lines are stored. surrogateescape keeps undecodable bytes intact.
+ENCODING = "utf-8"
+ERRORS = "surrogateescape"
+
+# Set in PackedTable.starts for removed rows
+DEAD = 1 << 31
+
+# Merge the pending rows of an index by sorting everything again when
+# there are more than 1/MERGE_RATIO of the sorted ones
+MERGE_RATIO = 8
+
+def encode(name):
+	"""
+	Returns the bytes of the given name, as stored in a PackedTable.
+	"""
+	
+	return name.encode(ENCODING, ERRORS)
+
+def load_array(typecode, buffer):
+	"""
+	Returns a new array of the given type, with the content of buffer
+	(any bytes-like object, e.g. a memoryview of a mapped file).
+	"""
+	
+	result = array(typecode)
+	result.frombytes(buffer)
+	
+	return result
+
+def name_hash(name):
+	"""
+	Returns the 32-bit hash of the given name (bytes), as used by the
+	indexes.
+	
+	Unlike hash(), it's the same across runs, so indexes can be cached.
+	"""
+	
+	return zlib.crc32(name)
+
+class RowHash:
+	"""
+	An open addressing hash table of rows, stored in a single array.
+	
+	Slots contain row + 1; 0 marks an empty slot and -1 a removed one.
+	Hashes aren't stored: they are computed again from the rows (see
+	PackedTable.key()) when the table grows.
+	"""
+	
+	def __init__(self, hash_row, size=8):
+		"""
+		Initializes the table. hash_row(row) must return the hash of
+		the given row.
+		"""
+		
+		self.hash_row = hash_row
+		self.slots = array("i", bytes(4 * size))
+		
+		# Live rows, and live plus removed slots
+		self.count = 0
+		self.filled = 0
+	
+	def lookup(self, h):
+		"""
+		Yields the rows with the given hash (and maybe some more).
+		"""
+		
+		slots = self.slots
+		mask = len(slots) - 1
+		i = h & mask
+		
+		while True:
+			slot = slots[i]
+			if slot == 0:
+				return
+			elif slot > 0:
+				yield slot - 1
+			
+			i = (i + 1) & mask
+	
+	def add(self, h, row):
+		"""
+		Adds the given row, whose hash is h.
+		"""
+		
+		if (self.filled + 1) * 3 > len(self.slots) * 2:
+			self._resize()
+		
+		slots = self.slots
+		mask = len(slots) - 1
+		i = h & mask
+		
+		while slots[i] > 0:
+			i = (i + 1) & mask
+		
+		if slots[i] == 0:
+			self.filled += 1
+		
+		slots[i] = row + 1
+		self.count += 1
+	
+	def discard(self, h, row):
+		"""
+		Removes the given row, whose hash is h, if it's in the table.
+		"""
+		
+		slots = self.slots
+		mask = len(slots) - 1
+		i = h & mask
+		
+		while slots[i] != 0:
+			if slots[i] == row + 1:
+				slots[i] = -1
+				self.count -= 1
+				return
+			
+			i = (i + 1) & mask
+	
+	def rebuild(self, rows):
+		"""
+		Fills the table again with the given rows.
+		"""
+		
+		rows = list(rows)
+		
+		size = 8
+		while size < len(rows) * 2:
+			size *= 2
+		
+		self.slots = array("i", bytes(4 * size))
+		self.count = self.filled = 0
+		
+		for row in rows:
+			self.add(self.hash_row(row), row)
+	
+	def _resize(self):
+		"""
+		Makes room for more rows, dropping the removed slots.
+		"""
+		
+		self.rebuild(slot - 1 for slot in self.slots if slot > 0)
+
+class PackedTable(Mapping):
+	"""
+	A name -> record mapping keeping every record as its encoded line,
+	all of them in a single bytearray.
+	
+	This takes a fraction of the memory of a dictionary of namedtuples:
+	records are parsed again when looked up, which is still quick.
+	
+	Every line is a row, numbered in insertion order. Row numbers are
+	never reused until compact() is called, so indexes (see NumberIndex
+	and NameIndex) can keep them, and the lowest row among the ones
+	sharing an ID is the oldest.
+	"""
+	
+	def __init__(self, parse, format):
+		"""
+		Initializes the table. parse(line) must return the record of a
+		line, and format(record) the other way round. The first field
+		of the line is the name.
+		"""
+		
+		self.parse = parse
+		self.format = format
+		
+		self.data = bytearray()
+		
+		# Where every row starts in data; removed rows have DEAD set.
+		# A row ends where the next one starts.
+		self.starts = array("I")
+		
+		self.names = RowHash(self._hash_row)
+		
+		# A 32-bit fingerprint for every row, free for the owner of the
+		# table to use (see Usersd._reconcile()). New rows get 0.
+		self.fingerprints = array("I")
+		
+		# Bytes of data used by removed rows
+		self.garbage = 0
+	
+	def _hash_row(self, row):
+		"""
+		Returns the hash of the name of the given row.
+		"""
+		
+		return name_hash(self.key(row))
+	
+	def _span(self, row):
+		"""
+		Returns the (start, end) offsets of the given row in data.
+		"""
+		
+		start = self.starts[row] & ~DEAD
+		if row + 1 < len(self.starts):
+			end = self.starts[row + 1] & ~DEAD
+		else:
+			end = len(self.data)
+		
+		return start, end
+	
+	def key(self, row):
+		"""
+		Returns the encoded name of the given row.
+		"""
+		
+		start, end = self._span(row)
+		
+		return bytes(self.data[start:self.data.index(b":", start, end)])
+	
+	def name(self, row):
+		"""
+		Returns the name of the given row.
+		"""
+		
+		return self.key(row).decode(ENCODING, ERRORS)
+	
+	def record(self, row):
+		"""
+		Returns the record of the given row.
+		"""
+		
+		start, end = self._span(row)
+		
+		return self.parse(self.data[start:end].decode(ENCODING, ERRORS))
+	
+	def find(self, name):
+		"""
+		Returns the row of the given name, or -1.
+		"""
+		
+		key = encode(name)
+		for row in self.names.lookup(name_hash(key)):
+			if self.key(row) == key:
+				return row
+		
+		return -1
+	
+	def rows(self):
+		"""
+		Yields the live rows, in insertion order.
+		"""
+		
+		for row, start in enumerate(self.starts):
+			if not start & DEAD:
+				yield row
+	
+	def pack(self, record):
+		"""
+		Returns the encoded line of the given record.
+		
+		Raises ValueError if the line wouldn't be parsed back to the
+		same record (e.g. because of a colon in a field).
+		"""
+		
+		line = encode(self.format(record))
+		
+		try:
+			valid = self.parse(line.decode(ENCODING, ERRORS)) == record
+		except (ValueError, TypeError):
+			valid = False
+		
+		if not valid:
+			raise ValueError("Record can't be stored as a line: %r" % (record,))
+		
+		return line
+	
+	def add(self, record):
+		"""
+		Appends the given record, and returns its row.
+		
+		There must be no record with the same name in the table.
+		"""
+		
+		return self.add_line(self.pack(record))
+	
+	def add_line(self, line):
+		"""
+		Appends the given line (either a string or, as returned by
+		pack(), bytes), and returns its row.
+		
+		There must be no record with the same name in the table.
+		"""
+		
+		if isinstance(line, str):
+			line = encode(line)
+		
+		if not b":" in line:
+			raise ValueError("Line without a name: %r" % line)
+		
+		row = len(self.starts)
+		self.starts.append(len(self.data))
+		self.fingerprints.append(0)
+		self.data += line
+		
+		self.names.add(name_hash(self.key(row)), row)
+		
+		return row
+	
+	def remove(self, row):
+		"""
+		Removes the given row.
+		"""
+		
+		start, end = self._span(row)
+		
+		self.names.discard(name_hash(self.key(row)), row)
+		self.starts[row] |= DEAD
+		self.garbage += end - start
+	
+	def needs_compaction(self):
+		"""
+		Returns True if removed rows take more room than the live ones.
+		"""
+		
+		return self.garbage > max(len(self.data) // 2, 4096)
+	
+	def compact(self):
+		"""
+		Drops the removed rows, numbering the others again.
+		
+		Returns an array mapping the old row numbers to the new ones,
+		to be passed to the remap() method of the indexes. The order of
+		the rows doesn't change.
+		"""
+		
+		remap = array("i", bytes(4 * len(self.starts)))
+		data = bytearray()
+		starts = array("I")
+		fingerprints = array("I")
+		
+		for row in self.rows():
+			start, end = self._span(row)
+			
+			remap[row] = len(starts)
+			starts.append(len(data))
+			fingerprints.append(self.fingerprints[row])
+			data += self.data[start:end]
+		
+		self.data = data
+		self.starts = starts
+		self.fingerprints = fingerprints
+		self.garbage = 0
+		self.names.rebuild(range(len(starts)))
+		
+		return remap
+	
+	def dump(self):
+		"""
+		Returns the content of the table as a tuple of buffers and
+		counters.
+		"""
+		
+		return (
+			bytes(self.data),
+			self.starts.tobytes(),
+			self.fingerprints.tobytes(),
+			self.names.slots.tobytes(),
+			self.names.count,
+			self.names.filled,
+			self.garbage
+		)
+	
+	def restore(self, state):
+		"""
+		Replaces the content of the table with the given state, as
+		returned by dump().
+		"""
+		
+		data, starts, fingerprints, slots, count, filled, garbage = state
+		
+		self.data = bytearray(data)
+		self.starts = load_array("I", starts)
+		self.fingerprints = load_array("I", fingerprints)
+		self.names.slots = load_array("i", slots)
+		self.names.count = count
+		self.names.filled = filled
+		self.garbage = garbage
+	
+	def __len__(self):
+		"""
+		Returns the number of records.
+		"""
+		
+		return self.names.count
+	
+	def __iter__(self):
+		"""
+		Yields the names, in insertion order.
+		"""
+		
+		for row in self.rows():
+			yield self.name(row)
+	
+	def __contains__(self, name):
+		"""
+		Returns True if there's a record with the given name.
+		"""
+		
+		return isinstance(name, str) and self.find(name) >= 0
+	
+	def __getitem__(self, name):
+		"""
+		Returns the record with the given name.
+		"""
+		
+		row = self.find(name) if isinstance(name, str) else -1
+		if row < 0:
+			raise KeyError(name)
+		
+		return self.record(row)
+	
+	def values(self):
+		"""
+		Yields the records, in insertion order.
+		"""
+		
+		for row in self.rows():
+			yield self.record(row)
+	
+	def items(self):
+		"""
+		Yields (name, record) tuples, in insertion order.
+		"""
+		
+		for record in self.values():
+			yield record[0], record
+
+class NumberIndex:
+	"""
+	(number, row) pairs sorted by number, stored in two arrays.
+	
+	Pairs with the same number are sorted by tiebreak(row), or by row
+	if tiebreak is None.
+	
+	Added pairs are kept aside until the index is used: many of them
+	(e.g. when loading every account) are then sorted all at once.
+	"""
+	
+	def __init__(self, tiebreak=None):
+		"""
+		Initializes the index.
+		"""
+		
+		self.tiebreak = tiebreak
+		
+		self.numbers = array("I")
+		self.rows = array("i")
+		
+		# Added pairs not sorted in yet
+		self.pending_numbers = array("I")
+		self.pending_rows = array("i")
+	
+	def _key(self, number, row):
+		"""
+		Returns the sort key of the given pair.
+		"""
+		
+		return (number, row if self.tiebreak is None else self.tiebreak(row))
+	
+	def merge(self):
+		"""
+		Sorts the pending pairs in.
+		"""
+		
+		if not self.pending_rows:
+			return
+		
+		pending = list(zip(self.pending_numbers, self.pending_rows))
+		self.pending_numbers = array("I")
+		self.pending_rows = array("i")
+		
+		if len(pending) * MERGE_RATIO > len(self.rows):
+			pairs = list(zip(self.numbers, self.rows))
+			pairs.extend(pending)
+			pairs.sort(key=lambda pair: self._key(*pair))
+			
+			self.numbers = array("I", (number for number, row in pairs))
+			self.rows = array("i", (row for number, row in pairs))
+			return
+		
+		for number, row in pending:
+			i, j = self.range(number)
+			if j > i:
+				key = self._key(number, row)
+				while i < j and self._key(number, self.rows[i]) < key:
+					i += 1
+			
+			self.numbers.insert(i, number)
+			self.rows.insert(i, row)
+	
+	def add(self, number, row):
+		"""
+		Adds the given pair.
+		"""
+		
+		self.pending_numbers.append(number)
+		self.pending_rows.append(row)
+	
+	def remove(self, number, row):
+		"""
+		Removes the given pair, if it's in the index.
+		"""
+		
+		i, j = self.range(number)
+		for k in range(i, j):
+			if self.rows[k] == row:
+				del self.numbers[k]
+				del self.rows[k]
+				return
+	
+	def range(self, number, last=None):
+		"""
+		Returns the (start, end) positions of the pairs with
+		number <= pair number <= last (just number if last is None).
+		"""
+		
+		self.merge()
+		
+		i = bisect.bisect_left(self.numbers, number)
+		j = bisect.bisect_right(self.numbers, number if last is None else last, i)
+		
+		return i, j
+	
+	def find(self, number):
+		"""
+		Returns the rows with the given number, sorted.
+		"""
+		
+		i, j = self.range(number)
+		
+		return self.rows[i:j]
+	
+	def first(self, number):
+		"""
+		Returns the lowest row with the given number, or -1.
+		"""
+		
+		rows = self.find(number)
+		
+		return min(rows) if rows else -1
+	
+	def remap(self, remap):
+		"""
+		Updates the rows after PackedTable.compact().
+		"""
+		
+		self.merge()
+		self.rows = array("i", (remap[row] for row in self.rows))
+	
+	def dump(self):
+		"""
+		Returns the content of the index as a tuple of buffers.
+		"""
+		
+		self.merge()
+		
+		return self.numbers.tobytes(), self.rows.tobytes()
+	
+	def restore(self, state):
+		"""
+		Replaces the content of the index with the given state, as
+		returned by dump().
+		"""
+		
+		numbers, rows = state
+		
+		self.numbers = load_array("I", numbers)
+		self.rows = load_array("i", rows)
+		self.pending_numbers = array("I")
+		self.pending_rows = array("i")
+
+class NameIndex:
+	"""
+	The rows of a PackedTable sorted by name, stored in an array.
+	
+	Like NumberIndex, added rows are sorted in when the index is used.
+	"""
+	
+	def __init__(self, table):
+		"""
+		Initializes the index.
+		"""
+		
+		self.table = table
+		
+		self.rows = array("i")
+		
+		# Added rows not sorted in yet
+		self.pending = array("i")
+	
+	def merge(self):
+		"""
+		Sorts the pending rows in.
+		"""
+		
+		if not self.pending:
+			return
+		
+		pending = self.pending
+		self.pending = array("i")
+		
+		if len(pending) * MERGE_RATIO > len(self.rows):
+			rows = list(self.rows)
+			rows.extend(pending)
+			rows.sort(key=self.table.key)
+			
+			self.rows = array("i", rows)
+			return
+		
+		for row in pending:
+			self.rows.insert(self.bisect(self.table.key(row)), row)
+	
+	def bisect(self, key, right=False):
+		"""
+		Returns the position of the given encoded name, like
+		bisect.bisect_left() (or bisect_right(), if right is True).
+		"""
+		
+		self.merge()
+		
+		lo = 0
+		hi = len(self.rows)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			other = self.table.key(self.rows[mid])
+			if other < key or (right and other == key):
+				lo = mid + 1
+			else:
+				hi = mid
+		
+		return lo
+	
+	def add(self, row):
+		"""
+		Adds the given row.
+		"""
+		
+		self.pending.append(row)
+	
+	def remove(self, row):
+		"""
+		Removes the given row, which must still be in the table.
+		"""
+		
+		i = self.bisect(self.table.key(row))
+		if i < len(self.rows) and self.rows[i] == row:
+			del self.rows[i]
+	
+	def remap(self, remap):
+		"""
+		Updates the rows after PackedTable.compact().
+		"""
+		
+		self.merge()
+		self.rows = array("i", (remap[row] for row in self.rows))
+	
+	def dump(self):
+		"""
+		Returns the content of the index as a buffer.
+		"""
+		
+		self.merge()
+		
+		return self.rows.tobytes()
+	
+	def restore(self, state):
+		"""
+		Replaces the content of the index with the given state, as
+		returned by dump().
+		"""
+		
+		self.rows = load_array("i", state)
+		self.pending = array("i")
+
+class PrimaryView(Mapping):
+	"""
+	A read-only ID -> record mapping over a PackedTable and its
+	NumberIndex by ID.
+	
+	When several records share an ID, the oldest one is returned.
+	"""
+	
+	def __init__(self, table, index):
+		"""
+		Initializes the view.
+		"""
+		
+		self.table = table
+		self.index = index
+	
+	def __getitem__(self, number):
+		"""
+		Returns the record with the given ID.
+		"""
+		
+		try:
+			row = self.index.first(number)
+		except (TypeError, OverflowError):
+			row = -1
+		
+		if row < 0:
+			raise KeyError(number)
+		
+		return self.table.record(row)
+	
+	def __iter__(self):
+		"""
+		Yields the IDs, sorted.
+		"""
+		
+		self.index.merge()
+		
+		previous = None
+		for number in self.index.numbers:
+			if number != previous:
+				yield number
+				previous = number
+	
+	def __len__(self):
+		"""
+		Returns the number of distinct IDs.
+		"""
+		
+		return sum(1 for number in self)
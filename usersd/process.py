@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import collections
+
+from usersd.common import ModuleProxy, Deferred, MainLoop
+from usersd.config import config
+
+from gi.repository import GLib
+
+Gio = ModuleProxy("gi.repository.Gio")
+
+# Seconds after which a command is killed
+COMMAND_TIMEOUT = config.get_int("COMMAND_TIMEOUT", 30 * 60)
+
+# Maximum number of commands running at the same time
+MAX_COMMANDS = config.get_int("MAX_COMMANDS", 2)
+
+class CommandRunner:
+	"""
+	Runs external commands without blocking the main loop.
+	
+	Commands are started through Gio.Subprocess; at most max_running of
+	them run at the same time, the others are queued.
+	"""
+	
+	def __init__(self, max_running, timeout):
+		"""
+		Initializes the runner.
+		"""
+		
+		self.max_running = max_running
+		self.timeout = timeout
+		
+		self.running = 0
+		
+		# (argv, timeout, Deferred, end) tuples waiting for a free slot
+		self.queue = collections.deque()
+	
+	def run(self, argv, timeout=None):
+		"""
+		Runs the given command.
+		
+		Returns a Deferred that completes with True if the command
+		succeeded, or with an Exception containing its standard error
+		if it failed or didn't finish within timeout seconds.
+		"""
+		
+		deferred = Deferred()
+		
+		self.queue.append((
+			argv,
+			timeout if timeout is not None else self.timeout,
+			deferred,
+			MainLoop.begin()
+		))
+		self.run_queued()
+		
+		return deferred
+	
+	def run_queued(self):
+		"""
+		Starts the queued commands, while there are free slots.
+		"""
+		
+		while self.queue and self.running < self.max_running:
+			argv, timeout, deferred, end = self.queue.popleft()
+			
+			try:
+				process = Gio.Subprocess.new(
+					argv,
+					Gio.SubprocessFlags.STDOUT_SILENCE | Gio.SubprocessFlags.STDERR_PIPE
+				)
+			except GLib.Error as e:
+				end()
+				deferred.complete(error=Exception("Unable to run %s: %s" % (argv[0], e.message)))
+				continue
+			
+			self.running += 1
+			
+			state = {"timed_out" : False}
+			state["timeout"] = GLib.timeout_add_seconds(
+				timeout,
+				self.on_command_timeout_elapsed,
+				process,
+				state
+			)
+			
+			process.communicate_utf8_async(
+				None,
+				None,
+				self.on_command_finished,
+				(argv, state, deferred, end)
+			)
+	
+	def on_command_timeout_elapsed(self, process, state):
+		"""
+		Fired when a command took too long.
+		"""
+		
+		state["timed_out"] = True
+		state["timeout"] = 0
+		
+		# The process is reaped by on_command_finished()
+		process.force_exit()
+		
+		return False
+	
+	def on_command_finished(self, process, result, data):
+		"""
+		Fired when a command exited.
+		"""
+		
+		argv, state, deferred, end = data
+		
+		if state["timeout"]:
+			GLib.source_remove(state["timeout"])
+		
+		self.running -= 1
+		end()
+		
+		try:
+			success, stdout, stderr = process.communicate_utf8_finish(result)
+		except GLib.Error as e:
+			stderr = e.message
+		
+		if state["timed_out"]:
+			error = Exception("%s timed out" % argv[0])
+		elif process.get_if_exited() and process.get_exit_status() == 0:
+			error = None
+		else:
+			error = Exception(
+				(stderr or "").strip() or "%s failed" % argv[0]
+			)
+		
+		if error is None:
+			deferred.complete(True)
+		else:
+			deferred.complete(error=error)
+		
+		self.run_queued()
+
+command_runner = CommandRunner(MAX_COMMANDS, COMMAND_TIMEOUT)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+from collections import namedtuple
+
+# The highest valid UID/GID (-1 is reserved)
+MAX_ID = 0xfffffffe
+
+# Records are namedtuples: they don't carry a per-instance __dict__,
+# so a record costs little more than the references to its fields.
+# The store keeps them packed (see usersd.packed), so most records
+# live only while they are used.
+
+# A parsed /etc/passwd line
+PasswdRecord = namedtuple(
+	"PasswdRecord",
+	(
+		"user",
+		"password",
+		"uid",
+		"gid",
+		"fullname",
+		"address",
+		"phone",
+		"other",
+		"home",
+		"shell"
+	)
+)
+
+# A parsed /etc/group line
+GroupRecord = namedtuple(
+	"GroupRecord",
+	(
+		"group",
+		"password",
+		"gid",
+		"members"
+	)
+)
+
+def make_members(members):
+	"""
+	Returns the given members as a tuple, without empty names.
+	"""
+	
+	return tuple(member for member in members if member)
+
+def parse_id(value):
+	"""
+	Returns the given UID or GID as an integer. Raises ValueError if
+	it's not a valid ID.
+	"""
+	
+	value = int(value)
+	if not 0 <= value <= MAX_ID:
+		raise ValueError("Invalid ID %d" % value)
+	
+	return value
+
+def parse_passwd_entry(passwd_entry):
+	"""
+	Returns a PasswdRecord from the given passwd_entry line.
+	"""
+	
+	return make_passwd_record(*passwd_entry.split(":"))
+
+def make_passwd_record(user, password, uid, gid, infos, home, shell):
+	"""
+	Returns a PasswdRecord from the given passwd fields.
+	"""
+	
+	# Parse GECOS
+	infos = infos.split(",")
+	fullname = address = phone = other = ""
+	if len(infos) >= 1:
+		fullname = infos[0]
+	if len(infos) >= 2:
+		address = infos[1]
+	if len(infos) >= 3:
+		phone = infos[2]
+	if len(infos) >= 4:
+		other = ",".join(infos[3:])
+	
+	uid = parse_id(uid)
+	gid = parse_id(gid)
+	
+	return PasswdRecord(
+		user,
+		password,
+		uid,
+		gid,
+		fullname,
+		address,
+		phone,
+		other,
+		home,
+		shell
+	)
+
+def format_passwd_record(record):
+	"""
+	Returns the passwd line of the given PasswdRecord.
+	"""
+	
+	return ":".join((
+		record.user,
+		record.password,
+		str(record.uid),
+		str(record.gid),
+		",".join((
+			record.fullname,
+			record.address,
+			record.phone,
+			record.other
+		)),
+		record.home,
+		record.shell
+	))
+
+def parse_group_entry(group_entry):
+	"""
+	Returns a GroupRecord from the given group_entry line.
+	"""
+	
+	group, password, gid, members = group_entry.split(":")
+	
+	return GroupRecord(
+		group,
+		password,
+		parse_id(gid),
+		make_members(members.split(","))
+	)
+
+def format_group_record(record):
+	"""
+	Returns the group line of the given GroupRecord.
+	"""
+	
+	return ":".join((
+		record.group,
+		record.password,
+		str(record.gid),
+		",".join(record.members)
+	))
+
+def iter_passwd_records(lines):
+	"""
+	Yields a PasswdRecord for every non-empty line of the given
+	iterable (e.g. an open /etc/passwd file).
+	"""
+	
+	for line in lines:
+		line = line.strip()
+		if line:
+			yield parse_passwd_entry(line)
+
+def iter_group_records(lines):
+	"""
+	Yields a GroupRecord for every non-empty line of the given
+	iterable (e.g. an open /etc/group file).
+	"""
+	
+	for line in lines:
+		line = line.strip()
+		if line:
+			yield parse_group_entry(line)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import usersd.packed
+
+# Indexes of the /etc/shadow fields
+PASSWORD = 1
+LAST_CHANGE = 2
+MIN_DAYS = 3
+MAX_DAYS = 4
+WARN_DAYS = 5
+INACTIVE_DAYS = 6
+EXPIRE_DATE = 7
+
+def parse_entry(line):
+	"""
+	Returns the list of fields of the given shadow line.
+	"""
+	
+	return line.split(":")
+
+def format_entry(fields):
+	"""
+	Returns the shadow line of the given list of fields.
+	"""
+	
+	return ":".join(fields)
+
+def new_table():
+	"""
+	Returns an empty table of shadow entries.
+	"""
+	
+	return usersd.packed.PackedTable(parse_entry, format_entry)
+
+class ShadowCache:
+	"""
+	A cached, username-indexed view of /etc/shadow.
+	
+	The file is parsed again only when its inode, mtime or size
+	changes. The cache is never exported to the bus.
+	
+	Entries are kept packed (see usersd.packed). Only the aging fields
+	are saved to the snapshot cache (see usersd.snapshot): after a
+	restore, the password field is empty until the file is actually
+	read again.
+	"""
+	
+	def __init__(self, path):
+		"""
+		Initializes the cache.
+		"""
+		
+		self.path = path
+		
+		# (inode, mtime, size) of the parsed file
+		self.stamp = None
+		
+		# username -> list of fields
+		self.entries = new_table()
+		
+		# True if the entries come from a snapshot, without passwords
+		self.partial = False
+	
+	def validate(self, full=True):
+		"""
+		Reloads the file if it changed since the last parse.
+		
+		If full is True, the file is also read if the entries have
+		been restored from a snapshot, and thus lack the passwords.
+		"""
+		
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			self.stamp = None
+			self.entries = new_table()
+			self.partial = False
+			return
+		
+		stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+		if stamp == self.stamp and not (full and self.partial):
+			return
+		
+		entries = new_table()
+		with open(self.path, "r") as f:
+			for line in f:
+				line = line.rstrip("\n")
+				if not ":" in line:
+					continue
+				
+				# The last entry of an user wins
+				row = entries.find(line.split(":", 1)[0])
+				if row >= 0:
+					entries.remove(row)
+				
+				entries.add_line(line)
+		
+		self.entries = entries
+		self.stamp = stamp
+		self.partial = False
+	
+	def dump(self):
+		"""
+		Returns the entries without their passwords, suitable for the
+		snapshot cache.
+		
+		Passwords are never dumped.
+		"""
+		
+		self.validate(full=False)
+		
+		aging = new_table()
+		for entry in self.entries.values():
+			if len(entry) > PASSWORD:
+				entry[PASSWORD] = ""
+			
+			aging.add_line(format_entry(entry))
+		
+		return self.stamp, aging.dump()
+	
+	def restore(self, state):
+		"""
+		Restores a state returned by dump(). If the file changed in the
+		meantime, it will be parsed again on the next lookup.
+		"""
+		
+		stamp, aging = state
+		
+		self.entries = new_table()
+		self.entries.restore(aging)
+		self.stamp = tuple(stamp) if stamp is not None else None
+		self.partial = True
+	
+	def get(self, user):
+		"""
+		Returns the list of shadow fields of the given user, or None.
+		"""
+		
+		self.validate()
+		
+		return self.entries.get(user)
+	
+	def get_field(self, user, field):
+		"""
+		Returns the given field of the user's entry, or None if either
+		the entry or the field is missing.
+		"""
+		
+		# The aging fields are available from a snapshot as well
+		self.validate(full=not LAST_CHANGE <= field <= EXPIRE_DATE)
+		
+		entry = self.entries.get(user)
+		if entry is None or len(entry) <= field:
+			return None
+		
+		return entry[field]
+	
+	def get_number(self, user, field):
+		"""
+		Like get_field(), but converts the field to an integer.
+		Empty fields are returned as None.
+		"""
+		
+		value = self.get_field(user, field)
+		if not value:
+			return None
+		
+		try:
+			return int(value)
+		except ValueError:
+			return None
+
+shadow_cache = ShadowCache("/etc/shadow")
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+import sys
+
+import mmap
+import marshal
+import struct
+
+CACHE_DIR = "/var/cache/usersd"
+CACHE_FILE = os.path.join(CACHE_DIR, "accounts.cache")
+
+# Bump every time the layout of the cached data changes
+CACHE_VERSION = 6
+
+# File header: magic, version, length of the layout that follows
+HEADER = struct.Struct("<8sII")
+MAGIC = b"usersd\0\0"
+
+# Buffers are aligned to this many bytes in the file
+ALIGNMENT = 8
+
+def file_stamp(path):
+	"""
+	Returns an (inode, mtime, size) tuple identifying the current
+	version of the given file, or None if it doesn't exist.
+	"""
+	
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	
+	return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def split_buffers(data, buffers):
+	"""
+	Returns a copy of data (nested tuples, lists and dictionaries) with
+	every bytes object appended to buffers and replaced by an
+	(Ellipsis, index) tuple.
+	"""
+	
+	if isinstance(data, bytes):
+		buffers.append(data)
+		return (..., len(buffers) - 1)
+	elif isinstance(data, (tuple, list)):
+		return type(data)(split_buffers(item, buffers) for item in data)
+	elif isinstance(data, dict):
+		return {key : split_buffers(value, buffers) for key, value in data.items()}
+	
+	return data
+
+def join_buffers(data, buffers):
+	"""
+	The opposite of split_buffers().
+	"""
+	
+	if isinstance(data, tuple) and len(data) == 2 and data[0] is ...:
+		return buffers[data[1]]
+	elif isinstance(data, (tuple, list)):
+		return type(data)(join_buffers(item, buffers) for item in data)
+	elif isinstance(data, dict):
+		return {key : join_buffers(value, buffers) for key, value in data.items()}
+	
+	return data
+
+class SnapshotCache:
+	"""
+	A persistent, binary copy of the parsed account database.
+	
+	The file starts with a small header and a marshalled layout: the
+	key describing the source files the data has been built from, the
+	structure of the data and the offsets of its buffers. The buffers
+	(the packed tables and indexes, see usersd.packed) follow, as they
+	are in memory.
+	
+	The file is memory-mapped when loaded, and buffers are returned as
+	memoryviews of the mapping: nothing is read until it's used, and a
+	stale cache is recognized by reading only the layout.
+	The file is readable only by root.
+	"""
+	
+	def __init__(self, path):
+		"""
+		Initializes the cache.
+		"""
+		
+		self.path = path
+	
+	def load(self, key):
+		"""
+		Returns the cached data, or None if there is no cache or if it
+		has been built from a source different from key.
+		
+		Buffers are returned as read-only memoryviews: the file stays
+		mapped as long as any of them is referenced.
+		"""
+		
+		try:
+			fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC | os.O_NOFOLLOW)
+		except OSError:
+			return None
+		
+		try:
+			st = os.fstat(fd)
+			if st.st_uid != os.geteuid() or st.st_mode & 0o077 or st.st_size < HEADER.size:
+				# Don't trust files that others could have written
+				return None
+			
+			mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+		except OSError:
+			return None
+		finally:
+			os.close(fd)
+		
+		view = memoryview(mapped)
+		try:
+			magic, version, length = HEADER.unpack_from(view)
+			if magic != MAGIC or version != CACHE_VERSION:
+				return None
+			
+			cached_key, layout, offsets = marshal.loads(
+				view[HEADER.size:HEADER.size + length]
+			)
+			if cached_key != key:
+				return None
+			
+			buffers = []
+			for offset, size in offsets:
+				if offset + size > len(view):
+					return None
+				
+				buffers.append(view[offset:offset + size])
+			
+			return join_buffers(layout, buffers)
+		except (EOFError, ValueError, TypeError, struct.error):
+			return None
+		finally:
+			# The mapping is closed once the returned buffers are gone
+			view.release()
+	
+	def save(self, key, data):
+		"""
+		Stores data, built from the source described by key.
+		
+		data is made of tuples, lists, dictionaries and what marshal
+		supports. bytes objects in it are stored as buffers, and come
+		back as memoryviews (see load()).
+		
+		The file is replaced atomically. Failures are not fatal, as the
+		cache is only an optimization.
+		"""
+		
+		directory = os.path.dirname(self.path)
+		tmp = self.path + "+"
+		
+		try:
+			buffers = []
+			layout = split_buffers(data, buffers)
+			
+			# The offsets depend on the size of the layout, which
+			# depends on the offsets: grow the room left for the layout
+			# until it fits, padding what's left
+			room = 0
+			while True:
+				position = HEADER.size + room
+				offsets = []
+				for buffer in buffers:
+					position += -position % ALIGNMENT
+					offsets.append((position, len(buffer)))
+					position += len(buffer)
+				
+				header = marshal.dumps((key, layout, offsets))
+				if len(header) <= room:
+					break
+				
+				room = len(header)
+			
+			os.makedirs(directory, mode=0o700, exist_ok=True)
+			
+			fd = os.open(
+				tmp,
+				os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC | os.O_NOFOLLOW,
+				0o600
+			)
+			with os.fdopen(fd, "wb") as f:
+				f.write(HEADER.pack(MAGIC, CACHE_VERSION, len(header)))
+				f.write(header)
+				for (offset, size), buffer in zip(offsets, buffers):
+					f.write(bytes(offset - f.tell()))
+					f.write(buffer)
+				
+				f.flush()
+				os.fsync(f.fileno())
+			
+			os.rename(tmp, self.path)
+		except (OSError, ValueError) as e:
+			print("usersd: unable to write the snapshot cache: %s" % e, file=sys.stderr)
+			try:
+				os.unlink(tmp)
+			except OSError:
+				pass
+
+snapshot_cache = SnapshotCache(CACHE_FILE)
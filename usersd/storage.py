@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import sys
+
+import usersd.fileio
+
+from usersd.common import Deferred, MainLoop
+from usersd.config import config
+
+from gi.repository import GLib
+
+# Milliseconds to wait for other changes before committing
+COMMIT_DELAY = config.get_int("COMMIT_DELAY", 50)
+
+class Storage:
+	"""
+	Stages changes to the account files, and commits them in groups.
+	
+	Every change made in a COMMIT_DELAY window is written with a single
+	transaction: the lock on the account files is taken once and every
+	touched file is written once to a synced temporary copy, that is
+	then renamed over the original.
+	
+	Changes are applied one at a time, in order: a change that can't
+	be applied (e.g. a new entry that already exists) fails on its own,
+	without touching the files, while the others are written anyway.
+	"""
+	
+	def __init__(self, delay):
+		"""
+		Initializes the storage.
+		"""
+		
+		self.delay = delay
+		
+		# (changes, Deferred) tuples, in staging order
+		self.staged = []
+		
+		self.commit_timeout = 0
+		
+		# Ends the activity of the pending commit (see LoopWithTimeout)
+		self.end_activity = None
+	
+	def stage(self, changes):
+		"""
+		Stages the given changes, a dictionary with file paths as keys
+		and, as values, dictionaries with entry names as keys and edits
+		(see fileio.apply_entries()) as values.
+		
+		Returns a Deferred that completes once the changes have been
+		committed.
+		"""
+		
+		deferred = Deferred()
+		self.staged.append((changes, deferred))
+		
+		if not self.commit_timeout:
+			self.end_activity = MainLoop.begin()
+			self.commit_timeout = GLib.timeout_add(
+				self.delay,
+				self.on_commit_timeout_elapsed
+			)
+		
+		return deferred
+	
+	def on_commit_timeout_elapsed(self):
+		"""
+		Fired when it's time to commit the staged changes.
+		"""
+		
+		self.commit_timeout = 0
+		self.commit()
+		
+		return False
+	
+	def commit(self):
+		"""
+		Commits the staged changes right away.
+		"""
+		
+		if self.commit_timeout:
+			GLib.source_remove(self.commit_timeout)
+			self.commit_timeout = 0
+		
+		if self.end_activity is not None:
+			self.end_activity()
+			self.end_activity = None
+		
+		staged, self.staged = self.staged, []
+		
+		if not staged:
+			return
+		
+		try:
+			with usersd.fileio.passwd_lock():
+				errors = usersd.fileio.write_changes(
+					[changes for changes, deferred in staged]
+				)
+		except Exception as e:
+			print("usersd: unable to commit the account changes: %s" % e, file=sys.stderr)
+			errors = [e] * len(staged)
+		
+		for (changes, deferred), error in zip(staged, errors):
+			deferred.complete(error=error)
+
+storage = Storage(COMMIT_DELAY)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import bisect
+
+import usersd.packed
+import usersd.records
+
+from usersd.intervals import IntervalSet
+
+class AccountStore:
+	"""
+	The in-memory account database.
+	
+	Users and groups are stored packed (see usersd.packed): every
+	account is a line in a bytearray, and the indexes by UID/GID, by name
+	and from members to groups are arrays of row numbers, so that the
+	store takes about a tenth of the memory of per-account objects.
+	Records are parsed again when looked up.
+	Indexes are updated incrementally, so that lookups never need to
+	scan the whole database.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the store.
+		"""
+		
+		# name -> PasswdRecord
+		self.users = usersd.packed.PackedTable(
+			usersd.records.parse_passwd_entry,
+			usersd.records.format_passwd_record
+		)
+		
+		# Users sorted by name, by (UID, name) and by (primary GID, name)
+		self.users_by_name = usersd.packed.NameIndex(self.users)
+		self.uid_index = usersd.packed.NumberIndex(self.users.key)
+		self.gid_index = usersd.packed.NumberIndex(self.users.key)
+		
+		# UID -> PasswdRecord. If several users share an UID, the
+		# first one added wins.
+		self.users_by_uid = usersd.packed.PrimaryView(self.users, self.uid_index)
+		
+		# name -> GroupRecord
+		self.groups = usersd.packed.PackedTable(
+			usersd.records.parse_group_entry,
+			usersd.records.format_group_record
+		)
+		
+		# Groups sorted by GID
+		self.group_gid_index = usersd.packed.NumberIndex()
+		
+		# GID -> GroupRecord, like users_by_uid
+		self.groups_by_gid = usersd.packed.PrimaryView(self.groups, self.group_gid_index)
+		
+		# (hash of the member name, group row) pairs, to find the groups
+		# of an user
+		self.member_index = usersd.packed.NumberIndex()
+		
+		# Used (or reserved) UIDs and GIDs, for the allocator
+		self.used_uids = IntervalSet()
+		self.used_gids = IntervalSet()
+		
+		# IDs handed out by reserve_ids() and not yet used
+		self.reserved_uids = set()
+		self.reserved_gids = set()
+		
+		# Bumped on every change
+		self.generation = 0
+	
+	def dump(self):
+		"""
+		Returns the content of the store as buffers and counters, for
+		the snapshot cache (see usersd.snapshot).
+		
+		Nothing needs to be parsed or sorted again to restore it.
+		"""
+		
+		uid_index = self.uid_index.dump()
+		group_gid_index = self.group_gid_index.dump()
+		
+		# Reserved IDs are not dumped
+		used_uids = IntervalSet(self.uid_index.numbers)
+		used_gids = IntervalSet(self.group_gid_index.numbers)
+		
+		return (
+			self.users.dump(),
+			self.users_by_name.dump(),
+			uid_index,
+			self.gid_index.dump(),
+			self.groups.dump(),
+			group_gid_index,
+			self.member_index.dump(),
+			used_uids.dump(),
+			used_gids.dump()
+		)
+	
+	def restore(self, state):
+		"""
+		Replaces the content of the store with the given state, as
+		returned by dump().
+		"""
+		
+		users, by_name, uids, gids, groups, group_gids, members, used_uids, used_gids = state
+		
+		self.users.restore(users)
+		self.users_by_name.restore(by_name)
+		self.uid_index.restore(uids)
+		self.gid_index.restore(gids)
+		
+		self.groups.restore(groups)
+		self.group_gid_index.restore(group_gids)
+		self.member_index.restore(members)
+		
+		self.used_uids = IntervalSet()
+		self.used_uids.restore(used_uids)
+		self.used_gids = IntervalSet()
+		self.used_gids.restore(used_gids)
+		self.reserved_uids = set()
+		self.reserved_gids = set()
+		
+		self.generation += 1
+	
+	def add_user(self, record):
+		"""
+		Adds (or replaces) the given PasswdRecord.
+		Raises ValueError if it can't be stored (see PackedTable.pack()).
+		"""
+		
+		# Refuse records that can't be stored before removing anything
+		line = self.users.pack(record)
+		
+		if record.user in self.users:
+			self.remove_user(record.user)
+		
+		row = self.users.add_line(line)
+		self.users_by_name.add(row)
+		self.uid_index.add(record.uid, row)
+		self.gid_index.add(record.gid, row)
+		
+		self.used_uids.add(record.uid)
+		self.reserved_uids.discard(record.uid)
+		
+		self.generation += 1
+	
+	def remove_user(self, name):
+		"""
+		Removes the given user from the store.
+		
+		Returns the removed PasswdRecord, or None.
+		"""
+		
+		row = self.users.find(name)
+		if row < 0:
+			return None
+		
+		record = self.users.record(row)
+		
+		self.users_by_name.remove(row)
+		self.uid_index.remove(record.uid, row)
+		self.gid_index.remove(record.gid, row)
+		self.users.remove(row)
+		
+		if self.uid_index.first(record.uid) < 0:
+			self.used_uids.remove(record.uid)
+		
+		if self.users.needs_compaction():
+			remap = self.users.compact()
+			for index in (self.users_by_name, self.uid_index, self.gid_index):
+				index.remap(remap)
+		
+		self.generation += 1
+		
+		return record
+	
+	def get_user(self, name):
+		"""
+		Returns the PasswdRecord of the given username, or None.
+		"""
+		
+		return self.users.get(name)
+	
+	def get_user_by_uid(self, uid):
+		"""
+		Returns the PasswdRecord of the given UID, or None.
+		"""
+		
+		return self.users_by_uid.get(uid)
+	
+	def iter_users_by_name(self, after="", prefix=""):
+		"""
+		Yields the PasswdRecords of the users whose name starts with
+		prefix, sorted by name, starting after the given name.
+		"""
+		
+		prefix = usersd.packed.encode(prefix)
+		
+		if after and usersd.packed.encode(after) >= prefix:
+			i = self.users_by_name.bisect(usersd.packed.encode(after), right=True)
+		else:
+			i = self.users_by_name.bisect(prefix)
+		
+		rows = self.users_by_name.rows
+		while i < len(rows):
+			if not self.users.key(rows[i]).startswith(prefix):
+				break
+			
+			yield self.users.record(rows[i])
+			i += 1
+	
+	def iter_users_by_uid(self, after=None, uid_min=0, uid_max=None):
+		"""
+		Yields the PasswdRecords of the users with uid_min <= UID <= uid_max,
+		sorted by UID, starting after the given (UID, username) tuple.
+		"""
+		
+		if uid_max is None:
+			uid_max = 0xffffffff
+		
+		i, j = self.uid_index.range(uid_min, uid_max)
+		
+		if after is not None and after >= (uid_min,):
+			uid, name = after
+			i = self.uid_index.range(uid, uid_max)[0]
+			
+			# Skip the users with the cursor UID, up to its name
+			name = usersd.packed.encode(name)
+			while (
+				i < j and
+				self.uid_index.numbers[i] == uid and
+				self.users.key(self.uid_index.rows[i]) <= name
+			):
+				i += 1
+		
+		while i < j:
+			yield self.users.record(self.uid_index.rows[i])
+			i += 1
+	
+	def iter_users_in_group(self, group, after=None, by_name=False):
+		"""
+		Yields the PasswdRecords of the users in the given GroupRecord,
+		either as members or by primary GID, starting after the given
+		cursor.
+		
+		Users are sorted by name if by_name is True (after is then an
+		username), by (UID, username) otherwise.
+		"""
+		
+		rows = set(self.gid_index.find(group.gid))
+		for member in group.members:
+			row = self.users.find(member)
+			if row >= 0:
+				rows.add(row)
+		
+		if by_name:
+			key = lambda record: record.user
+		else:
+			key = lambda record: (record.uid, record.user)
+		
+		records = sorted(map(self.users.record, rows), key=key)
+		
+		i = 0
+		if after is not None:
+			i = bisect.bisect_right([key(record) for record in records], after)
+		
+		for record in records[i:]:
+			yield record
+	
+	def find_free_ids(self, uid_min, uid_max, gid_min, gid_max):
+		"""
+		Returns a (UID, GID) tuple of free IDs in the given ranges.
+		
+		Like useradd, the same number is used for both, if possible.
+		Raises an Exception if there are no free IDs.
+		"""
+		
+		# Look for a number free in both sets, jumping over the used
+		# intervals of each one in turn
+		candidate = max(uid_min, gid_min)
+		maximum = min(uid_max, gid_max)
+		while candidate is not None:
+			candidate = self.used_uids.first_free(candidate, maximum)
+			if candidate is None:
+				break
+			
+			gid = self.used_gids.first_free(candidate, maximum)
+			if gid == candidate:
+				return candidate, candidate
+			
+			candidate = gid
+		
+		uid = self.used_uids.first_free(uid_min, uid_max)
+		gid = self.used_gids.first_free(gid_min, gid_max)
+		
+		if uid is None or gid is None:
+			raise Exception("No free IDs available")
+		
+		return uid, gid
+	
+	def reserve_ids(self, uid, gid):
+		"""
+		Marks the given IDs as used, until release_ids() is called or
+		an account actually uses them.
+		"""
+		
+		if not uid in self.used_uids:
+			self.used_uids.add(uid)
+			self.reserved_uids.add(uid)
+		
+		if not gid in self.used_gids:
+			self.used_gids.add(gid)
+			self.reserved_gids.add(gid)
+	
+	def release_ids(self, uid, gid):
+		"""
+		Releases IDs reserved by reserve_ids() and not used yet.
+		"""
+		
+		if uid in self.reserved_uids:
+			self.reserved_uids.discard(uid)
+			self.used_uids.remove(uid)
+		
+		if gid in self.reserved_gids:
+			self.reserved_gids.discard(gid)
+			self.used_gids.remove(gid)
+	
+	def add_group(self, record):
+		"""
+		Adds (or replaces) the given GroupRecord.
+		Raises ValueError if it can't be stored (see PackedTable.pack()).
+		"""
+		
+		line = self.groups.pack(record)
+		
+		if record.group in self.groups:
+			self.remove_group(record.group)
+		
+		row = self.groups.add_line(line)
+		self.group_gid_index.add(record.gid, row)
+		for member in set(record.members):
+			self.member_index.add(self._member_hash(member), row)
+		
+		self.used_gids.add(record.gid)
+		self.reserved_gids.discard(record.gid)
+		
+		self.generation += 1
+	
+	def remove_group(self, name):
+		"""
+		Removes the given group from the store.
+		
+		Returns the removed GroupRecord, or None.
+		"""
+		
+		row = self.groups.find(name)
+		if row < 0:
+			return None
+		
+		record = self.groups.record(row)
+		
+		self.group_gid_index.remove(record.gid, row)
+		for member in set(record.members):
+			self.member_index.remove(self._member_hash(member), row)
+		self.groups.remove(row)
+		
+		if self.group_gid_index.first(record.gid) < 0:
+			self.used_gids.remove(record.gid)
+		
+		if self.groups.needs_compaction():
+			remap = self.groups.compact()
+			for index in (self.group_gid_index, self.member_index):
+				index.remap(remap)
+		
+		self.generation += 1
+		
+		return record
+	
+	def get_group(self, name):
+		"""
+		Returns the GroupRecord of the given group name, or None.
+		"""
+		
+		return self.groups.get(name)
+	
+	def get_group_by_gid(self, gid):
+		"""
+		Returns the GroupRecord of the given GID, or None.
+		"""
+		
+		return self.groups_by_gid.get(gid)
+	
+	def get_groups_for_user(self, name):
+		"""
+		Returns a tuple containing the names of every group the given
+		user is member of.
+		"""
+		
+		groups = []
+		for row in self.member_index.find(self._member_hash(name)):
+			# Different names may have the same hash
+			record = self.groups.record(row)
+			if name in record.members:
+				groups.append(record.group)
+		
+		return tuple(groups)
+	
+	@staticmethod
+	def _member_hash(name):
+		"""
+		Returns the hash of the given member name, for member_index.
+		"""
+		
+		return usersd.packed.name_hash(usersd.packed.encode(name))
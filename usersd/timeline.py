@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+# NOTE: keep this module lightweight, as it is imported before everything
+# else to measure the startup time.
+
+import os
+import sys
+
+import time
+
+class Timeline:
+	"""
+	Records the time spent in every startup phase, from the exec() of
+	the daemon onwards.
+	
+	Nothing is recorded unless the USERSD_TIMELINE environment variable
+	is set.
+	"""
+	
+	def __init__(self, enabled):
+		"""
+		Initializes the timeline.
+		"""
+		
+		self.enabled = enabled
+		self.phases = []
+		
+		if not self.enabled:
+			return
+		
+		self.start = self.last = self.get_exec_time()
+	
+	@staticmethod
+	def get_exec_time():
+		"""
+		Returns the time our process has been started, on the
+		CLOCK_BOOTTIME clock.
+		"""
+		
+		now = time.clock_gettime(time.CLOCK_BOOTTIME)
+		
+		try:
+			with open("/proc/self/stat", "r") as f:
+				stat = f.read()
+		except OSError:
+			return now
+		
+		# The start time is the 22nd field, in clock ticks since boot
+		start_time = int(stat[stat.rindex(")") + 2:].split(" ")[19])
+		
+		return min(now, start_time / os.sysconf("SC_CLK_TCK"))
+	
+	def mark(self, phase):
+		"""
+		Marks the end of the given phase.
+		"""
+		
+		if not self.enabled:
+			return
+		
+		now = time.clock_gettime(time.CLOCK_BOOTTIME)
+		self.phases.append((phase, now - self.last))
+		self.last = now
+	
+	def report(self):
+		"""
+		Prints the timeline to stderr.
+		"""
+		
+		if not self.enabled:
+			return
+		
+		for phase, elapsed in self.phases:
+			print("usersd: %-28s %9.2f ms" % (phase, elapsed * 1000), file=sys.stderr)
+		
+		print(
+			"usersd: %-28s %9.2f ms" % ("total", (self.last - self.start) * 1000),
+			file=sys.stderr
+		)
+
+timeline = Timeline(bool(os.environ.get("USERSD_TIMELINE")))
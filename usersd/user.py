@@ -21,29 +21,70 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
+import os
+import sys
+
+import dbus
+
 import usersd.objects
-import subprocess
+import usersd.backends
+import usersd.records
 
-from usersd.common import is_authorized, get_user
+from usersd.common import MainLoop, call_if_authorized, get_user
 
 from usersd.common import Gtk, usersd_ui
 
-from passlib.context import CryptContext
+from usersd.shadow import shadow_cache
+import usersd.shadow
+
+import usersd.hashing
+from usersd.hashing import hashing_executor
+from usersd.process import command_runner
 
-pwd_context = CryptContext(schemes=[
-	"md5_crypt",
-	"bcrypt",
-	"sha1_crypt",
-	"sun_md5_crypt",
-	"sha256_crypt",
-	"sha512_crypt",
-])
+# The properties that can be changed through Set() and SetMany()
+WRITABLE_PROPERTIES = (
+	"gid",
+	"fullname",
+	"address",
+	"phone",
+	"other",
+	"home",
+	"shell",
+)
 
-default_encryption = "sha512_crypt"
+# The properties users can change on their own account without
+# authenticating (the shell only if listed in /etc/shells)
+SELF_SERVICE_PROPERTIES = (
+	"fullname",
+	"address",
+	"phone",
+	"other",
+)
+
+# The list of valid login shells
+SHELLS = "/etc/shells"
 
 MIN_PASSWORD_LENGTH = 4
 USERNAME_ALLOWED_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789.-"
 
+def get_valid_shells():
+	"""
+	Returns a set containing the shells listed in /etc/shells.
+	"""
+	
+	shells = set()
+	
+	try:
+		with open(SHELLS, "r") as f:
+			for line in f:
+				line = line.strip()
+				if line and not line.startswith("#"):
+					shells.add(line)
+	except OSError:
+		pass
+	
+	return shells
+
 class User(usersd.objects.BaseObject):
 	"""
 	The User object
@@ -63,30 +104,30 @@ class User(usersd.objects.BaseObject):
 	]
 	polkit_policy = "org.semplicelinux.usersd.modify-user"
 	
+	# The object is a view over its PasswdRecord
+	user = usersd.objects.record_field("user")
+	password = usersd.objects.record_field("password")
+	uid = usersd.objects.record_field("uid")
+	gid = usersd.objects.record_field("gid")
+	fullname = usersd.objects.record_field("fullname")
+	address = usersd.objects.record_field("address")
+	phone = usersd.objects.record_field("phone")
+	other = usersd.objects.record_field("other")
+	home = usersd.objects.record_field("home")
+	shell = usersd.objects.record_field("shell")
+	
 	@staticmethod
-	def add(user, fullname, shell="/bin/bash"):
+	def validate_username(user):
 		"""
-		This static method adds a new user, using the useradd command.
-		The arguments are self-explanatory.
-		
-		NOTE: the password will *NOT* encrypted, so you have to encrypt
-		it *BEFORE* calling this method.
-		
-		Returns True if the user has been created successfully, False
-		if not.
+		Raises an Exception if the given username is not valid.
 		"""
 		
-		if subprocess.call((
-			"/usr/sbin/useradd",
-			user,
-			"-m", # Create home directory
-			"-U", # Create user group
-			"-c", "%s,,,," % fullname, # Fullname
-			"-s", shell, # Shell
-		)) == 0:
-			return True
-		else:
-			return False
+		if not user or user.startswith(("-", ".")):
+			raise Exception("The username %r is not valid" % user)
+		
+		for char in user:
+			if char not in USERNAME_ALLOWED_CHARS:
+				raise Exception("The username must not contain %r" % char)
 	
 	@staticmethod
 	def add_graphically(sender, service, display, groups=[]):
@@ -106,6 +147,9 @@ class User(usersd.objects.BaseObject):
 		# Connect response
 		add_user_dialog.connect("response", User.on_add_user_dialog_response, add_user_dialog, service, groups)
 		
+		# Don't quit while the dialog is open
+		add_user_dialog.connect("destroy", MainLoop.begin())
+		
 		add_user_dialog.show()
 	
 	@staticmethod
@@ -124,7 +168,7 @@ class User(usersd.objects.BaseObject):
 			username = parent.objects.username.get_text()
 			
 			# Verify that the specified username is unique
-			if username in service._users:
+			if service.store.get_user(username) is not None:
 				parent.show_error(_("The username '%s' is already taken.") % username)
 				return False
 			
@@ -147,96 +191,167 @@ class User(usersd.objects.BaseObject):
 				parent.show_error(_("The password should be of at least %s characters.") % MIN_PASSWORD_LENGTH)
 				return False
 			
-			parent.hide_error()
-						
-			# Add the user
-			if not User.add(username, parent.objects.fullname.get_text()):
-				parent.show_error(_("Something went wrong while creating the new user."))
+			# Verify the full name
+			try:
+				User.validate_property("fullname", parent.objects.fullname.get_text())
+			except Exception:
+				parent.show_error(_("The full name must not contain colons, commas or newlines."))
 				return False
 			
-			# Add the user to the specified default groups
-			service.AddGroupsToUser(username, groups)
+			parent.hide_error()
 			
-			# Refresh
-			service._generate_users()
+			def on_user_created(result, error):
+				if error is not None:
+					dialog.set_sensitive(True)
+					parent.show_error(_("Something went wrong while creating the new user."))
+					return
+				
+				dialog.destroy()
 			
-			# Lookup for the newly created user
-			if not username in service._users:
-				parent.show_error(_("Something went wrong while creating the new user."))
-				return False
+			def on_password_hashed(password_hash, error):
+				if error is not None:
+					on_user_created(None, error)
+					return
+				
+				# Add the user, already in the specified default groups
+				try:
+					deferred = service.create_user(
+						username,
+						parent.objects.fullname.get_text(),
+						password_hash=password_hash,
+						groups=groups
+					)
+				except Exception as e:
+					on_user_created(None, e)
+					return
+				
+				deferred.add_callback(on_user_created)
 			
-			# Set password
-			service._users[username].change_password(parent.objects.password.get_text())
+			# Hashing happens outside the main loop, so block the dialog
+			# until we are done
+			dialog.set_sensitive(False)
 			
+			hashing_executor.submit(
+				usersd.hashing.hash_password,
+				(parent.objects.password.get_text(),),
+				on_password_hashed
+			)
+			
+			return False
+		
 		# Destroy the window
 		dialog.destroy()
 	
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.user",
 		in_signature="b",
-		out_signature="b",
+		out_signature="o",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def DeleteUser(self, with_home, sender, connection):
+	def DeleteUser(self, with_home, sender, connection, reply_handler, error_handler):
 		"""
 		Deletes the user.
 		If with_home is True, the user's home directory will be deleted as well.
 		
-		Returns True if the user has been deleted successfully, False if not.
+		Returns right away the object path of a Job (see usersd.job)
+		that tracks the deletion: its Finished signal tells whether the
+		account and the home directory have been removed successfully.
 		"""
 		
 		if get_user(sender) == self.uid:
 			# The sender can't remove itself!
 			raise Exception("The sender can't remove itself!")
 		
-		if self.polkit_policy and not is_authorized(
+		if not self.service.backend.writable:
+			raise usersd.backends.ReadOnlyBackendError()
+		
+		call_if_authorized(
 			sender,
-			connection,
 			self.polkit_policy,
-			True # user interaction
-		):
-			raise Exception("Not authorized")
+			reply_handler,
+			error_handler,
+			self.delete,
+			with_home
+		)
+	
+	def delete(self, with_home):
+		"""
+		Deletes the user, using the deluser command.
 		
-		deluser_call = ["/usr/sbin/deluser", self.user]
+		The user is removed from the store (and from the bus) right away,
+		while deluser and the removal of the home directory run in the
+		background. Returns the object path of the Job that tracks them.
+		"""
 		
-		# deluser is picky with blank arguments, so we can't put an ""
-		# in the place of --remove-home
-		if with_home:
-			deluser_call.append("--remove-home")
+		service = self.service
+		record = self.record
 		
-		if subprocess.call(deluser_call) == 0:
-			self.service.remove_from_user_list(self.user)
-			return True
-		else:
-			return False
+		job = service.create_job()
+		
+		record, groups = service.remove_from_user_list(record.user)
+		
+		def on_deluser_finished(result, error):
+			if error is not None:
+				print("usersd: unable to delete %s: %s" % (record.user, error), file=sys.stderr)
+				
+				# Still there
+				service.restore_user(record, groups)
+				service.finish_job(job, False)
+			elif with_home and os.path.isdir(record.home) and not any(
+				other.home == record.home for other in service.store.users.values()
+			):
+				# The home directory is removed by us, with progress
+				# reporting (and not shared with other users)
+				service.remove_home(job, record.home)
+			else:
+				service.finish_job(job, True)
+		
+		command_runner.run(
+			["/usr/sbin/deluser", record.user]
+		).add_callback(on_deluser_finished)
+		
+		return dbus.ObjectPath(job.path)
 
 	@usersd.objects.BaseObject.outside_timeout(
 		"org.semplicelinux.usersd.user",
 		in_signature="s",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def ChangePassword(self, display, sender, connection):
+	def ChangePassword(self, display, sender, connection, reply_handler, error_handler):
 		"""
-		This method returns the object path for the given user.
+		This method shows the user interface that permits to change the
+		user's password.
 		"""
 		
-		if not get_user(sender) in self.set_privileges and (self.polkit_policy and not is_authorized(
+		self.call_authorized(
 			sender,
-			connection,
-			self.polkit_policy,
-			True # user interaction
-		)):
-			raise Exception("Not authorized")
+			reply_handler,
+			error_handler,
+			self.show_change_password_dialog,
+			display,
+			get_user(sender)
+		)
+	
+	def show_change_password_dialog(self, display, uid):
+		"""
+		Shows the change password dialog on the given display, as the
+		given UID.
+		"""
 		
 		# Create changepassword dialog
-		usersd_ui._initialize(display, get_user(sender), self.service.get_uids_with_users())
+		usersd_ui._initialize(display, uid, self.service.get_uids_with_users())
 		change_password_dialog = usersd_ui.ChangePasswordDialog(self.is_locked())
 		
 		# Connect response
 		change_password_dialog.connect("response", self.on_change_password_dialog_response, change_password_dialog)
 		
+		# Don't quit while the dialog is open
+		change_password_dialog.connect("destroy", MainLoop.begin())
+		
 		change_password_dialog.show()
 
 	def on_change_password_dialog_response(self, dialog, response, parent):
@@ -245,26 +360,49 @@ class User(usersd.objects.BaseObject):
 		"""
 		
 		if response == Gtk.ResponseType.OK:
-			# Verify old password
-			if not parent.locked and not self.verify_password(parent.objects.old_password.get_text()):
-				parent.show_error(_("Current password is not correct."))
-				return False
+			new_password = parent.objects.new_password.get_text()
 			
 			# Verify new passwords
-			if not parent.objects.new_password.get_text() == parent.objects.confirm_new_password.get_text():
+			if not new_password == parent.objects.confirm_new_password.get_text():
 				parent.show_error(_("The new passwords do not match."))
 				return False
 			
 			# Check password length
-			if not len(parent.objects.new_password.get_text()) >= MIN_PASSWORD_LENGTH:
+			if not len(new_password) >= MIN_PASSWORD_LENGTH:
 				parent.show_error(_("The new password should be of at least %s characters.") % MIN_PASSWORD_LENGTH)
 				return False
 			
-			parent.hide_error()
+			def on_password_verified(verified):
+				if not verified:
+					dialog.set_sensitive(True)
+					parent.show_error(_("Current password is not correct."))
+					return
+				
+				parent.hide_error()
+				
+				def on_password_changed(result, error):
+					if error is not None:
+						dialog.set_sensitive(True)
+						parent.show_error(_("Something went wrong while changing the password."))
+						return
+					
+					dialog.destroy()
+				
+				# Finally set password, and destroy the window when done
+				self.change_password(new_password, on_password_changed)
 			
-			# Finally set password
-			self.change_password(parent.objects.new_password.get_text())
+			# Hashing happens outside the main loop, so block the dialog
+			# until we are done
+			dialog.set_sensitive(False)
 			
+			# Verify old password
+			if parent.locked:
+				on_password_verified(True)
+			else:
+				self.verify_password(parent.objects.old_password.get_text(), on_password_verified)
+			
+			return False
+		
 		# Destroy the window
 		dialog.destroy()
 	
@@ -274,111 +412,283 @@ class User(usersd.objects.BaseObject):
 		False otherwise.
 		"""
 		
-		status = True
-		with open("/etc/shadow", "r") as f:
-			for line in f:
-				splt = line.split(":")
-				if splt[0] == self.user:
-					status = (splt[1] == "!")
-					break
+		password = shadow_cache.get_field(self.user, usersd.shadow.PASSWORD)
 		
-		splt = None
-		return status
+		return password is None or password == "!"
 
-	def verify_password(self, oldpassword):
+	def verify_password(self, oldpassword, callback):
 		"""
-		Returns True if the password is verified, False otherwise.
+		Verifies the password in the hashing pool.
+		
+		callback is called with True if the password is verified,
+		False otherwise.
 		"""
 		
-		status = False
-		with open("/etc/shadow", "r") as f:
-			for line in f:
-				splt = line.split(":")
-				if splt[0] == self.user:
-					status = pwd_context.verify(oldpassword, splt[1])
-					break
+		password = shadow_cache.get_field(self.user, usersd.shadow.PASSWORD)
+		if password is None:
+			callback(False)
+			return
 		
-		splt = None
-		return status
+		hashing_executor.submit(
+			usersd.hashing.verify_password,
+			(oldpassword, password),
+			lambda result, error: callback(error is None and result)
+		)
 	
-	def change_password(self, newpassword):
+	def change_password(self, newpassword, callback=None):
 		"""
 		Changes the password.
+		
+		The new password is hashed in the hashing pool. If specified,
+		callback is called with the (result, error) tuple once the
+		password has been stored, or as soon as something fails.
 		"""
 		
-		with open("/etc/shadow", "r") as f:
-			lines = f.readlines()
+		hashing_executor.submit(
+			usersd.hashing.hash_password,
+			(newpassword,),
+			lambda result, error: self.on_password_hashed(result, error, callback)
+		)
+	
+	def on_password_hashed(self, password_hash, error, callback):
+		"""
+		Fired when the new password has been hashed.
+		"""
 		
-		with open("/etc/shadow", "w") as f:
-			for line in lines:
-				splt = line.split(":")
-				if splt[0] == self.user:
-					# Change
-					splt[1] = pwd_context.encrypt(newpassword, scheme=default_encryption)
-				
-				f.write(":".join(splt))
+		if error is None:
+			try:
+				deferred = self.service.backend.write_password(self.user, password_hash)
+			except Exception as e:
+				error = e
+		
+		if error is not None:
+			print("usersd: unable to change the password of %s: %s" % (self.user, error), file=sys.stderr)
+			if callback:
+				callback(None, error)
+			return
+		
+		if callback:
+			deferred.add_callback(callback)
+	
+	@property
+	def last_change(self):
+		"""
+		The date of the last password change, in days since Jan 1, 1970.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.LAST_CHANGE)
+	
+	@property
+	def min_days(self):
+		"""
+		The minimum password age, in days.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.MIN_DAYS)
+	
+	@property
+	def max_days(self):
+		"""
+		The maximum password age, in days.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.MAX_DAYS)
 	
-	def __init__(self, service, bus_name, passwd_entry):
+	@property
+	def warn_days(self):
+		"""
+		The password warning period, in days.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.WARN_DAYS)
+	
+	@property
+	def inactive_days(self):
+		"""
+		The password inactivity period, in days.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.INACTIVE_DAYS)
+	
+	@property
+	def expire_date(self):
+		"""
+		The account expiration date, in days since Jan 1, 1970.
+		"""
+		
+		return shadow_cache.get_number(self.user, usersd.shadow.EXPIRE_DATE)
+	
+	def __init__(self, service, bus_name, record):
 		"""
 		Initializes the object.
 		"""
 		
 		self.service = service
 		
-		self.user, self.password, uid, gid, infos, self.home, self.shell = passwd_entry.split(":")
+		self.record = record
 		
-		# Parse GECOS
-		infos = infos.split(",")
-		self.fullname = self.address = self.phone = self.other = ""
-		if len(infos) >= 1:
-			self.fullname = infos[0]
-		if len(infos) >= 2:
-			self.address = infos[1]
-		if len(infos) >= 3:
-			self.phone = infos[2]
-		if len(infos) >= 4:
-			self.other = ",".join(infos[3:])
+		self.path = "/org/semplicelinux/usersd/user/%s" % self.uid
+		super().__init__(bus_name)
+	
+	@property
+	def set_privileges(self):
+		"""
+		Ensures the actual user can change its own password without
+		authenticating.
+		"""
 		
-		self.uid = int(uid)
-		self.gid = int(gid)
+		return (0, self.uid)
+	
+	def may_set_properties(self, uid, properties):
+		"""
+		Returns True if the given UID can set the given properties
+		without authentication.
 		
-		# Ensure the actual user can write its own properties without authenticating
-		self.set_privileges = [0, self.uid]
+		Users can change only their GECOS fields and their shell (to
+		one listed in /etc/shells); everything else, like the primary
+		group or the home directory, needs the Polkit policy.
+		"""
 		
-		self.path = "/org/semplicelinux/usersd/user/%s" % uid
-		super().__init__(bus_name)
+		if uid == 0:
+			return True
+		elif uid != self.uid:
+			return False
+		
+		for name, value in properties.items():
+			attribute = name[0].lower() + name[1:]
+			if attribute in SELF_SERVICE_PROPERTIES:
+				continue
+			elif attribute == "shell" and value in get_valid_shells():
+				continue
+			
+			return False
+		
+		return True
+	
+	def reload_record(self, record):
+		"""
+		Reloads the user details from an updated PasswdRecord, notifying
+		the changed properties.
+		"""
+		
+		old_record, self.record = self.record, record
+		
+		self.invalidate_properties(
+			field for field, old, new in zip(record._fields, old_record, record)
+			if old != new
+		)
+	
+	def to_record(self):
+		"""
+		Returns the PasswdRecord with the current user details.
+		"""
+		
+		return self.record
+	
+	@staticmethod
+	def validate_property(name, value):
+		"""
+		Validates a new value for the given property.
+		
+		Returns a tuple (attribute, value) with the attribute name and the
+		value converted to the right type. Raises an Exception if the
+		property can't be written or the value is not valid.
+		"""
+		
+		attribute = name[0].lower() + name[1:]
+		
+		if not attribute in WRITABLE_PROPERTIES:
+			raise Exception("The property %s is not writable" % name)
+		
+		if attribute in ("gid",):
+			if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+				raise Exception("%s must be a positive integer" % name)
+			
+			return attribute, int(value)
+		
+		if not isinstance(value, str):
+			raise Exception("%s must be a string" % name)
+		
+		forbidden = ":\n"
+		if attribute in ("fullname", "address", "phone"):
+			# GECOS subfields are comma-separated
+			forbidden += ","
+		
+		for char in forbidden:
+			if char in value:
+				raise Exception("%s must not contain %r" % (name, char))
+		
+		return attribute, str(value)
 	
 	def store_property(self, name, value):
 		"""
-		Stores the modified property in the /etc/passwd file.
+		Stores the modified property through the backend.
 		"""
-
-		# Set value
-		setattr(self, name[0].lower() + name[1:], value)
+		
+		return self.store_properties({name: value})
+	
+	def store_properties(self, properties):
+		"""
+		Stores the given modified properties through the backend,
+		with a single write.
+		
+		The object and the account store are updated right away; the
+		returned Deferred completes once the change is on disk.
+		"""
+		
+		if not self.service.backend.writable:
+			raise usersd.backends.ReadOnlyBackendError()
+		
+		# Validate everything before touching anything
+		validated = [
+			self.validate_property(name, value)
+			for name, value in properties.items()
+		]
+		
+		record = self.record._replace(**dict(validated))
 		
 		# Save
-		with open("/etc/passwd", "r") as f:
-			# w+ doesn't seem to work lately...
-			lines = f.readlines()
-		
-		with open("/etc/passwd", "w") as f:
-			for line in lines:
-				if line.split(":")[0] == self.user:
-					# That's us!
-					line = ":".join((
-						self.user,
-						self.password,
-						str(self.uid),
-						str(self.gid),
-						",".join((
-							self.fullname,
-							self.address,
-							self.phone,
-							self.other
-						)),
-						self.home,
-						self.shell
-					)) + "\n"
-				
-				f.write(line)
-
+		deferred = self.service.backend.write_user(record)
+		
+		old_record = self.record
+		
+		# Set values
+		self.record = record
+		self.invalidate_properties(attribute for attribute, value in validated)
+		
+		# Keep the account store in sync
+		self.service.store.add_user(record)
+		self.service.AccountsChanged([self.user], [])
+		
+		def on_committed(result, error):
+			if error is not None and self.record is record:
+				# Roll back
+				self.reload_record(old_record)
+				self.service.store.add_user(old_record)
+				self.service.AccountsChanged([self.user], [])
+		
+		return deferred.add_callback(on_committed)
+	
+	@usersd.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.usersd.user",
+		in_signature="a{sv}",
+		sender_keyword="sender",
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
+	)
+	def SetMany(self, properties, sender, connection, reply_handler, error_handler):
+		"""
+		Sets every property in the given dictionary at once.
+		
+		Authorization is checked only once, and /etc/passwd is rewritten
+		only once. If any value is not valid, nothing is changed.
+		"""
+		
+		self.call_authorized(
+			sender,
+			reply_handler,
+			error_handler,
+			self.store_properties,
+			properties,
+			properties=properties
+		)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# usersd - user management daemon
+# Copyright (C) 2014  Eugenio "g7" Paolantonio
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import ctypes
+import ctypes.util
+
+import struct
+
+from gi.repository import GLib
+
+from usersd.filesnapshot import FileSnapshot
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Milliseconds to wait after the first event of a burst before
+# reloading the changed files
+DEBOUNCE_INTERVAL = 250
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+class FileWatcher:
+	"""
+	Watches account files through inotify.
+	
+	Events are collected and debounced: after a burst of events the
+	given callback is called once, with a dictionary containing, for
+	every changed file, the changed and removed entries returned by
+	FileSnapshot.diff().
+	"""
+	
+	def __init__(self, callback):
+		"""
+		Initializes the watcher.
+		"""
+		
+		self.callback = callback
+		
+		# directory -> { basename -> FileSnapshot }
+		self.snapshots = {}
+		
+		# watch descriptor -> directory
+		self.watches = {}
+		
+		self.pending = set()
+		self.debounce_timeout = 0
+		
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		
+		self.source = GLib.io_add_watch(
+			self.fd,
+			GLib.PRIORITY_DEFAULT,
+			GLib.IO_IN,
+			self.on_inotify_event
+		)
+	
+	def add(self, path, state=None):
+		"""
+		Starts watching the given file.
+		
+		If specified, state (see FileSnapshot.dump()) is used as the
+		current state of the file instead of reading it.
+		"""
+		
+		# We watch the parent directory because tools like vipw or
+		# useradd replace the files by renaming a temporary copy
+		directory, basename = os.path.split(path)
+		
+		if not directory in self.snapshots:
+			wd = libc.inotify_add_watch(
+				self.fd,
+				directory.encode(),
+				WATCH_MASK
+			)
+			if wd < 0:
+				raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s" % directory)
+			
+			self.watches[wd] = directory
+			self.snapshots[directory] = {}
+		
+		snapshot = FileSnapshot(path)
+		if state is None:
+			snapshot.load()
+		else:
+			snapshot.restore(state)
+		
+		self.snapshots[directory][basename] = snapshot
+	
+	def on_inotify_event(self, fd, condition):
+		"""
+		Fired when there are inotify events waiting to be read.
+		"""
+		
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return True
+		
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+			offset += length
+			
+			if mask & IN_Q_OVERFLOW:
+				# We lost events, reload everything
+				for directory, snapshots in self.snapshots.items():
+					self.pending.update(snapshots.values())
+				continue
+			
+			directory = self.watches.get(wd)
+			if directory is None:
+				continue
+			
+			snapshot = self.snapshots[directory].get(name)
+			if snapshot is not None:
+				self.pending.add(snapshot)
+		
+		if self.pending and not self.debounce_timeout:
+			self.debounce_timeout = GLib.timeout_add(
+				DEBOUNCE_INTERVAL,
+				self.on_debounce_timeout_elapsed
+			)
+		
+		return True
+	
+	def on_debounce_timeout_elapsed(self):
+		"""
+		Fired when the burst of events is over.
+		"""
+		
+		self.debounce_timeout = 0
+		
+		pending, self.pending = self.pending, set()
+		
+		changes = {}
+		states = {}
+		for snapshot in pending:
+			changed, removed, states[snapshot] = snapshot.diff()
+			if changed or removed:
+				changes[snapshot.path] = (changed, removed)
+		
+		if changes:
+			# If this raises, the snapshots are left alone, so that the
+			# changes are reported again on the next event
+			self.callback(changes)
+		
+		for snapshot, hashes in states.items():
+			snapshot.hashes = hashes
+		
+		return False